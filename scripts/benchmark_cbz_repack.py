@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+基准测试：ZIP 压缩包转换为 CBZ 的耗时
+
+对比两种方式：
+  - before: 旧实现，解压到临时目录后以 ZIP_DEFLATED 重新压缩写入
+  - after:  cbztool.write_xml_to_zip，ZIP 成员原样复制压缩数据，不解压不重新压缩
+
+用法: python scripts/benchmark_cbz_repack.py [页数] [图片宽度]
+"""
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+# 添加父目录到路径以便导入模块
+sys.path.append('src')
+
+from PIL import Image
+import cbztool
+
+METADATA = {'Title': 'benchmark', 'Writer': 'benchmark'}
+
+
+class FakeApp:
+    config = {'KEEP_ORIGINAL_FILE': False, 'REMOVE_ADS': False, 'CBZ_COMPRESSION': 'stored'}
+
+
+def make_pages(count, width, distinct=20, seed=0):
+    """生成噪声 JPEG 页面（近似真实扫描图的不可压缩性），循环复用少量不同的图片以加快生成"""
+    rng = random.Random(seed)
+    height = int(width * 1.42)
+    samples = []
+    for _ in range(distinct):
+        img = Image.frombytes('L', (width, height), rng.randbytes(width * height)).convert('RGB')
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=85)
+        samples.append(buf.getvalue())
+    return [samples[i % distinct] for i in range(count)]
+
+
+def make_fixture(path, pages):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:
+        for i, data in enumerate(pages, 1):
+            zf.writestr(f'{i:04d}.jpg', data)
+
+
+def legacy_repack(file_path):
+    """旧实现：解压到临时目录，再以 ZIP_DEFLATED 逐个写入"""
+    root = os.path.dirname(file_path)
+    temp_dir = tempfile.mkdtemp(dir=root)
+    with zipfile.ZipFile(file_path, 'r') as archive:
+        archive.extractall(temp_dir)
+    names = sorted(os.listdir(temp_dir))
+    target = os.path.splitext(file_path)[0] + '.legacy.cbz'
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as tgt_zip:
+        for name in names:
+            with open(os.path.join(temp_dir, name), 'rb') as source, tgt_zip.open(name, 'w') as out:
+                shutil.copyfileobj(source, out)
+        tgt_zip.writestr('ComicInfo.xml', cbztool.make_comicinfo_xml(METADATA))
+    shutil.rmtree(temp_dir)
+    os.remove(file_path)
+    return target
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 800
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        fixture = os.path.join(work_dir, 'fixture.zip')
+        make_fixture(fixture, make_pages(pages, width))
+        size_mb = os.path.getsize(fixture) / 1024 / 1024
+        print(f"测试压缩包: {pages} 页, {size_mb:.1f} MB")
+
+        before_src = os.path.join(work_dir, 'before.zip')
+        shutil.copy(fixture, before_src)
+        before_out, before_time = timed(lambda: legacy_repack(before_src))
+        before_mb = os.path.getsize(before_out) / 1024 / 1024
+        print(f"before: {before_time:.2f} s, 输出 {before_mb:.1f} MB")
+
+        after_src = os.path.join(work_dir, 'after.zip')
+        shutil.copy(fixture, after_src)
+        after_out, after_time = timed(lambda: cbztool.write_xml_to_zip(after_src, METADATA, app=FakeApp()))
+        after_mb = os.path.getsize(after_out) / 1024 / 1024
+        print(f"after:  {after_time:.2f} s, 输出 {after_mb:.1f} MB")
+
+        with zipfile.ZipFile(after_out) as zf:
+            if zf.testzip() is not None or len(zf.namelist()) != pages + 1:
+                print("错误: 输出的 CBZ 不完整")
+                sys.exit(1)
+        print(f"提速约 {before_time / after_time:.1f} 倍，体积差 {before_mb - after_mb:+.1f} MB")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
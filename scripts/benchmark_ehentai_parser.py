@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+基准测试：E-Hentai 收藏夹页面解析的正确性和速度
+
+对比三种方式：
+  - before: 旧实现，BeautifulSoup + html.parser + CSS 选择器
+  - soup:   BeautifulSoup + lxml 解析器 + CSS 选择器（lxml 后端不可用时的路径）
+  - lxml:   lxml + XPath 定向提取（ehentai_parser.parse_favorites_page）
+
+默认使用按线上页面结构生成的四种布局（thumbnail / minimal / compact / extended）的收藏夹页面；
+也可以传入保存的收藏夹页面（浏览器“另存为 HTML”）所在目录，对比真实页面。
+
+用法: python scripts/benchmark_ehentai_parser.py [每页画廊数] [重复次数] [HTML 目录]
+"""
+import html
+import os
+import random
+import sys
+import time
+
+# 添加父目录到路径以便导入模块
+sys.path.append('src')
+
+from bs4 import BeautifulSoup
+from providers import ehentai_parser
+from providers.ehentai import EHentaiTools
+
+CATEGORIES = ['Doujinshi', 'Manga', 'Artist CG', 'Game CG', 'Non-H', 'Image Set', 'Western', 'Cosplay', 'Misc']
+FAVCATS = ['Favorites 0', 'Common', '💕', 'Read later', 'Favorites 4', 'Favorites 5', 'Favorites 6', 'Favorites 7', 'Favorites 8', 'Favorites 9']
+TAGS = ['artist:foo bar', 'group:circle', 'parody:original', 'character:alice', 'female:stockings',
+        'male:glasses', 'language:chinese', 'language:translated', 'other:full color', 'mixed:group']
+
+
+def make_galleries(count, seed):
+    rng = random.Random(seed)
+    galleries = []
+    for i in range(count):
+        gid = 3000000 - i * 7
+        token = ''.join(rng.choice('0123456789abcdef') for _ in range(10))
+        galleries.append({
+            'gid': gid,
+            'url': f'https://exhentai.org/g/{gid}/{token}/',
+            'title': f'[サークル &amp; Artist {i}] タイトル {i} &lt;Vol.{i % 5}&gt; [中国翻訳]',
+            'thumb': f'https://s.exhentai.org/t/{token[:2]}/{token[2:4]}/{token}-{i}-1280-1810-jpg_250.jpg',
+            'category': rng.choice(CATEGORIES),
+            'posted': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}',
+            'favcat': rng.randrange(len(FAVCATS)),
+            'pages': rng.randint(10, 300),
+            'tags': rng.sample(TAGS, rng.randint(0, len(TAGS))),
+        })
+    return galleries
+
+
+def tag_divs(tags):
+    return ''.join(f'<div class="gt" title="{tag}">{tag.split(":", 1)[1]}</div>' for tag in tags)
+
+
+def posted_div(g):
+    return (f'<div onclick="popUp(\'https://exhentai.org/gallerypopups.php?gid={g["gid"]}&amp;t=x&amp;act=addfav\',675,415)" '
+            f'style="border-color:#000;background-color:rgba(0,0,0,.1)" title="{FAVCATS[g["favcat"]]}" '
+            f'id="posted_{g["gid"]}">{g["posted"]}</div>')
+
+
+def render_thumbnail(galleries):
+    items = ''.join(
+        f'<div class="gl1t"><a href="{g["url"]}"><span class="glink">{g["title"]}</span></a>'
+        f'<div class="gl3t" style="height:340px;width:250px"><a href="{g["url"]}">'
+        f'<img style="height:340px;width:240px;top:0px" alt="{g["title"]}" title="{g["title"]}" src="{g["thumb"]}"></a></div>'
+        f'<div class="gl4t glname glink">{g["title"]}</div>'
+        f'<div class="gl5t"><div><div class="cs ct2" onclick="document.location=\'https://exhentai.org/doujinshi\'">{g["category"]}</div>'
+        f'{posted_div(g)}</div><div><div class="ir" style="background-position:0px -21px;opacity:1"></div><div>{g["pages"]} pages</div></div></div>'
+        f'<div class="gl6t">{tag_divs(g["tags"][:3])}</div></div>'
+        for g in galleries)
+    return f'<div class="itg gld">{items}</div>'
+
+
+def render_minimal(galleries):
+    rows = ''.join(
+        f'<tr><td class="gl1m glcat"><div class="cs ct2">{g["category"]}</div></td>'
+        f'<td class="gl2m"><div class="glthumb" id="it{g["gid"]}"><div><img style="height:283px;width:200px" alt="{g["title"]}" '
+        f'title="{g["title"]}" data-src="{g["thumb"]}" src="data:image/gif;base64,R0lGODlhAQABAAAAACw="></div></div>{posted_div(g)}</td>'
+        f'<td class="gl3m glname"><a href="{g["url"]}"><div class="glink">{g["title"]}</div></a></td>'
+        f'<td class="gl4m"><div class="ir" style="background-position:0px -1px;opacity:1"></div></td>'
+        f'<td class="gl5m glhide"><div><a href="https://exhentai.org/uploader/u{g["gid"] % 97}">u{g["gid"] % 97}</a></div></td></tr>'
+        for g in galleries)
+    return f'<table class="itg gltm"><tr><th>Category</th><th>Published</th><th>Title</th><th></th><th>Uploader</th></tr>{rows}</table>'
+
+
+def render_compact(galleries):
+    rows = ''.join(
+        f'<tr><td class="gl1c glcat"><div class="cn ct2" onclick="document.location=\'https://exhentai.org/doujinshi\'">{g["category"]}</div></td>'
+        f'<td class="gl2c"><div class="glcut" id="ic{g["gid"]}"></div><div class="glthumb" id="it{g["gid"]}"><div>'
+        f'<img style="height:283px;width:200px" alt="{g["title"]}" title="{g["title"]}" data-src="{g["thumb"]}" '
+        f'src="data:image/gif;base64,R0lGODlhAQABAAAAACw="></div></div><div>{posted_div(g)}'
+        f'<div class="ir" style="background-position:-16px -21px;opacity:1"></div></div></td>'
+        f'<td class="gl3c glname" onmouseover="show_image_pane({g["gid"]})"><a href="{g["url"]}"><div class="glink">{g["title"]}</div>'
+        f'<div>{tag_divs(g["tags"])}</div></a></td>'
+        f'<td class="gl4c glhide"><div><a href="https://exhentai.org/uploader/u1">u1</a></div><div>{g["pages"]} pages</div></td></tr>'
+        for g in galleries)
+    return f'<table class="itg gltc"><tr><th>Category</th><th>Published</th><th>Title</th><th>Uploader</th></tr>{rows}</table>'
+
+
+def render_extended(galleries):
+    def tag_table(tags):
+        rows = ''.join(f'<tr><td class="tc">{tag.split(":")[0]}:</td><td><div class="gt" title="{tag}">{tag.split(":", 1)[1]}</div></td></tr>'
+                       for tag in tags)
+        return f'<table><tr><td class="tc">namespace:</td></tr>{rows}</table>' if tags else ''
+    rows = ''.join(
+        f'<tr><td class="gl1e" style="width:250px"><div style="height:340px;width:250px"><a href="{g["url"]}">'
+        f'<img style="height:340px;width:240px;top:0px" alt="{g["title"]}" title="{g["title"]}" src="{g["thumb"]}"></a></div></td>'
+        f'<td class="gl2e"><div><div class="gl3e"><div class="cn ct2" onclick="document.location=\'https://exhentai.org/doujinshi\'">{g["category"]}</div>'
+        f'{posted_div(g)}<div class="ir" style="background-position:0px -21px;opacity:1"></div>'
+        f'<div><a href="https://exhentai.org/uploader/u1">u1</a></div><div>{g["pages"]} pages</div>'
+        f'<div class="gldown"><a href="https://exhentai.org/gallerytorrents.php?gid={g["gid"]}" onclick="return popUp(\'x\',610,590)" rel="nofollow">'
+        f'<img src="https://exhentai.org/img/t.png" alt="T" title="Show torrents"></a></div></div>'
+        f'<a href="{g["url"]}"><div class="gl4e glname" style="min-height:206px"><div class="glink">{g["title"]}</div>'
+        f'<div>{tag_table(g["tags"])}</div></div></a></div>'
+        f'<div class="glfe"><div class="glfnote">Favorited: {g["posted"]}</div></div></td></tr>'
+        for g in galleries)
+    return f'<table class="itg glte">{rows}</table>'
+
+
+RENDERERS = {
+    'thumbnail': render_thumbnail,
+    'minimal': render_minimal,
+    'compact': render_compact,
+    'extended': render_extended,
+}
+
+
+def make_page(layout, count, seed=0):
+    """生成与线上收藏夹页面结构一致的 HTML"""
+    favcat_divs = ''.join(
+        f'<div class="fp{" fps" if i == 0 else ""}" onclick="document.location=\'https://exhentai.org/favorites.php?favcat={i}\'">'
+        f'<div>{(i + 1) * 37}</div><div class="i" style="background-position:0px -{2 + 19 * i}px"></div><div>{html.escape(name)}</div></div>'
+        for i, name in enumerate(FAVCATS))
+    galleries = make_galleries(count, seed)
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>ExHentai.org</title>
+<script type="text/javascript">var base_url = "https://exhentai.org/";</script></head>
+<body><div class="ido"><h1 class="ih">Favorites</h1>
+<div class="nosel">{favcat_divs}<div class="fp" onclick="document.location='https://exhentai.org/favorites.php'"><div>Show All Favorites</div></div></div>
+<!-- favorites list -->
+<div class="searchnav"><div><a id="ufirst" href="https://exhentai.org/favorites.php">&lt;&lt; First</a></div>
+<div><a id="dnext" href="https://exhentai.org/favorites.php?next={galleries[-1]['gid']}-1700000000">Next &gt;</a></div></div>
+<form><div>{RENDERERS[layout](galleries)}</div></form>
+<div class="searchnav"><div><a id="unext" href="https://exhentai.org/favorites.php?next=1">Next &gt;</a></div></div>
+</div></body></html>"""
+
+
+def timed(func, repeat):
+    result = func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def parse_with_soup(text, features):
+    tools = EHentaiTools()
+    soup = BeautifulSoup(text, features)
+    layout, galleries = tools._parse_favorites_page(soup)
+    next_link = soup.select_one('div.searchnav a#dnext')
+    return layout, galleries, dict(tools.favcat_map), next_link.get('href') if next_link else None
+
+
+def parse_with_lxml(text):
+    tools = EHentaiTools()
+    tools.html_backend = ehentai_parser.BACKEND_LXML
+    layout, galleries, next_url = tools._parse_favorites_html(text)
+    return layout, galleries, dict(tools.favcat_map), next_url
+
+
+def load_pages(count, directory=None):
+    if directory:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(('.html', '.htm')):
+                with open(os.path.join(directory, name), encoding='utf-8') as f:
+                    yield name, f.read()
+        return
+    for layout in RENDERERS:
+        yield f'{layout} ({count} 个画廊)', make_page(layout, count)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    directory = sys.argv[3] if len(sys.argv) > 3 else None
+
+    if ehentai_parser.lxml_html is None:
+        print("未安装 lxml，无法对比（pip install lxml）")
+        sys.exit(1)
+
+    mismatched = False
+    for name, text in load_pages(count, directory):
+        before, before_time = timed(lambda: parse_with_soup(text, 'html.parser'), repeat)
+        soup, soup_time = timed(lambda: parse_with_soup(text, 'lxml'), repeat)
+        lxml, lxml_time = timed(lambda: parse_with_lxml(text), repeat)
+        print(f"{name}: layout={before[0]}, 画廊 {len(before[1])} 个, {len(text) / 1024:.0f} KB")
+        print(f"  before: {before_time * 1000:8.2f} ms")
+        print(f"  soup:   {soup_time * 1000:8.2f} ms  ({before_time / soup_time:.1f}x)")
+        print(f"  lxml:   {lxml_time * 1000:8.2f} ms  ({before_time / lxml_time:.1f}x)")
+        for label, result in (('soup', soup), ('lxml', lxml)):
+            if result != before:
+                mismatched = True
+                diffs = [i for i, (a, b) in enumerate(zip(result[1], before[1])) if a != b]
+                print(f"  错误: {label} 的解析结果与 before 不一致（layout/favcat/next 一致: "
+                      f"{result[0] == before[0]}/{result[2] == before[2]}/{result[3] == before[3]}，不一致的画廊: {diffs[:5]}）")
+                if diffs:
+                    print(f"    {label}:   {result[1][diffs[0]]}")
+                    print(f"    before: {before[1][diffs[0]]}")
+
+    if mismatched:
+        sys.exit(1)
+    print("所有页面的解析结果一致")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+基准测试：Hitomi 图片 URL 计算速度（URLs/秒）
+
+对比三种方式：
+  - before: 旧实现，每张图片启动一次 Node.js
+  - node:   回退方案，每个画廊启动一次 Node.js
+  - python: gg.js 解析为 Python 查找表后计算
+
+用法: python scripts/benchmark_hitomi_resolver.py [页数] [旧实现采样数]
+"""
+import random
+import shutil
+import sys
+import time
+
+# 添加父目录到路径以便导入模块
+sys.path.append('src')
+
+from providers.hitomi import GGResolver, NodeGGResolver
+
+DOMAIN = 'gold-usergeneratedcontent.net'
+
+
+def make_gg_script(case_count=600, seed=0):
+    """生成与线上 gg.js 结构一致的脚本"""
+    rng = random.Random(seed)
+    cases = sorted(rng.sample(range(4096), case_count))
+    case_lines = '\n'.join(f'case {c}:' for c in cases)
+    return f"""'use strict';
+gg = {{
+m: function(g) {{
+var o = 0;
+switch (g) {{
+{case_lines}
+o = 1; break;
+}}
+return o;
+}},
+s: function(h) {{ var m = /(..)(.)$/.exec(h); return parseInt(m[2]+m[1], 16).toString(10); }},
+b: '1718888888/'
+}};
+"""
+
+
+def make_hashes(count, seed=1):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('0123456789abcdef') for _ in range(64)) for _ in range(count)]
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    legacy_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    gg_script = make_gg_script()
+    hashes = make_hashes(pages)
+
+    resolver, parse_time = timed(lambda: GGResolver.parse(gg_script))
+    py_urls, py_time = timed(lambda: resolver.image_urls(hashes, DOMAIN))
+    print(f"python: 解析 gg.js {parse_time * 1000:.2f} ms, {pages} 个 URL 用时 {py_time * 1000:.2f} ms, "
+          f"{pages / py_time:,.0f} URLs/s")
+
+    if not shutil.which('node'):
+        print("未找到 node，跳过 Node.js 对比")
+        return
+
+    node = NodeGGResolver(gg_script)
+    node_urls, node_time = timed(lambda: node.image_urls(hashes, DOMAIN))
+    print(f"node:   {pages} 个 URL 用时 {node_time * 1000:.2f} ms, {pages / node_time:,.0f} URLs/s")
+
+    sample = hashes[:legacy_samples]
+    legacy_urls, legacy_time = timed(lambda: [node.image_url(h, DOMAIN) for h in sample])
+    print(f"before: {len(sample)} 个 URL 用时 {legacy_time * 1000:.2f} ms, {len(sample) / legacy_time:,.1f} URLs/s")
+
+    if node_urls != py_urls or legacy_urls != py_urls[:legacy_samples]:
+        print("错误: Python 与 Node.js 的计算结果不一致")
+        sys.exit(1)
+    print(f"结果一致，python 相比 before 提速约 {(pages / py_time) / (len(sample) / legacy_time):,.0f} 倍")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+检查：进程被强制结束后，流式 CBZ（CbzStreamWriter）能否从没有中央目录的 .part 继续写入
+
+模拟写入若干页后进程被杀死（.part 末尾没有中央目录，最后一页只写了一半），
+重新打开时应恢复所有完整的页面、丢弃不完整的页面，最终的 CBZ 不包含无效的前缀数据。
+
+用法: python scripts/check_cbz_stream_resume.py [页数] [每页大小KB]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+# 添加父目录到路径以便导入模块
+sys.path.append('src')
+
+from cbzstream import CbzStreamWriter
+
+
+def make_pages(count, size):
+    return [(f'{i:04d}.jpg', os.urandom(size)) for i in range(1, count + 1)]
+
+
+def simulate_kill(writer, partial):
+    """保留已写入的字节并追加半个本地文件头 + 部分数据，不写中央目录，模拟写入途中进程被杀死"""
+    writer.zf.fp.flush()
+    with open(writer.part_path, 'rb') as f:
+        data = f.read()
+    writer.abort()
+    with open(writer.part_path, 'wb') as f:
+        f.write(data + partial)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 100) * 1024
+    pages = make_pages(count, size)
+    written = count // 2
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(work_dir, 'gallery.cbz')
+        writer = CbzStreamWriter(path)
+        for name, data in pages[:written]:
+            writer.write(name, data)
+        simulate_kill(writer, b'PK\x03\x04' + os.urandom(size // 2))
+
+        writer = CbzStreamWriter(path)
+        resumed = set(writer.names)
+        expected = {name for name, _ in pages[:written]}
+        print(f"恢复的页面: {len(resumed)}/{written}")
+        for name, data in pages:
+            if name not in writer.names:
+                writer.write(name, data)
+        writer.close()
+
+        with zipfile.ZipFile(path) as zf:
+            bad = zf.testzip()
+            names = zf.namelist()
+            contents_ok = all(zf.read(name) == data for name, data in pages)
+        file_size = os.path.getsize(path)
+        print(f"最终 CBZ: {len(names)} 页, {file_size / 1024:.0f} KB, testzip: {bad or 'OK'}")
+
+        errors = []
+        if resumed != expected:
+            errors.append(f"恢复的页面不一致: {sorted(resumed)} != {sorted(expected)}")
+        if bad or not contents_ok or names != [name for name, _ in pages]:
+            errors.append("最终 CBZ 的成员或内容不正确")
+        if file_size > count * size * 1.05:
+            errors.append("最终 CBZ 包含多余的数据（未恢复的 .part 被保留为前缀）")
+        if os.path.exists(f"{path}.part") or os.path.exists(f"{path}.part.broken"):
+            errors.append("遗留了临时文件")
+        for error in errors:
+            print(f"失败: {error}")
+        sys.exit(1 if errors else 0)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+本地模拟 aria2 的 JSON-RPC / WebSocket 服务，用于在没有 aria2 的环境中测试下载流程
+
+- POST /jsonrpc: 支持 addUri、addTorrent、tellStatus、tellActive、remove、getGlobalStat、
+  changeGlobalOption 和 system.multicall，getGlobalStat 额外返回已处理的 RPC 数量 numRpcCalls
+- GET /jsonrpc (WebSocket): 推送 aria2.onDownloadStart / onDownloadComplete / onDownloadError /
+  onDownloadStop 通知
+- 每个任务在 --duration 秒内匀速下载完成，完成时在 dir 下写入 out 指定的文件
+  URI 中包含 "error" 的任务会在下载到一半时失败
+
+用法: python scripts/fake_aria2.py [--port 6800] [--duration 10] [--size 10485760]
+对应 config.yaml: aria2.server 设置为 http://127.0.0.1:6800/jsonrpc
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class FakeAria2:
+    def __init__(self, duration, size):
+        self.duration = duration
+        self.size = size
+        self.lock = threading.Lock()
+        self.downloads = {}
+        self.clients = set()
+        self.options = {}
+        self.next_gid = 1
+        self.calls = 0
+
+    def broadcast(self, method, gid):
+        frame = encode_frame(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': [{'gid': gid}]}).encode())
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.sendall(frame)
+            except OSError:
+                with self.lock:
+                    self.clients.discard(client)
+
+    def add(self, uri, options):
+        with self.lock:
+            gid = f'{self.next_gid:016x}'
+            self.next_gid += 1
+            directory = options.get('dir') or '.'
+            name = options.get('out') or os.path.basename(uri) or gid
+            self.downloads[gid] = {
+                'uri': uri,
+                'path': os.path.join(directory, name),
+                'started': time.monotonic(),
+                'status': 'active',
+                'errorCode': '0',
+            }
+        self.broadcast('aria2.onDownloadStart', gid)
+        threading.Thread(target=self._progress, args=(gid,), daemon=True).start()
+        return gid
+
+    def _progress(self, gid):
+        while True:
+            time.sleep(0.2)
+            with self.lock:
+                item = self.downloads[gid]
+                if item['status'] != 'active':
+                    return
+                ratio = (time.monotonic() - item['started']) / self.duration
+                if 'error' in item['uri'] and ratio >= 0.5:
+                    item['status'] = 'error'
+                    item['errorCode'] = '1'
+                    event = 'aria2.onDownloadError'
+                elif ratio >= 1:
+                    item['status'] = 'complete'
+                    event = 'aria2.onDownloadComplete'
+                else:
+                    continue
+            if event == 'aria2.onDownloadComplete':
+                os.makedirs(os.path.dirname(item['path']) or '.', exist_ok=True)
+                with open(item['path'], 'wb') as f:
+                    f.write(b'\0' * min(self.size, 1024))
+            self.broadcast(event, gid)
+            return
+
+    def status(self, gid):
+        with self.lock:
+            item = self.downloads.get(gid)
+            if item is None:
+                raise KeyError(f'GID {gid} is not found')
+            ratio = min(1.0, (time.monotonic() - item['started']) / self.duration)
+            if item['status'] == 'complete':
+                ratio = 1.0
+            active = item['status'] == 'active'
+            return {
+                'gid': gid,
+                'status': item['status'],
+                'errorCode': item['errorCode'],
+                'errorMessage': 'fake error' if item['status'] == 'error' else '',
+                'totalLength': str(self.size),
+                'completedLength': str(int(self.size * ratio)),
+                'downloadSpeed': str(int(self.size / self.duration) if active else 0),
+                'files': [{'path': item['path']}],
+            }
+
+    def remove(self, gid):
+        with self.lock:
+            item = self.downloads[gid]
+            item['status'] = 'removed'
+        self.broadcast('aria2.onDownloadStop', gid)
+        return gid
+
+    def call(self, method, params):
+        if method == 'system.multicall':
+            results = []
+            for item in params[0]:
+                try:
+                    results.append([self.call(item['methodName'], item.get('params') or [])])
+                except Exception as e:
+                    results.append({'code': 1, 'message': str(e)})
+            return results
+        if params and isinstance(params[0], str) and params[0].startswith('token:'):
+            params = params[1:]
+        if method == 'aria2.addUri':
+            return self.add(params[0][0], params[1] if len(params) > 1 else {})
+        if method == 'aria2.addTorrent':
+            return self.add(f'torrent-{len(params[0])}', params[2] if len(params) > 2 else {})
+        if method == 'aria2.tellStatus':
+            status = self.status(params[0])
+            if len(params) > 1 and params[1]:
+                status = {key: value for key, value in status.items() if key in params[1]}
+            return status
+        if method == 'aria2.tellActive':
+            with self.lock:
+                gids = [gid for gid, item in self.downloads.items() if item['status'] == 'active']
+            return [self.status(gid) for gid in gids]
+        if method in ('aria2.remove', 'aria2.forceRemove'):
+            return self.remove(params[0])
+        if method == 'aria2.getGlobalStat':
+            with self.lock:
+                active = sum(1 for item in self.downloads.values() if item['status'] == 'active')
+                calls = self.calls
+            return {'numActive': str(active), 'downloadSpeed': '0', 'uploadSpeed': '0', 'numRpcCalls': str(calls)}
+        if method == 'aria2.changeGlobalOption':
+            with self.lock:
+                self.options.update(params[0])
+            print(f'changeGlobalOption: {params[0]}')
+            return 'OK'
+        if method == 'aria2.getGlobalOption':
+            with self.lock:
+                return dict(self.options)
+        raise KeyError(f'Unsupported method: {method}')
+
+
+def encode_frame(payload, opcode=0x1):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'fake-aria2'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        with self.server.aria2.lock:
+            self.server.aria2.calls += 1
+        try:
+            reply = {'jsonrpc': '2.0', 'id': body.get('id'), 'result': self.server.aria2.call(body['method'], body.get('params') or [])}
+        except Exception as e:
+            reply = {'jsonrpc': '2.0', 'id': body.get('id'), 'error': {'code': 1, 'message': str(e)}}
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_error(400)
+            return
+        accept = base64.b64encode(hashlib.sha1(key.encode() + WS_GUID).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        aria2 = self.server.aria2
+        with aria2.lock:
+            aria2.clients.add(self.connection)
+        try:
+            # 只读取客户端的控制帧，直到连接关闭
+            while True:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    break
+                opcode, length = header[0] & 0x0F, header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack('!H', self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('!Q', self.rfile.read(8))[0]
+                if header[1] & 0x80:
+                    self.rfile.read(4)
+                self.rfile.read(length)
+                if opcode == 0x8:
+                    break
+        finally:
+            with aria2.lock:
+                aria2.clients.discard(self.connection)
+        self.close_connection = True
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟 aria2 JSON-RPC / WebSocket 服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6800)
+    parser.add_argument('--duration', type=float, default=10, help='每个任务的下载耗时（秒）')
+    parser.add_argument('--size', type=int, default=10 * 1024 * 1024, help='每个任务的文件大小（字节）')
+    args = parser.parse_args()
+
+    server = Server((args.host, args.port), Handler)
+    server.aria2 = FakeAria2(args.duration, args.size)
+    print(f'fake aria2 listening on http://{args.host}:{args.port}/jsonrpc')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+广告页检测的进程池任务
+
+该模块作为 detectAd 进程池的任务入口，只依赖 PIL、numpy 和 pyzbar，导入时没有副作用：
+不打开数据库、不读取配置，已知广告哈希由调用方作为参数传入。
+"""
+from typing import Dict, List, Optional, Tuple
+from PIL import Image, ImageOps
+import numpy as np
+import io, re, time
+from pyzbar.pyzbar import decode, ZBarSymbol
+
+# pHash 和 dHash 与已知广告页的汉明距离均不超过该值时直接判定为广告
+AD_HASH_MAX_DISTANCE = 6
+
+# 二维码白名单
+qr_code_white_list = [
+    r"^https://[^.]+\.fanbox\.cc",
+    r"^https://twitter\.com",
+    r"^https://x\.com",
+    r"^https://www\.pixiv\.net",
+    r"^https://www\.dmm\.co\.jp",
+    r"^https://fantia\.jp",
+    r"^https://marshmallow-qa\.com",
+    r"^https://www\.dlsite\.com",
+    r"^https://hitomi\.la",
+]
+
+# 判断是否彩色图片
+def is_color_img(img: Image.Image) -> bool:
+    arr = np.asarray(img)
+    if arr.ndim < 3:
+        return False
+    # 每隔 16 个像素采样
+    samples = arr.reshape(-1, arr.shape[2])[::16, :3]
+    r, g, b = samples[:, 0], samples[:, 1], samples[:, 2]
+    return bool(np.any((r != g) | (r != b)))
+
+# 识别二维码
+def get_qr_code(img: Image.Image) -> Optional[str]:
+    try:
+        decoded = decode(img, symbols=[ZBarSymbol.QRCODE])
+        if not decoded:
+            return None
+        return decoded[0].data.decode("utf-8")
+    except Exception:
+        return None
+
+# 检测广告页，返回 (是否广告, 二维码内容)
+def scan_ad_img(img: Image.Image) -> Tuple[bool, Optional[str]]:
+    # 强制转 RGB
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    # 缩小大图提高识别速度
+    MAX_DIM = 1024
+    if max(img.width, img.height) > MAX_DIM:
+        scale = MAX_DIM / max(img.width, img.height)
+        new_size = (int(img.width * scale), int(img.height * scale))
+        img = img.resize(new_size, Image.Resampling.LANCZOS)
+
+    # 黑白图肯定不是广告
+    if not is_color_img(img):
+        return False, None
+
+    # 转灰度二值化
+    gray = ImageOps.grayscale(img)
+    binary = gray.point(lambda p: 255 if p >= 200 else 0)
+
+    # 全图识别二维码
+    text = get_qr_code(binary)
+
+    # 分块扫描
+    if not text:
+        w, h = img.width // 2, img.height // 2
+        for sx, sy in [(w, h), (0, h), (w, 0), (0, 0)]:
+            try:
+                text = get_qr_code(img.crop((sx, sy, sx + w, sy + h)))
+            except Exception:
+                continue
+            if text:
+                break
+
+    if text:
+        return all(not re.match(reg, text) for reg in qr_code_white_list), text
+    return False, None
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+# 32x32 DCT-II 变换矩阵
+_N = 32
+_DCT = np.sqrt(2 / _N) * np.cos(np.pi * (2 * np.arange(_N)[None, :] + 1) * np.arange(_N)[:, None] / (2 * _N))
+_DCT[0] /= np.sqrt(2)
+
+# 感知哈希：灰度缩放到 32x32 做 DCT，取左上 8x8 低频分量与中位数比较
+def phash(img: Image.Image) -> int:
+    pixels = np.asarray(img.convert("L").resize((_N, _N), Image.Resampling.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8]
+    return _bits_to_int(low > np.median(low))
+
+# 差异哈希：灰度缩放到 9x8，比较相邻像素
+def dhash(img: Image.Image) -> int:
+    pixels = np.asarray(img.convert("L").resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+# 纯色、空白等页面的哈希几乎全 0 或全 1，不能用于比对
+def is_informative_hash(hashes: Tuple[int, int]) -> bool:
+    return all(8 <= h.bit_count() <= 56 for h in hashes)
+
+def match_known_ad(hashes: Tuple[int, int], known: List[Tuple[int, int]]) -> Optional[Tuple[int, int]]:
+    """在已知广告哈希中查找 pHash 和 dHash 均足够接近的记录"""
+    if not is_informative_hash(hashes):
+        return None
+    p, d = hashes
+    for known_p, known_d in known:
+        if (p ^ known_p).bit_count() <= AD_HASH_MAX_DISTANCE and (d ^ known_d).bit_count() <= AD_HASH_MAX_DISTANCE:
+            return known_p, known_d
+    return None
+
+# 进程池任务：从图片数据检测广告页
+# 先与已知广告哈希比对，未命中时才识别二维码
+def scan_ad_page(data: bytes, known: List[Tuple[int, int]] = ()) -> Dict:
+    start = time.perf_counter()
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        hashes = (phash(img), dhash(img))
+        matched = match_known_ad(hashes, known)
+        if matched:
+            is_ad, text = True, None
+        else:
+            is_ad, text = scan_ad_img(img)
+    return {
+        "is_ad": is_ad,
+        "text": text,
+        "hashes": hashes,
+        "matched": matched,
+        "elapsed": time.perf_counter() - start,
+    }
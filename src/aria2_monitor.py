@@ -0,0 +1,501 @@
+import os
+import ssl
+import json
+import time
+import base64
+import socket
+import struct
+import hashlib
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+from providers import aria2
+from utils import get_task_info
+from transfer_meter import estimate_eta, format_size, format_speed
+
+# 轮询 aria2 状态的间隔（秒），用于更新进度；WebSocket 不可用时也靠它发现任务结束
+POLL_INTERVAL = 5
+# WebSocket 断开后的重连间隔（秒）
+RECONNECT_INTERVAL = 30
+# 死种判断：长时间没有任何进度 / 长时间没有速度时移除任务
+NO_PROGRESS_TIMEOUT = 300
+NO_SPEED_TIMEOUT = 7200
+# 连续无法获取状态超过该时长（秒）判定 aria2 不可用
+MAX_ERROR_DURATION = 3600
+# 轮询时只请求需要的字段，减少 BT 任务（文件列表、peers 等）的响应体积
+STATUS_KEYS = ['gid', 'status', 'errorCode', 'errorMessage', 'totalLength', 'completedLength', 'downloadSpeed', 'files']
+# 已下载长度达到总长度后，最多等待 status 变为 complete 的时间（秒）
+COMPLETE_GRACE = 5
+
+# aria2 WebSocket 通知
+EVENT_COMPLETE = 'complete'
+EVENT_ERROR = 'error'
+EVENT_STOP = 'stop'
+NOTIFICATIONS = {
+    'aria2.onDownloadComplete': EVENT_COMPLETE,
+    'aria2.onBtDownloadComplete': EVENT_COMPLETE,
+    'aria2.onDownloadError': EVENT_ERROR,
+    'aria2.onDownloadStop': EVENT_STOP,
+}
+
+_WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def websocket_url(rpc_url):
+    """由 aria2 的 HTTP RPC 地址得到 WebSocket 地址，如 http://host:6800/jsonrpc -> ws://host:6800/jsonrpc"""
+    parts = urlsplit(rpc_url or '')
+    if parts.scheme in ('ws', 'wss'):
+        return rpc_url
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        return None
+    scheme = 'wss' if parts.scheme == 'https' else 'ws'
+    return parts._replace(scheme=scheme).geturl()
+
+
+class WebSocketClient:
+    """只用于接收 aria2 通知的最小 WebSocket 客户端（RFC 6455，文本帧 + ping/pong/close）"""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b''
+        self.fragments = []
+
+    def connect(self):
+        parts = urlsplit(self.url)
+        secure = parts.scheme == 'wss'
+        port = parts.port or (443 if secure else 80)
+        sock = socket.create_connection((parts.hostname, port), timeout=self.timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parts.hostname)
+
+        key = base64.b64encode(os.urandom(16))
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        sock.sendall(
+            f'GET {path} HTTP/1.1\r\n'
+            f'Host: {parts.netloc}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key.decode()}\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n'.encode()
+        )
+
+        response = b''
+        while b'\r\n\r\n' not in response:
+            chunk = sock.recv(4096)
+            if not chunk:
+                sock.close()
+                raise ConnectionError('WebSocket 握手时连接被关闭')
+            response += chunk
+        header, self.buffer = response.split(b'\r\n\r\n', 1)
+        lines = header.decode('latin-1').split('\r\n')
+        headers = {k.strip().lower(): v.strip() for k, v in (line.split(':', 1) for line in lines[1:] if ':' in line)}
+        expected = base64.b64encode(hashlib.sha1(key + _WS_GUID).digest()).decode()
+        if ' 101 ' not in f'{lines[0]} ' or headers.get('sec-websocket-accept') != expected:
+            sock.close()
+            raise ConnectionError(f'WebSocket 握手失败: {lines[0]}')
+        self.sock = sock
+
+    def _send_frame(self, opcode, payload=b''):
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def _parse_frame(self):
+        """从缓冲区解析一个完整的帧，数据不足时返回 None"""
+        data = self.buffer
+        if len(data) < 2:
+            return None
+        fin, opcode = data[0] & 0x80, data[0] & 0x0F
+        masked, length = data[1] & 0x80, data[1] & 0x7F
+        offset = 2
+        if length == 126:
+            if len(data) < 4:
+                return None
+            length = struct.unpack('!H', data[2:4])[0]
+            offset = 4
+        elif length == 127:
+            if len(data) < 10:
+                return None
+            length = struct.unpack('!Q', data[2:10])[0]
+            offset = 10
+        mask = b''
+        if masked:
+            mask = data[offset:offset + 4]
+            offset += 4
+        if len(data) < offset + length:
+            return None
+        payload = data[offset:offset + length]
+        if masked:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.buffer = data[offset + length:]
+        return fin, opcode, payload
+
+    def recv(self, timeout):
+        """
+        读取一条文本消息，timeout 秒内没有完整消息时返回 None
+        连接关闭时抛出 ConnectionError
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self._parse_frame()
+            if frame is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.sock.settimeout(remaining)
+                try:
+                    chunk = self.sock.recv(65536)
+                except socket.timeout:
+                    return None
+                if not chunk:
+                    raise ConnectionError('WebSocket 连接已关闭')
+                self.buffer += chunk
+                continue
+
+            fin, opcode, payload = frame
+            if opcode == 0x8:
+                raise ConnectionError('aria2 关闭了 WebSocket 连接')
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+                continue
+            if opcode in (0x1, 0x2, 0x0):
+                self.fragments.append(payload)
+                if fin:
+                    message = b''.join(self.fragments)
+                    self.fragments = []
+                    return message.decode('utf-8', errors='replace')
+
+    def close(self):
+        if self.sock:
+            try:
+                self._send_frame(0x8)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+
+
+class _Watch:
+    """一个正在等待的 aria2 下载"""
+
+    def __init__(self, gid, logger, task_id, tasks, tasks_lock):
+        self.gid = gid
+        self.logger = logger
+        self.task_id = task_id
+        self.task = get_task_info(task_id, tasks, tasks_lock)
+        self.future = Future()
+        now = time.monotonic()
+        self.last_progress_at = now
+        self.last_speed_at = now
+        self.first_error_at = None
+        self.complete_seen_at = None
+        self.last_logged_progress = -1
+        self.last_log_time = 0
+
+
+class Aria2Monitor:
+    """
+    aria2 下载监视器：所有任务共用一个后台线程和一条 WebSocket 连接
+
+    watch(gid) 返回 Future，aria2 推送 onDownloadComplete / onBtDownloadComplete / onDownloadError /
+    onDownloadStop 通知时立即查询结果并完成 Future（结果为文件路径，失败或取消为 None）。
+    同一线程每 POLL_INTERVAL 秒通过一次 system.multicall 查询所有任务的进度（复用 keep-alive 连接），
+    同时处理取消、死种和 WebSocket 不可用时的状态兜底。
+    没有等待中的任务时线程退出并断开连接。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.thread = None
+        self.rpc = None
+        self.ws_url = None
+        self.logger = None
+        self.wakeup = threading.Event()
+
+    def configure(self, server, token, logger=None):
+        with self.lock:
+            self.rpc = aria2.Aria2RPC(url=server, token=token, logger=logger) if server else None
+            self.ws_url = websocket_url(server)
+            self.logger = logger
+        self.wakeup.set()
+
+    def watch(self, gid, logger=None, task_id=None, tasks=None, tasks_lock=None):
+        """开始等待 gid 对应的下载，返回 Future"""
+        watch = _Watch(gid, logger, task_id, tasks, tasks_lock)
+        with self.lock:
+            if self.rpc is None:
+                raise RuntimeError('aria2 RPC 未配置')
+            self.watches[gid] = watch
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='aria2-monitor', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return watch.future
+
+    def _resolve(self, watch, value):
+        with self.lock:
+            self.watches.pop(watch.gid, None)
+        if not watch.future.done():
+            watch.future.set_result(value)
+
+    def _run(self):
+        ws = None
+        next_connect = 0.0
+        next_poll = 0.0
+        try:
+            while True:
+                with self.lock:
+                    if not self.watches:
+                        self.thread = None
+                        return
+                    ws_url = self.ws_url
+
+                try:
+                    now = time.monotonic()
+                    if ws is None and ws_url and now >= next_connect:
+                        try:
+                            ws = WebSocketClient(ws_url)
+                            ws.connect()
+                            if self.logger:
+                                self.logger.info(f"已连接 aria2 WebSocket: {ws_url}")
+                        except Exception as e:
+                            ws = None
+                            next_connect = now + RECONNECT_INTERVAL
+                            if self.logger:
+                                self.logger.warning(f"无法连接 aria2 WebSocket，改为轮询状态: {e}")
+
+                    if now >= next_poll:
+                        next_poll = now + POLL_INTERVAL
+                        self._poll()
+
+                    timeout = max(0.1, next_poll - time.monotonic())
+                    if ws is not None:
+                        try:
+                            message = ws.recv(timeout)
+                            if message:
+                                self._on_message(message)
+                        except (OSError, ConnectionError) as e:
+                            if self.logger:
+                                self.logger.warning(f"aria2 WebSocket 连接断开: {e}")
+                            ws.close()
+                            ws = None
+                            next_connect = time.monotonic() + RECONNECT_INTERVAL
+                    else:
+                        self.wakeup.wait(timeout)
+                        self.wakeup.clear()
+                except Exception as e:
+                    # 单次循环中的意外错误（异常的通知或状态数据等）不能让监视线程退出
+                    if self.logger:
+                        self.logger.error(f"aria2 监视线程发生错误: {e}", exc_info=True)
+                    self.wakeup.wait(1)
+                    self.wakeup.clear()
+        finally:
+            if ws is not None:
+                ws.close()
+            # 线程意外退出时让 watch() 可以重新启动线程，并结束所有等待中的任务，避免调用方永久阻塞
+            # （正常退出时 thread 已在循环中置为 None，此时新加入的任务属于新线程）
+            watches = []
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+                    watches = list(self.watches.values())
+                    self.watches.clear()
+            for watch in watches:
+                if not watch.future.done():
+                    if watch.logger:
+                        watch.logger.error(f"aria2 监视线程已退出，任务失败 (gid: {watch.gid})")
+                    watch.future.set_result(None)
+
+    def _on_message(self, message):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        event = NOTIFICATIONS.get(data.get('method'))
+        if not event:
+            return
+        for param in data.get('params') or []:
+            gid = param.get('gid') if isinstance(param, dict) else None
+            with self.lock:
+                watch = self.watches.get(gid)
+            if watch:
+                if watch.logger:
+                    watch.logger.info(f"收到 aria2 通知: {data['method']} (gid: {gid})")
+                self._check(watch, event)
+
+    def _is_cancelled(self, watch):
+        return bool(watch.task and watch.task.cancel_event.is_set())
+
+    def _poll(self):
+        """一次 system.multicall 查询所有等待中任务的状态，请求数与任务数量无关"""
+        with self.lock:
+            watches = list(self.watches.values())
+        watches = [watch for watch in watches if not self._cancel_if_requested(watch)]
+        if not watches:
+            return
+        try:
+            statuses = self.rpc.tell_status_many([watch.gid for watch in watches], keys=STATUS_KEYS)
+        except Exception as e:
+            for watch in watches:
+                self._on_error(watch, e)
+            return
+        for watch in watches:
+            self._on_status(watch, statuses.get(watch.gid))
+
+    def _check(self, watch, event=None):
+        """收到通知时查询单个下载的状态"""
+        if self._cancel_if_requested(watch):
+            return
+        try:
+            result = self.rpc.tell_status(watch.gid, keys=STATUS_KEYS)
+        except Exception as e:
+            self._on_error(watch, e)
+            return
+        self._on_status(watch, result.get('result') or result.get('error'), event)
+
+    def _cancel_if_requested(self, watch):
+        """任务被用户取消时停止 aria2 下载并完成 Future，返回是否已取消"""
+        if not self._is_cancelled(watch):
+            return False
+        if watch.logger:
+            watch.logger.info(f"任务 {watch.task_id} 被用户取消，正在停止 aria2 下载")
+        try:
+            self.rpc.remove(watch.gid)
+        except Exception as e:
+            if watch.logger:
+                watch.logger.warning(f"停止 aria2 下载失败: {e}")
+        self._resolve(watch, None)
+        return True
+
+    def _on_status(self, watch, result, event=None):
+        if not isinstance(result, dict) or 'status' not in result:
+            message = result.get('message') if isinstance(result, dict) else result
+            self._on_error(watch, message)
+            return
+        try:
+            self._handle_status(watch, result, event)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            # 状态数据不完整（如缺少 files / completedLength），按获取状态失败处理
+            self._on_error(watch, f"无法解析 aria2 状态: {e!r}")
+            return
+        watch.first_error_at = None
+
+    def _on_error(self, watch, error):
+        """获取状态失败：持续失败超过 MAX_ERROR_DURATION 时判定任务失败"""
+        logger = watch.logger
+        now = time.monotonic()
+        if watch.first_error_at is None:
+            watch.first_error_at = now
+        error_duration = now - watch.first_error_at
+        if logger:
+            logger.warning(f"获取 aria2 状态时发生异常，将继续重试 (已持续 {int(error_duration)}秒): {error}")
+        if error_duration > MAX_ERROR_DURATION:
+            if logger:
+                logger.error(f"连续 {int(error_duration)}秒 无法连接 aria2 服务，判定为服务不可用，任务失败")
+            self._resolve(watch, None)
+
+    def _handle_status(self, watch, result, event=None):
+        logger = watch.logger
+        status = result['status']
+
+        # 如果下载文件已经存在, 且未在 Aria2 开启 --allow-overwrite, 则会报错并返回 errorCode 13, 此时直接返回文件路径
+        if status == 'error' and result.get('errorCode') == "13":
+            if logger:
+                logger.info("文件已存在，下载任务将被跳过")
+            self._resolve(watch, result['files'][0]['path'])
+            return
+
+        completelen = int(result['completedLength'])
+        totallen = int(result['totalLength'])
+        download_speed = int(result['downloadSpeed'])
+        progress = min(100, int((completelen / totallen) * 100)) if totallen > 0 else 0
+
+        # 更新任务进度信息
+        if watch.task:
+            watch.task.update_progress(progress=progress, downloaded=completelen, total_size=totallen, speed=download_speed,
+                                       eta=estimate_eta(totallen - completelen, download_speed) if totallen > 0 else None)
+
+        # 智能日志策略：前 10% 和 90% 以后更频繁
+        now = time.monotonic()
+        if progress < 10 or progress >= 90:
+            log_interval, progress_threshold = 10, 2
+        else:
+            log_interval, progress_threshold = 30, 5
+        if logger and (
+            abs(progress - watch.last_logged_progress) >= progress_threshold or
+            now - watch.last_log_time >= log_interval or
+            status in ['complete', 'error', 'removed']
+        ):
+            logger.info(
+                f"Aria2 [{status}] {progress}% "
+                f"({format_size(completelen)}/{format_size(totallen)}) "
+                f"@ {format_speed(download_speed)}"
+            )
+            watch.last_logged_progress = progress
+            watch.last_log_time = now
+
+        # 任务完成（BT 任务下载完成后可能继续做种，status 仍为 active）
+        if status == 'complete' or event == EVENT_COMPLETE:
+            if logger:
+                logger.info("Download complete.")
+            self._resolve(watch, result['files'][0]['path'])
+            return
+
+        # 已完成长度达到总长度，最多等待 COMPLETE_GRACE 秒让 status 更新为 complete
+        if completelen >= totallen and totallen > 0:
+            if watch.complete_seen_at is None:
+                watch.complete_seen_at = now
+                if logger:
+                    logger.info(f"文件已下载完成，等待最多 {COMPLETE_GRACE} 秒确认 status 完成")
+            elif now - watch.complete_seen_at >= COMPLETE_GRACE:
+                if logger:
+                    logger.info("status 仍未更新为 complete，但已视为完成")
+                self._resolve(watch, result['files'][0]['path'])
+            return
+
+        # 任务失败或被移除
+        if status in ['removed', 'error'] or event in (EVENT_ERROR, EVENT_STOP):
+            if logger:
+                error_msg = result.get('errorMessage', 'Unknown error')
+                logger.error(f"Aria2 任务失败: status={status}, error={error_msg}")
+            self._resolve(watch, None)
+            return
+
+        # 判断死种: 长时间无进度 / 无速度
+        if completelen > 0:
+            watch.last_progress_at = now
+        if download_speed > 0:
+            watch.last_speed_at = now
+        if completelen == 0 and now - watch.last_progress_at >= NO_PROGRESS_TIMEOUT:
+            if logger:
+                logger.warning("No progress for 5 minutes, removing task.")
+            self._remove(watch)
+        elif now - watch.last_speed_at >= NO_SPEED_TIMEOUT:
+            if logger:
+                logger.warning("No speed for 2 hours, removing task.")
+            self._remove(watch)
+
+    def _remove(self, watch):
+        try:
+            self.rpc.remove(watch.gid)
+        except Exception as e:
+            if watch.logger:
+                watch.logger.warning(f"移除 aria2 任务失败: {e}")
+        self._resolve(watch, None)
+
+
+# 全局实例
+aria2_monitor = Aria2Monitor()
@@ -0,0 +1,211 @@
+import re
+import threading
+import time
+from datetime import datetime
+
+from ratelimit import TokenBucket
+
+# 下载循环中两次检查限速计划之间的最小间隔（秒）
+SCHEDULE_CHECK_INTERVAL = 30
+# 令牌桶容量对应的秒数，允许短时间突发
+BURST_SECONDS = 1.0
+
+_BANDWIDTH_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?\s*(?:/\s*s)?\s*$', re.IGNORECASE)
+_UNIT_BYTES = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+_TIME_RANGE_PATTERN = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*[-~–]\s*(\d{1,2}):(\d{2})\s*$')
+
+
+def parse_bandwidth(value):
+    """
+    解析带宽字符串为每秒字节数，如 '2M' / '2 MB/s' -> 2097152, '512K' -> 524288, 纯数字按字节计算
+    空值、0 或 'unlimited' 表示不限速，返回 None
+    """
+    if value in (None, '', 0, False) or str(value).strip().lower() in ('unlimited', 'none', '0'):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) if value > 0 else None
+    match = _BANDWIDTH_PATTERN.match(str(value))
+    if not match:
+        raise ValueError(f"无法解析带宽: {value}，格式应为 数字+单位，如 2M、512K")
+    number, unit = match.groups()
+    rate = float(number) * _UNIT_BYTES[unit.lower()]
+    return rate if rate > 0 else None
+
+
+def parse_time_range(value):
+    """解析 'HH:MM-HH:MM' 为 (开始分钟, 结束分钟)，结束早于开始时表示跨越午夜"""
+    match = _TIME_RANGE_PATTERN.match(str(value or ''))
+    if not match:
+        raise ValueError(f"无法解析时段: {value}，格式应为 HH:MM-HH:MM")
+    start_h, start_m, end_h, end_m = (int(part) for part in match.groups())
+    if start_h > 24 or end_h > 24 or start_m > 59 or end_m > 59:
+        raise ValueError(f"无效的时段: {value}")
+    return start_h * 60 + start_m, end_h * 60 + end_m
+
+
+def _in_range(minute, time_range):
+    start, end = time_range
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+def _format_rate(rate):
+    if not rate:
+        return '不限速'
+    if rate >= 1024 ** 2:
+        return f"{rate / 1024 ** 2:.2f} MB/s"
+    return f"{rate / 1024:.0f} KB/s"
+
+
+class BandwidthLimiter:
+    """
+    进程级的下载带宽限制器，所有进程内的下载流（E-Hentai 归档、HDoujin、nhentai、Hitomi）共享
+
+    配置示例 (config.yaml):
+        bandwidth:
+          limit: 0
+          providers:
+            hitomi: 1M
+          schedule:
+            - time: "08:00-23:00"
+              limit: 2M
+              providers: {nhentai: 512K}
+          aria2: true
+
+    全局令牌桶与各 provider 的令牌桶同时生效。schedule 按顺序匹配当前本地时间，命中的时段
+    使用该时段的 limit 和 providers（未列出的 provider 沿用顶层设置），都不命中时使用顶层设置。
+    限速变化时调用通过 on_change 注册的回调（例如设置 aria2 的全局限速）。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.default_rule = {'limit': None, 'providers': {}}
+        self.schedule = []
+        self.apply_to_aria2 = True
+        self.logger = None
+        self.active = None
+        self.global_bucket = None
+        self.provider_buckets = {}
+        self.callbacks = []
+        # 是否已通过回调设置过限速（取消限速配置后需要再通知一次以解除限速）
+        self.notified = False
+        self.next_check = 0.0
+
+    def configure(self, config, logger=None):
+        """根据 bandwidth 配置段更新限速规则并立即应用当前时段"""
+        config = config or {}
+        default_rule = self._parse_rule(config, 'bandwidth', logger)
+        schedule = []
+        for index, entry in enumerate(config.get('schedule') or []):
+            try:
+                time_range = parse_time_range(entry.get('time'))
+            except (ValueError, AttributeError) as e:
+                if logger:
+                    logger.error(f"bandwidth.schedule[{index}] 配置无效，已忽略: {e}")
+                continue
+            rule = self._parse_rule(entry, f'bandwidth.schedule[{index}]', logger)
+            rule['providers'] = {**default_rule['providers'], **rule['providers']}
+            schedule.append((time_range, rule))
+
+        with self.lock:
+            self.default_rule = default_rule
+            self.schedule = schedule
+            self.apply_to_aria2 = bool(config.get('aria2', True))
+            self.logger = logger
+            self.active = None
+        self.refresh(force=True)
+
+    def _parse_rule(self, config, prefix, logger):
+        rule = {'limit': None, 'providers': {}}
+        try:
+            rule['limit'] = parse_bandwidth(config.get('limit'))
+        except ValueError as e:
+            if logger:
+                logger.error(f"{prefix}.limit 配置无效，已忽略: {e}")
+        for provider, value in (config.get('providers') or {}).items():
+            try:
+                rule['providers'][provider] = parse_bandwidth(value)
+            except ValueError as e:
+                if logger:
+                    logger.error(f"{prefix}.providers.{provider} 配置无效，已忽略: {e}")
+        return rule
+
+    @property
+    def configured(self):
+        """是否设置了任何限速（从未设置时不修改 aria2 的限速）"""
+        rules = [self.default_rule] + [rule for _, rule in self.schedule]
+        return any(rule['limit'] or any(rule['providers'].values()) for rule in rules)
+
+    def _current_rule(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for time_range, rule in self.schedule:
+            if _in_range(minute, time_range):
+                return rule
+        return self.default_rule
+
+    def refresh(self, force=False):
+        """检查当前时段的限速，变化时更新令牌桶并通知回调；供下载循环和定时任务调用"""
+        with self.lock:
+            self.next_check = time.monotonic() + SCHEDULE_CHECK_INTERVAL
+            rule = self._current_rule()
+            if rule is self.active and not force:
+                return
+            self.active = rule
+            self.global_bucket = self._bucket(self.global_bucket, rule['limit'])
+            self.provider_buckets = {
+                provider: self._bucket(self.provider_buckets.get(provider), rate)
+                for provider, rate in rule['providers'].items()
+                if rate
+            }
+            enabled = self.apply_to_aria2 and self.configured
+            callbacks = list(self.callbacks) if enabled or self.notified else []
+            limit = rule['limit'] if enabled else None
+            self.notified = enabled
+            logger = self.logger
+        if logger and self.configured:
+            providers = '，'.join(f"{p}: {_format_rate(r)}" for p, r in rule['providers'].items() if r)
+            logger.info(f"下载限速: 全局 {_format_rate(rule['limit'])}" + (f"，{providers}" if providers else ''))
+        for callback in callbacks:
+            try:
+                callback(limit)
+            except Exception as e:
+                if logger:
+                    logger.warning(f"应用下载限速失败: {e}")
+
+    def _bucket(self, bucket, rate):
+        if not rate:
+            return None
+        if bucket is None:
+            return TokenBucket(rate, burst=rate * BURST_SECONDS)
+        bucket.configure(rate, burst=rate * BURST_SECONDS)
+        return bucket
+
+    def on_change(self, callback):
+        """注册限速变化的回调，参数为新的全局限速（字节/秒，None 表示不限速）"""
+        with self.lock:
+            if callback not in self.callbacks:
+                self.callbacks.append(callback)
+
+    def throttle(self, provider, nbytes):
+        """下载循环每读取 nbytes 字节调用一次，超出限速时阻塞"""
+        if time.monotonic() >= self.next_check:
+            self.refresh()
+        provider_bucket = self.provider_buckets.get(provider)
+        if provider_bucket:
+            provider_bucket.acquire(nbytes)
+        global_bucket = self.global_bucket
+        if global_bucket:
+            global_bucket.acquire(nbytes)
+
+    def iter_content(self, response, provider, chunk_size=64 * 1024):
+        """包装 response.iter_content，按限速产出数据块"""
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                self.throttle(provider, len(chunk))
+            yield chunk
+
+
+# 全局实例
+bandwidth_limiter = BandwidthLimiter()
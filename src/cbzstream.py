@@ -0,0 +1,129 @@
+import os
+import zlib
+import struct
+import zipfile
+
+from utils import mark_zip_verified
+
+# ZIP 本地文件头：签名、版本、标志、压缩方式、时间、日期、CRC、压缩后大小、原始大小、文件名长度、扩展字段长度
+_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+def iter_local_entries(path):
+    """
+    按本地文件头顺序读取 .part 中完整写入的 STORED 成员，产出 (ZipInfo, 数据)
+    用于进程被强制结束、没有写入中央目录的 .part；遇到不完整、CRC 不符或无法识别的成员时停止
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_LOCAL_HEADER.size)
+            if len(header) < _LOCAL_HEADER.size:
+                return
+            (signature, _, flags, method, mtime, mdate, crc,
+             compress_size, file_size, name_length, extra_length) = _LOCAL_HEADER.unpack(header)
+            # 流式写入只使用 STORED，且大小和 CRC 写在本地文件头中（无数据描述符、未加密）
+            if signature != _LOCAL_HEADER_SIGNATURE or method != zipfile.ZIP_STORED or flags & 0x09 or compress_size != file_size:
+                return
+            name = f.read(name_length)
+            extra = f.read(extra_length)
+            data = f.read(compress_size)
+            if len(name) < name_length or len(extra) < extra_length or len(data) < compress_size or zlib.crc32(data) != crc:
+                return
+            date_time = ((mdate >> 9) + 1980, (mdate >> 5) & 0xF, mdate & 0x1F,
+                         mtime >> 11, (mtime >> 5) & 0x3F, (mtime & 0x1F) * 2)
+            try:
+                info = zipfile.ZipInfo(name.decode('utf-8' if flags & 0x800 else 'cp437'), date_time)
+            except ValueError:
+                return
+            yield info, data
+
+class CbzStreamWriter:
+    """
+    流式 CBZ 写入器：下载完成的页面按页码顺序以 ZIP_STORED 直接追加到 CBZ，不经过临时目录
+    写入过程中使用 <path>.part，全部页面写入后重命名为 path。
+    下载中断时补写中央目录并保留 .part，重试时以追加模式打开并跳过已写入的页面；
+    进程被强制结束、.part 没有中央目录时，按本地文件头恢复其中完整的页面。
+    ComicInfo.xml 由 write_xml_to_zip 在后处理阶段直接追加到中央目录之前。
+    """
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.logger = logger
+        self.zf = None
+        self.names = set()
+        # 续写时之前写入的页面未在本进程中校验
+        self.resumed = False
+
+        if os.path.exists(self.part_path):
+            try:
+                # 先以只读方式确认中央目录完整：'a' 模式遇到没有中央目录的文件不会报错，
+                # 而是把它当作普通数据、在末尾另起一个空压缩包
+                with zipfile.ZipFile(self.part_path, 'r'):
+                    pass
+            except zipfile.BadZipFile:
+                self._rebuild_part()
+            except OSError as e:
+                if logger:
+                    logger.warning(f"无法读取未完成的 CBZ，重新创建: {e}")
+                os.remove(self.part_path)
+        if os.path.exists(self.part_path):
+            try:
+                self.zf = zipfile.ZipFile(self.part_path, 'a', zipfile.ZIP_STORED)
+                self.names = set(self.zf.namelist())
+                self.resumed = bool(self.names)
+                if logger:
+                    logger.info(f"继续写入未完成的 CBZ: {self.part_path}，已有 {len(self.names)} 页")
+            except (zipfile.BadZipFile, OSError) as e:
+                if logger:
+                    logger.warning(f"未完成的 CBZ 已损坏，重新创建: {e}")
+                self.zf = None
+        if self.zf is None:
+            os.makedirs(os.path.dirname(self.part_path) or '.', exist_ok=True)
+            self.zf = zipfile.ZipFile(self.part_path, 'w', zipfile.ZIP_STORED)
+
+    def _rebuild_part(self):
+        """.part 没有中央目录（进程被强制结束）时，按本地文件头恢复完整的页面，重新写入新的 .part"""
+        broken_path = f"{self.part_path}.broken"
+        os.replace(self.part_path, broken_path)
+        count = 0
+        try:
+            with zipfile.ZipFile(self.part_path, 'w', zipfile.ZIP_STORED) as zf:
+                for info, data in iter_local_entries(broken_path):
+                    zf.writestr(info, data)
+                    count += 1
+        except OSError as e:
+            count = 0
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+            if self.logger:
+                self.logger.warning(f"恢复未完成的 CBZ 失败，重新创建: {e}")
+        finally:
+            os.remove(broken_path)
+        if self.logger and count:
+            self.logger.info(f"未完成的 CBZ 缺少中央目录，已从本地文件头恢复 {count} 页")
+
+    def write(self, name, data):
+        """写入一页（只能在单个线程中按顺序调用）"""
+        self.zf.writestr(name, data)
+        self.names.add(name)
+
+    def close(self):
+        """写入中央目录并重命名为最终文件"""
+        self.zf.close()
+        os.replace(self.part_path, self.path)
+        if not self.resumed:
+            # 所有页面都在本次写入，CRC 由写入的数据计算得到，且页面已通过完整性检查
+            mark_zip_verified(self.path)
+        return self.path
+
+    def suspend(self):
+        """写入中央目录但保留 .part，供重试时继续追加"""
+        self.zf.close()
+
+    def abort(self):
+        """丢弃未完成的 CBZ"""
+        self.zf.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
@@ -1,49 +1,238 @@
 import zipfile, os
 import shutil
+import struct
 import tempfile
+import zlib
 from xml.dom.minidom import parseString
 import dicttoxml
-from utils import check_dirs
-from PIL import Image
+from utils import check_dirs, is_zip_verified, mark_zip_verified
 from natsort import natsorted
 import detectAd
-import re
 import py7zr
 
-# 广告文件名正则列表
-ad_file_pattern = re.compile(
-    r'('
-    r'^zzz.*\.(jpg|png|webp)$|'        # 以 zzz 开头的图片
-    r'^YZv5\.0\.png$|'                 # 固定文件名
-    r'.*_ZZZZ0.*\..*$|'                # _ZZZZ0
-    r'.*_ZZZZ1.*\..*$|'                # _ZZZZ1
-    r'.*_zzz.*\..*$|'                  # 任意 _zzz
-    r'脸肿汉化组招募|'                 # 脸肿汉化组招募
-    r'無邪気漢化組招募圖_ver.*\.png$|' # 無邪気汉化组招募图
-    r'無邪気無修宇宙分組_ver.*\.png$'  # 無邪気无修宇宙分组
-    r')',
-    re.IGNORECASE
-)
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.jxl')
+
+# 图片本身已经压缩，默认以 ZIP_STORED 存储，避免再经过一遍 zlib
+CBZ_COMPRESSION = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+}
+
+# 7z 成员解压到内存缓冲区：单个成员超过阈值或内存总量超过预算时转存到临时文件
+SPOOL_MEMBER_THRESHOLD = 16 * 1024 * 1024
+SPOOL_MEMORY_BUDGET = 256 * 1024 * 1024
+
+def get_cbz_compression(app=None):
+    """根据 advanced.cbz_compression 配置返回写入图片时使用的压缩方式"""
+    name = str(app.config.get('CBZ_COMPRESSION', 'stored') if app else 'stored').lower()
+    return CBZ_COMPRESSION.get(name, zipfile.ZIP_STORED)
+
+# 原样复制压缩数据依赖的 zipfile 内部实现（CPython 3.8 - 3.13 均提供）：
+# 模块级的本地文件头结构及字段下标，以及 ZipFile 实例的 _lock / _writecheck / _didModify / start_dir / fp
+_RAW_COPY_MODULE_ATTRS = ('structFileHeader', 'sizeFileHeader', 'stringFileHeader',
+                          '_FH_SIGNATURE', '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH')
+_RAW_COPY_ZIPFILE_ATTRS = ('_lock', '_writecheck', '_didModify', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+
+def _can_copy_raw(src_zip, tgt_zip):
+    """当前 Python 的 zipfile 是否提供原样复制所需的内部实现，缺少时 copy_zip_member 回退为解压后重新写入"""
+    return (all(hasattr(zipfile, name) for name in _RAW_COPY_MODULE_ATTRS)
+            and all(hasattr(tgt_zip, name) for name in _RAW_COPY_ZIPFILE_ATTRS)
+            and getattr(src_zip, 'fp', None) is not None
+            and not getattr(tgt_zip, '_writing', False))
+
+def _copy_zip_member_decoded(src_zip, src_info, tgt_zip, arcname):
+    """通过公开接口复制成员：解压后重新写入，读取时由 ZipExtFile 校验 CRC"""
+    zinfo = zipfile.ZipInfo(arcname, src_info.date_time)
+    zinfo.external_attr = src_info.external_attr
+    zinfo.compress_type = src_info.compress_type if src_info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) else tgt_zip.compression
+    with src_zip.open(src_info) as source, tgt_zip.open(zinfo, 'w') as target:
+        shutil.copyfileobj(source, target)
+    return True
+
+def copy_zip_member(src_zip, src_info, tgt_zip, arcname=None):
+    """
+    将 src_zip 中的成员原样复制到 tgt_zip：直接拷贝压缩后的字节，不重新压缩
+    复制的同时校验 CRC（STORED 直接计算，DEFLATED 边复制边解压），CRC 不符时抛出 BadZipFile
+    加密的成员无法原样复制，zipfile 缺少所需的内部实现时（见 _can_copy_raw）也无法原样复制，
+    这两种情况回退为解压后重新写入
+    返回成员数据是否已校验
+    """
+    arcname = arcname or src_info.filename
+    if src_info.flag_bits & 0x1 or not _can_copy_raw(src_zip, tgt_zip):
+        return _copy_zip_member_decoded(src_zip, src_info, tgt_zip, arcname)
+
+    zinfo = zipfile.ZipInfo(arcname, src_info.date_time)
+    zinfo.compress_type = src_info.compress_type
+    zinfo.CRC = src_info.CRC
+    zinfo.file_size = src_info.file_size
+    zinfo.compress_size = src_info.compress_size
+    zinfo.external_attr = src_info.external_attr
+    zinfo.create_system = src_info.create_system
+    zinfo.extract_version = max(zinfo.extract_version, src_info.extract_version)
+    # 大小和 CRC 已知，写入本地文件头即可，不需要数据描述符
+    zinfo.flag_bits = src_info.flag_bits & ~0x08
+
+    # 跳过源文件的本地文件头，定位到压缩数据
+    src_fp = src_zip.fp
+    src_fp.seek(src_info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, src_fp.read(zipfile.sizeFileHeader))
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad magic number for file header: {src_info.filename}")
+    src_fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    with tgt_zip._lock:
+        tgt_zip._writecheck(zinfo)
+        tgt_zip._didModify = True
+        tgt_fp = tgt_zip.fp
+        tgt_fp.seek(tgt_zip.start_dir)
+        zinfo.header_offset = tgt_fp.tell()
+        tgt_fp.write(zinfo.FileHeader(zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT))
+        remaining = zinfo.compress_size
+        crc = 0
+        inflater = zlib.decompressobj(-15) if zinfo.compress_type == zipfile.ZIP_DEFLATED else None
+        while remaining > 0:
+            chunk = src_fp.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated member: {src_info.filename}")
+            tgt_fp.write(chunk)
+            remaining -= len(chunk)
+            if inflater:
+                crc = zlib.crc32(inflater.decompress(chunk), crc)
+            elif zinfo.compress_type == zipfile.ZIP_STORED:
+                crc = zlib.crc32(chunk, crc)
+        verified = zinfo.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+        if inflater:
+            crc = zlib.crc32(inflater.flush(), crc)
+        if verified and crc != zinfo.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {src_info.filename}")
+        tgt_zip.filelist.append(zinfo)
+        tgt_zip.NameToInfo[zinfo.filename] = zinfo
+        tgt_zip.start_dir = tgt_fp.tell()
+    return verified
+
+def can_inject_comicinfo(src_zip):
+    """
+    判断 ZIP 能否原地写入 ComicInfo.xml：
+    除目录和 ComicInfo.xml 外只包含图片，且已有的 ComicInfo.xml 位于所有成员数据的最后
+    """
+    infos = [info for info in src_zip.infolist() if not info.is_dir()]
+    comicinfo = [info for info in infos if info.filename.lower() == 'comicinfo.xml']
+    if any(not info.filename.lower().endswith(IMAGE_EXTS) for info in infos if info not in comicinfo):
+        return False
+    if not comicinfo:
+        return True
+    # 替换已有的 ComicInfo.xml 需要截断文件并修改 ZipFile 的 start_dir / _didModify
+    if not all(hasattr(src_zip, name) for name in ('start_dir', '_didModify', 'filelist', 'NameToInfo')):
+        return False
+    last_offset = max(info.header_offset for info in infos)
+    return len(comicinfo) == 1 and comicinfo[0].header_offset == last_offset
+
+def inject_comicinfo(file_path, xml_content, copy=False, logger=None):
+    """
+    原地追加或替换 ZIP 中的 ComicInfo.xml 并重命名为 .cbz，页面数据不动
+    旧的 ComicInfo.xml 位于数据末尾时直接截断覆盖，耗时只取决于元数据和中央目录的大小
+    """
+    zip_file_root = os.path.dirname(file_path)
+    zip_file_name = os.path.basename(file_path)
+    # 页面数据不变，原文件已校验过时写入后仍视为已校验
+    verified = is_zip_verified(file_path)
+
+    if copy:
+        # 原地修改前先保留一份原始文件
+        try:
+            completed_path = os.path.join(zip_file_root, 'Completed')
+            shutil.copy2(file_path, os.path.join(check_dirs(completed_path), zip_file_name))
+        except Exception as e:
+            if logger:
+                logger.error(e)
+
+    with zipfile.ZipFile(file_path, 'a') as zf:
+        for info in list(zf.filelist):
+            if not info.is_dir() and info.filename.lower() == 'comicinfo.xml':
+                # 旧的 ComicInfo.xml 是最后一个成员，从它的本地文件头处截断
+                zf.filelist.remove(info)
+                del zf.NameToInfo[info.filename]
+                zf.start_dir = info.header_offset
+                zf.fp.seek(info.header_offset)
+                zf.fp.truncate()
+                zf._didModify = True
+        zf.writestr("ComicInfo.xml", xml_content, compress_type=zipfile.ZIP_DEFLATED)
+
+    new_file_path = os.path.splitext(file_path)[0] + ".cbz"
+    if new_file_path != file_path:
+        shutil.move(file_path, new_file_path)
+    if verified:
+        mark_zip_verified(new_file_path)
+    if logger:
+        logger.info(f"已原地写入 ComicInfo.xml: {new_file_path}")
+    return new_file_path
+
+class SpoolIO(py7zr.io.Py7zIO):
+    """py7zr 解压输出：先写入内存，超过 max_size 后自动转存到 spool_dir 下的临时文件"""
+
+    def __init__(self, max_size, spool_dir=None):
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=max_size, dir=spool_dir)
+
+    def write(self, s):
+        return self.buffer.write(s)
+
+    def read(self, size=None):
+        return self.buffer.read(-1 if size is None else size)
+
+    def seek(self, offset, whence=0):
+        return self.buffer.seek(offset, whence)
+
+    def flush(self):
+        self.buffer.flush()
+
+    def size(self):
+        position = self.buffer.tell()
+        self.buffer.seek(0, os.SEEK_END)
+        size = self.buffer.tell()
+        self.buffer.seek(position)
+        return size
+
+    def close(self):
+        self.buffer.close()
+
+class SpoolFactory(py7zr.io.WriterFactory):
+    """为每个 7z 成员创建 SpoolIO，内存中的总数据量超过预算后新成员直接写入临时文件"""
+
+    def __init__(self, spool_dir=None, member_threshold=SPOOL_MEMBER_THRESHOLD, memory_budget=SPOOL_MEMORY_BUDGET):
+        self.spool_dir = spool_dir
+        self.member_threshold = member_threshold
+        self.memory_budget = memory_budget
+        self.products = {}
+
+    def _in_memory(self):
+        return sum(p.size() for p in self.products.values() if not p.buffer._rolled)
+
+    def create(self, filename):
+        product = SpoolIO(self.member_threshold, self.spool_dir)
+        if self._in_memory() >= self.memory_budget:
+            product.buffer.rollover()
+        self.products[filename] = product
+        return product
+
+    def close(self):
+        for product in self.products.values():
+            product.close()
+        self.products.clear()
+
+def read_7z_images(file_path, spool_dir=None):
+    """将 7z 中的图片解压到 SpoolFactory 缓冲区，返回 factory，factory.products 为 {成员名: SpoolIO}"""
+    factory = SpoolFactory(spool_dir)
+    with py7zr.SevenZipFile(file_path, 'r') as archive:
+        img_names = [name for name in archive.getnames() if name.lower().endswith(IMAGE_EXTS)]
+        if img_names:
+            archive.extract(targets=img_names, factory=factory)
+    return factory
 
 def make_comicinfo_xml(metadata):
     return parseString(
         dicttoxml.dicttoxml(metadata, custom_root='ComicInfo', attr_type=False)
     ).toprettyxml(indent="  ", encoding="UTF-8")
 
-def extract_images_only(file_path, temp_dir):
-    file_exts = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.avif', '.jxl', '.xml', '.json')
-
-    if file_path.lower().endswith('.7z'):
-        with py7zr.SevenZipFile(file_path, 'r') as archive:
-            img_names = [name for name in archive.getnames() if name.lower().endswith(file_exts)]
-            if img_names:
-                archive.extract(path=temp_dir, targets=img_names)
-    else:
-        with zipfile.ZipFile(file_path, 'r') as archive:
-            for name in archive.namelist():
-                if name.lower().endswith(file_exts):
-                    archive.extract(name, temp_dir)
-
 def write_xml_to_zip(file_path, metadata, app=None, logger=None):
     zip_file_root = os.path.dirname(file_path)
     zip_file_name = os.path.basename(file_path)
@@ -57,106 +246,61 @@ def write_xml_to_zip(file_path, metadata, app=None, logger=None):
     xml_content = make_comicinfo_xml(metadata)
 
     # 检查输入是文件夹、ZIP文件还是7z文件
+    src_zip = None
+    src_infos = {}
+    src_7z = None
     if os.path.isdir(file_path):
         # 处理文件夹输入
         # 获取所有图片并自然排序
+        base_dir = file_path
         img_files = []
         for root, dirs, files in os.walk(file_path):
             for file in files:
-                if file.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.jxl')):
+                if file.lower().endswith(IMAGE_EXTS):
                     full_path = os.path.join(root, file)
                     rel_path = os.path.relpath(full_path, file_path)
                     img_files.append(rel_path)
         img_files = natsorted(img_files, key=lambda name: os.path.basename(name))
+    elif not file_path.lower().endswith('.7z'):
+        # 处理ZIP文件输入，直接读取成员，无需解压
+        src_zip = zipfile.ZipFile(file_path, 'r')
+        for info in src_zip.infolist():
+            if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTS):
+                src_infos[info.filename] = info
+        img_files = natsorted(src_infos, key=lambda name: os.path.basename(name))
     else:
-        # 处理ZIP或7z文件输入，先解压到临时目录
-        temp_dir = tempfile.mkdtemp(dir=zip_file_root)
-        try:
-            extract_images_only(file_path, temp_dir)
-            # 获取所有图片并自然排序
-            img_files = []
-            for root, dirs, files in os.walk(temp_dir):
-                for file in files:
-                    if file.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.jxl')):
-                        full_path = os.path.join(root, file)
-                        rel_path = os.path.relpath(full_path, temp_dir)
-                        img_files.append(rel_path)
-            img_files = natsorted(img_files, key=lambda name: os.path.basename(name))
-        except Exception as e:
-            shutil.rmtree(temp_dir)
-            raise e
+        # 处理7z文件输入，图片解压到内存缓冲区，较大的成员转存到下载目录下的临时文件
+        src_7z = read_7z_images(file_path, spool_dir=zip_file_root)
+        img_files = natsorted(src_7z.products, key=lambda name: os.path.basename(name))
     if not img_files:
         msg = f"文件夹 {file_path} 内没有找到有效图片"
         if logger:
             logger.warning(msg)
         else:
             print(msg)
-        if 'temp_dir' in locals() and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        if src_zip:
+            src_zip.close()
+        if src_7z:
+            src_7z.close()
         return None
 
+    def read_page(name):
+        if src_zip:
+            return src_zip.read(src_infos[name])
+        if src_7z:
+            member = src_7z.products[name]
+            member.seek(0)
+            return member.read()
+        with open(os.path.join(base_dir, name), 'rb') as f:
+            return f.read()
+
     # 广告页检测
     ad_pages = set()
     if remove_ad_flag:
         if logger:
             logger.info("正在检测广告页...")
-        start_idx = max(0, len(img_files) - 10)
-        normal_num = 0
-        for i in range(len(img_files) - 1, start_idx - 1, -1):
-            if i in ad_pages:
-                continue
-            name = img_files[i]
-            basename = os.path.basename(name)
-            # 文件名匹配
-            if ad_file_pattern.search(basename):
-                ad_pages.add(i)
-                (logger.debug if logger else print)(f"[DEBUG] 文件名匹配广告: {i} => {basename}")
-                continue
-            # 图像检测
-            try:
-                if os.path.isdir(file_path):
-                    # 从文件夹读取图片
-                    img_path = os.path.join(file_path, name)
-                    with Image.open(img_path) as img:
-                        img.load()
-                        is_ad = detectAd.is_ad_img(img, logger)
-                        if is_ad:
-                            ad_pages.add(i)
-                            (logger.debug if logger else print)(f"[DEBUG] 二维码检测广告: {i} => {name}")
-                        elif normal_num > 2:
-                            break
-                        else:
-                            normal_num += 1
-                else:
-                    # 从临时目录读取图片
-                    img_path = os.path.join(temp_dir, name)
-                    with Image.open(img_path) as img:
-                        img.load()
-                        is_ad = detectAd.is_ad_img(img, logger)
-                        if is_ad:
-                            ad_pages.add(i)
-                            (logger.debug if logger else print)(f"[DEBUG] 二维码检测广告: {i} => {name}")
-                        elif normal_num > 2:
-                            break
-                        else:
-                            normal_num += 1
-            except Exception as e:
-                (logger.debug if logger else print)(f"[DEBUG] 打开图片 {name} 异常: {e}")
-                continue
-
-        # 邻页补充
+        ad_pages = detectAd.detect_ad_pages(img_files, read_page, logger)
         if ad_pages:
-            start_idx = min(ad_pages)
-            ad_num = 0
-            for i in range(start_idx, len(img_files)):
-                if i in ad_pages:
-                    ad_num += 1
-                    continue
-                if ad_num >= 2 or ((i - 1 in ad_pages) and (i + 1 in ad_pages)):
-                    ad_pages.add(i)
-                    (logger.debug if logger else print)(f"[DEBUG] 根据邻页规则补充广告: {i} => {img_files[i]}")
-                else:
-                    ad_num = 0
             if logger:
                 logger.info(f"[INFO] 最终广告页索引: {sorted(ad_pages)}")
                 logger.info(f"[INFO] 最终广告页文件: {', '.join([img_files[i] for i in sorted(ad_pages)])}")
@@ -164,33 +308,48 @@ def write_xml_to_zip(file_path, metadata, app=None, logger=None):
                 print(f"[INFO] 最终广告页索引: {sorted(ad_pages)}")
                 print(f"[INFO] 最终广告页文件: {', '.join([img_files[i] for i in sorted(ad_pages)])}")
 
+    # 没有需要删除的页面时，ZIP 只需写入 ComicInfo.xml，无需重建整个压缩包
+    if src_zip and not ad_pages and can_inject_comicinfo(src_zip):
+        src_zip.close()
+        return inject_comicinfo(file_path, xml_content, copy=copy, logger=logger)
+
     # 安全临时文件（唯一文件名，避免冲突）
     with tempfile.NamedTemporaryFile(dir=zip_file_root, suffix=".cbz", delete=False) as tmp:
         target_zip_path = tmp.name
 
-    # 创建目标ZIP文件并写入内容
-    with zipfile.ZipFile(target_zip_path, 'w', zipfile.ZIP_DEFLATED) as tgt_zip:
-        # 写入非广告页（流式复制，节省内存）
-        for idx, name in enumerate(img_files):
-            if idx in ad_pages:
-                continue
-            if os.path.isdir(file_path):
-                # 从文件夹复制文件
-                src_path = os.path.join(file_path, name)
-                with open(src_path, 'rb') as source, tgt_zip.open(name, 'w') as target:
-                    shutil.copyfileobj(source, target)
-            else:
-                # 从临时目录复制文件
-                src_path = os.path.join(temp_dir, name)
-                with open(src_path, 'rb') as source, tgt_zip.open(name, 'w') as target:
-                    shutil.copyfileobj(source, target)
-
-        # 写入 ComicInfo.xml
-        tgt_zip.writestr("ComicInfo.xml", xml_content)
+    # 创建目标ZIP文件并写入内容，图片数据在写入时都经过 CRC 计算或校验
+    verified = True
+    try:
+        with zipfile.ZipFile(target_zip_path, 'w', get_cbz_compression(app)) as tgt_zip:
+            # 写入非广告页（流式复制，节省内存）
+            for idx, name in enumerate(img_files):
+                if idx in ad_pages:
+                    continue
+                if src_zip:
+                    # ZIP 输入：原样复制压缩数据，不解压不重新压缩
+                    verified = copy_zip_member(src_zip, src_infos[name], tgt_zip) and verified
+                elif src_7z:
+                    # 7z 输入：从解压缓冲区写入
+                    member = src_7z.products[name]
+                    member.seek(0)
+                    with tgt_zip.open(name, 'w') as target:
+                        shutil.copyfileobj(member.buffer, target)
+                else:
+                    # 从文件夹复制文件
+                    src_path = os.path.join(base_dir, name)
+                    with open(src_path, 'rb') as source, tgt_zip.open(name, 'w') as target:
+                        shutil.copyfileobj(source, target)
 
-    # 清理临时目录（如果存在）
-    if 'temp_dir' in locals() and os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
+            # 写入 ComicInfo.xml（文本压缩效果好，始终使用 DEFLATED）
+            tgt_zip.writestr("ComicInfo.xml", xml_content, compress_type=zipfile.ZIP_DEFLATED)
+    except Exception:
+        os.remove(target_zip_path)
+        raise
+    finally:
+        if src_zip:
+            src_zip.close()
+        if src_7z:
+            src_7z.close()
 
     # 文件替换逻辑
     if copy:
@@ -221,5 +380,7 @@ def write_xml_to_zip(file_path, metadata, app=None, logger=None):
 
     new_file_path = os.path.splitext(file_path)[0] + ".cbz"
     shutil.move(target_zip_path, new_file_path)
+    if verified:
+        mark_zip_verified(new_file_path)
 
     return new_file_path
@@ -25,7 +25,10 @@ def get_default_config():
             'remove_ads': 'false',
             'aggressive_series_detection': 'false', # 启用后，E-Hentai 会对 AltnateSeries 字段进行更激进的检测。
             'openai_series_detection': 'false', # 启用后，使用配置号的 OpenAI 接口对标题进行系列名和序号的检测。
-            'prefer_openai_series': 'false' # 启用后，优先使用 OpenAI 进行系列识别，正则作为后备方案。
+            'prefer_openai_series': 'false', # 启用后，优先使用 OpenAI 进行系列识别，正则作为后备方案。
+            'page_download_concurrency': 4, # nhentai/Hitomi 逐页下载时每个画廊的并发数
+            'stream_cbz': 'true', # 启用后，nhentai/Hitomi 的页面下载完成后直接按顺序写入 CBZ，不再经过临时目录
+            'cbz_compression': 'stored' # 生成 CBZ 时图片的压缩方式：stored（不压缩）或 deflated
         },
         'ehentai': {
             'ipb_member_id': '',
@@ -63,6 +66,39 @@ def get_default_config():
             'index_sync': 'false',
             'index_sync_interval': '6h'
         },
+        'rate_limit': {
+            'default_concurrency': 8, # 未单独配置的主机的并发上限，遇到 429/503 时自动减半并缓慢恢复
+            'hosts': {
+                'nhentai.net': '30/m',
+                '*.nhentai.net': '5/s',
+                '*.gold-usergeneratedcontent.net': '10/s',
+                'api.hdoujin.org': '2/s',
+                'api.e-hentai.org': '1/s'
+            }
+        },
+        'download_queue': {
+            'max_workers': 5, # 同时运行的下载任务总数，排队顺序为 手动 > RSS > 收藏夹
+            'providers': {
+                'archive': 2,
+                'torrent': 5,
+                'nhentai': 2,
+                'hitomi': 2,
+                'hdoujin': 1
+            }
+        },
+        'metadata_cache': {
+            'enable': 'true', # 缓存画廊元数据（data/metadata.db），重试和回退时不再重复请求
+            'ttl': {
+                'info': '30d', # 标题、分类、页数等很少变化的字段的有效期
+                'tags': '1d' # 标签、评分、种子等经常变化的字段的有效期
+            }
+        },
+        'bandwidth': {
+            'limit': 0, # 进程内下载（归档、HDoujin、nhentai、Hitomi）的全局限速，如 2M 表示 2 MB/s，0 表示不限速
+            'providers': {}, # 各下载方式的限速，如 {'nhentai': '1M'}
+            'schedule': [], # 按时段限速，如 [{'time': '08:00-23:00', 'limit': '2M'}]，不在任何时段内时使用 limit
+            'aria2': 'true' # 按同一计划通过 aria2.changeGlobalOption 设置 aria2 的全局下载限速
+        },
         'notification': {},
         'openai': {
             'api_key': '',
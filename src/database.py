@@ -1,5 +1,6 @@
 import sqlite3
 import threading
+import json
 import os
 from datetime import datetime, timezone
 from typing import List, Dict, Optional, Tuple
@@ -14,6 +15,11 @@ class TaskDatabase:
         "failed": TaskStatus.ERROR,
     }
 
+    # 下载队列中任务的状态：pending 排队等待，running 正在执行，leased 已交给外部下载器（aria2）等待完成
+    QUEUE_PENDING = 'pending'
+    QUEUE_RUNNING = 'running'
+    QUEUE_LEASED = 'leased'
+
     def __init__(self, db_path: str = './data/tasks.db'):
         self.db_path = db_path
         self.lock = threading.Lock()
@@ -153,6 +159,40 @@ class TaskDatabase:
 
             conn.commit()
 
+            # 创建持久化下载队列表，任务结束后删除对应记录，重启时据此恢复排队和中断的任务
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS download_queue (
+                    task_id TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    mode TEXT,
+                    favcat TEXT,
+                    provider TEXT,
+                    priority TEXT,
+                    state TEXT NOT NULL,
+                    attempts INTEGER DEFAULT 0,
+                    checkpoint TEXT,
+                    enqueued_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    dedup_key TEXT
+                )
+            ''')
+
+            cursor = conn.execute("PRAGMA table_info(download_queue)")
+            if 'dedup_key' not in [row[1] for row in cursor.fetchall()]:
+                conn.execute('ALTER TABLE download_queue ADD COLUMN dedup_key TEXT')
+                # 为旧队列记录填充去重键，同一画廊的重复记录只保留最早的一条持有该键
+                seen = set()
+                for task_id, url in conn.execute('SELECT task_id, url FROM download_queue ORDER BY enqueued_at').fetchall():
+                    key = self.download_key(url)
+                    if key and key not in seen:
+                        seen.add(key)
+                        conn.execute('UPDATE download_queue SET dedup_key = ? WHERE task_id = ?', (key, task_id))
+
+            # 同一画廊同时只能有一个排队中或执行中的下载
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_download_queue_dedup_key ON download_queue(dedup_key)')
+
+            conn.commit()
+
     def add_task(self, task_id: str, status: str = TaskStatus.IN_PROGRESS,
                  filename: Optional[str] = None, error: Optional[str] = None,
                  url: Optional[str] = None, mode: Optional[str] = None, favcat: Optional[str] = None) -> bool:
@@ -385,6 +425,130 @@ class TaskDatabase:
                 print(f"Database error migrating tasks: {e}")
                 return False
 
+    def enqueue_download(self, task_id: str, url: str, mode: Optional[str] = None, favcat: Optional[str] = None,
+                         provider: Optional[str] = None, priority: Optional[str] = None) -> Optional[str]:
+        """
+        将下载任务写入持久化队列，已存在时（重启后恢复）保留尝试次数和断点信息
+
+        同一画廊（按 download_key 判断）已在队列中时不会重复入队。
+
+        Returns:
+            持有该下载的任务 ID：入队成功时为 task_id，同一画廊已排队或执行中时为已有任务的 ID，
+            数据库错误时为 None
+        """
+        dedup_key = self.download_key(url)
+        with self.lock:
+            try:
+                with self._get_conn() as conn:
+                    now = datetime.now(timezone.utc).isoformat()
+                    try:
+                        conn.execute('''
+                            INSERT INTO download_queue
+                            (task_id, url, mode, favcat, provider, priority, state, attempts, enqueued_at, updated_at, dedup_key)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)
+                            ON CONFLICT(task_id) DO UPDATE SET
+                                provider = excluded.provider,
+                                priority = excluded.priority,
+                                state = excluded.state,
+                                updated_at = excluded.updated_at
+                        ''', (task_id, url, mode, favcat, provider, priority, self.QUEUE_PENDING, now, now, dedup_key))
+                    except sqlite3.IntegrityError:
+                        # dedup_key 唯一约束冲突：同一画廊已有排队中或执行中的任务
+                        row = conn.execute('SELECT task_id FROM download_queue WHERE dedup_key = ?', (dedup_key,)).fetchone()
+                        return row[0] if row else None
+                    conn.commit()
+                return task_id
+            except sqlite3.Error as e:
+                print(f"Database error enqueuing download: {e}")
+                return None
+
+    def update_download_state(self, task_id: str, state: str, new_attempt: bool = False) -> bool:
+        """更新队列中任务的状态，new_attempt 为 True 时尝试次数加一"""
+        with self.lock:
+            try:
+                with self._get_conn() as conn:
+                    attempts = 1 if new_attempt else 0
+                    conn.execute('UPDATE download_queue SET state = ?, attempts = attempts + ?, updated_at = ? WHERE task_id = ?',
+                                 (state, attempts, datetime.now(timezone.utc).isoformat(), task_id))
+                    conn.commit()
+                return True
+            except sqlite3.Error as e:
+                print(f"Database error updating download state: {e}")
+                return False
+
+    def set_download_checkpoint(self, task_id: str, checkpoint: Dict) -> bool:
+        """保存 provider 的断点信息（如 aria2 的 gid），重启后据此续传"""
+        with self.lock:
+            try:
+                with self._get_conn() as conn:
+                    conn.execute('UPDATE download_queue SET checkpoint = ?, updated_at = ? WHERE task_id = ?',
+                                 (json.dumps(checkpoint), datetime.now(timezone.utc).isoformat(), task_id))
+                    conn.commit()
+                return True
+            except sqlite3.Error as e:
+                print(f"Database error setting download checkpoint: {e}")
+                return False
+
+    def get_download_checkpoint(self, task_id: str) -> Dict:
+        """获取任务的断点信息，没有时返回空字典"""
+        with self.lock:
+            try:
+                with self._get_conn() as conn:
+                    cursor = conn.execute('SELECT checkpoint FROM download_queue WHERE task_id = ?', (task_id,))
+                    row = cursor.fetchone()
+                    return json.loads(row[0]) if row and row[0] else {}
+            except (sqlite3.Error, ValueError) as e:
+                print(f"Database error getting download checkpoint: {e}")
+                return {}
+
+    def remove_download(self, task_id: str) -> bool:
+        """任务结束（完成、失败或取消）后从持久化队列中删除"""
+        with self.lock:
+            try:
+                with self._get_conn() as conn:
+                    conn.execute('DELETE FROM download_queue WHERE task_id = ?', (task_id,))
+                    conn.commit()
+                return True
+            except sqlite3.Error as e:
+                print(f"Database error removing download: {e}")
+                return False
+
+    def get_interrupted_downloads(self) -> List[Dict]:
+        """
+        获取重启前未结束的任务（tasks 表中仍为进行中），按入队顺序排列
+        没有队列记录的旧任务使用 tasks 表中的 url、mode、favcat，state 为 None
+        """
+        with self.lock:
+            try:
+                with self._get_conn() as conn:
+                    conn.row_factory = sqlite3.Row
+                    cursor = conn.execute('''
+                        SELECT t.id AS task_id, COALESCE(q.url, t.url) AS url, COALESCE(q.mode, t.mode) AS mode,
+                               COALESCE(q.favcat, t.favcat) AS favcat, q.provider, q.priority, q.state,
+                               COALESCE(q.attempts, 0) AS attempts, q.checkpoint
+                        FROM tasks t LEFT JOIN download_queue q ON q.task_id = t.id
+                        WHERE t.status = ?
+                        ORDER BY COALESCE(q.enqueued_at, t.created_at)
+                    ''', (TaskStatus.IN_PROGRESS,))
+                    return [dict(row) for row in cursor.fetchall()]
+            except sqlite3.Error as e:
+                print(f"Database error getting interrupted downloads: {e}")
+                return []
+
+    def clear_stale_downloads(self) -> bool:
+        """删除已不在进行中的任务遗留的队列记录（例如排队时被取消或删除的任务）"""
+        with self.lock:
+            try:
+                with self._get_conn() as conn:
+                    conn.execute('''
+                        DELETE FROM download_queue
+                        WHERE task_id NOT IN (SELECT id FROM tasks WHERE status = ?)
+                    ''', (TaskStatus.IN_PROGRESS,))
+                    conn.commit()
+                return True
+            except sqlite3.Error as e:
+                print(f"Database error clearing stale downloads: {e}")
+                return False
 
     def set_global_state(self, key: str, value: str) -> bool:
         """设置全局状态值"""
@@ -810,6 +974,22 @@ class TaskDatabase:
         
         return normalized, site_type
 
+    def download_key(self, url: Optional[str]) -> Optional[str]:
+        """
+        生成下载去重键：E-Hentai/ExHentai 画廊按 gid 去重（忽略站点和 token 的差异），其他站点使用规范化 URL
+        """
+        if not url:
+            return None
+        try:
+            normalized_url, site_type = self.normalize_url(url)
+        except Exception:
+            return None
+        if site_type == 'e-hentai':
+            gid, _ = parse_gallery_url(normalized_url)
+            if gid:
+                return f"e-hentai:{gid}"
+        return normalized_url
+
     def upsert_komga_url_index(self, urls: List[Dict]) -> bool:
         """
         批量插入或更新 Komga URL 索引
@@ -947,5 +1127,86 @@ class TaskDatabase:
                 print(f"Database error querying book IDs by URLs: {e}")
                 return {self.normalize_url(url)[0]: None for url in urls}
 
+class AdHashDatabase:
+    """已确认广告页的感知哈希索引（pHash + dHash，均为 64 位，以 16 位十六进制存储）"""
+
+    def __init__(self, db_path: str = './data/ad_hashes.db'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self._hashes_cache = None  # 缓存所有已知哈希 [(phash, dhash), ...]
+
+        # 确保数据库文件的父目录存在
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            check_dirs(db_dir)
+
+        self._init_database()
+
+    def _get_conn(self):
+        """获取数据库连接"""
+        return sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+
+    def _init_database(self):
+        """初始化数据库表"""
+        with self._get_conn() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS ad_hashes (
+                    phash TEXT NOT NULL,
+                    dhash TEXT NOT NULL,
+                    source TEXT,
+                    hits INTEGER DEFAULT 0,
+                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    last_seen TEXT DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (phash, dhash)
+                )
+            ''')
+            conn.commit()
+
+    def get_hashes(self) -> List[Tuple[int, int]]:
+        """获取所有已知广告页哈希"""
+        with self.lock:
+            if self._hashes_cache is None:
+                try:
+                    with self._get_conn() as conn:
+                        cursor = conn.execute('SELECT phash, dhash FROM ad_hashes')
+                        self._hashes_cache = [(int(p, 16), int(d, 16)) for p, d in cursor.fetchall()]
+                except sqlite3.Error as e:
+                    print(f"Database error getting ad hashes: {e}")
+                    return []
+            return list(self._hashes_cache)
+
+    def add_hash(self, phash: int, dhash: int, source: Optional[str] = None) -> bool:
+        """记录新确认的广告页哈希，已存在时只更新命中信息"""
+        with self.lock:
+            try:
+                now = datetime.now(timezone.utc).isoformat()
+                with self._get_conn() as conn:
+                    conn.execute('''
+                        INSERT INTO ad_hashes (phash, dhash, source, hits, created_at, last_seen)
+                        VALUES (?, ?, ?, 0, ?, ?)
+                        ON CONFLICT(phash, dhash) DO UPDATE SET last_seen = excluded.last_seen
+                    ''', (f'{phash:016x}', f'{dhash:016x}', source, now, now))
+                    conn.commit()
+                if self._hashes_cache is not None and (phash, dhash) not in self._hashes_cache:
+                    self._hashes_cache.append((phash, dhash))
+                return True
+            except sqlite3.Error as e:
+                print(f"Database error adding ad hash: {e}")
+                return False
+
+    def record_hit(self, phash: int, dhash: int) -> bool:
+        """已知广告哈希被命中时更新命中次数"""
+        with self.lock:
+            try:
+                with self._get_conn() as conn:
+                    conn.execute('UPDATE ad_hashes SET hits = hits + 1, last_seen = ? WHERE phash = ? AND dhash = ?',
+                                 (datetime.now(timezone.utc).isoformat(), f'{phash:016x}', f'{dhash:016x}'))
+                    conn.commit()
+                return True
+            except sqlite3.Error as e:
+                print(f"Database error recording ad hash hit: {e}")
+                return False
+
 # 全局数据库实例
 task_db = TaskDatabase()
+ad_hash_db = AdHashDatabase()
@@ -1,96 +1,179 @@
-from typing import List, Optional, Set, TypeVar, Callable
-from PIL import Image, ImageOps
-import numpy as np
-import re, os
-from pyzbar.pyzbar import decode, ZBarSymbol
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypeVar
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from PIL import Image
+import re, os, threading, multiprocessing
+# 进程池任务放在独立的无副作用模块中，spawn 子进程只需导入该模块
+from ad_scan import qr_code_white_list, scan_ad_img, scan_ad_page, is_informative_hash
 
 T = TypeVar("T")
 
-# 二维码白名单
-qr_code_white_list = [
-    r"^https://[^.]+\.fanbox\.cc",
-    r"^https://twitter\.com",
-    r"^https://x\.com",
-    r"^https://www\.pixiv\.net",
-    r"^https://www\.dmm\.co\.jp",
-    r"^https://fantia\.jp",
-    r"^https://marshmallow-qa\.com",
-    r"^https://www\.dlsite\.com",
-    r"^https://hitomi\.la",
-]
+# 广告文件名正则列表
+ad_file_pattern = re.compile(
+    r'('
+    r'^zzz.*\.(jpg|png|webp)$|'        # 以 zzz 开头的图片
+    r'^YZv5\.0\.png$|'                 # 固定文件名
+    r'.*_ZZZZ0.*\..*$|'                # _ZZZZ0
+    r'.*_ZZZZ1.*\..*$|'                # _ZZZZ1
+    r'.*_zzz.*\..*$|'                  # 任意 _zzz
+    r'脸肿汉化组招募|'                 # 脸肿汉化组招募
+    r'無邪気漢化組招募圖_ver.*\.png$|' # 無邪気汉化组招募图
+    r'無邪気無修宇宙分組_ver.*\.png$'  # 無邪気无修宇宙分组
+    r')',
+    re.IGNORECASE
+)
 
-# 判断是否彩色图片
-def is_color_img(img: Image.Image) -> bool:
-    arr = np.array(img)
-    # 每隔 16 个像素采样
-    for i in range(0, arr.shape[0]*arr.shape[1], 16):
-        y, x = divmod(i, arr.shape[1])
-        r, g, b = arr[y, x, :3]
-        if r != g or r != b:
-            return True
-    return False
-
-# 识别二维码
-def get_qr_code(img: Image.Image) -> Optional[str]:
-    try:
-        decoded = decode(img, symbols=[ZBarSymbol.QRCODE])
-        if not decoded:
-            return None
-        return decoded[0].data.decode("utf-8")
-    except Exception:
-        return None
+# 只检测末尾的若干页
+AD_TAIL_PAGES = 10
+# 二维码识别进程池大小
+AD_SCAN_WORKERS = min(4, os.cpu_count() or 1)
 
 # 判断广告页
 def is_ad_img(img: Image.Image, logger=None) -> bool:
-    # 强制转 RGB
-    if img.mode != "RGB":
-        img = img.convert("RGB")
+    is_ad, text = scan_ad_img(img)
+    log = logger.debug if logger else print
+    if text:
+        matched = [reg for reg in qr_code_white_list if re.match(reg, text)]
+        log(f"[DEBUG] 二维码识别结果: {text}, 匹配到白名单: {matched}")
+    else:
+        log("[DEBUG] 未识别到二维码，非广告")
+    return is_ad
 
-    # 缩小大图提高识别速度
-    MAX_DIM = 1024
-    if max(img.width, img.height) > MAX_DIM:
-        scale = MAX_DIM / max(img.width, img.height)
-        new_size = (int(img.width * scale), int(img.height * scale))
-        img = img.resize(new_size, Image.Resampling.LANCZOS)
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool(logger=None) -> Optional[ProcessPoolExecutor]:
+    """按需创建二维码识别进程池，无法创建时返回 None（退回当前线程内识别）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            try:
+                # 使用 spawn 启动子进程：在多线程的 Flask/调度器进程中 fork 可能复制其他线程持有的锁导致子进程死锁
+                _pool = ProcessPoolExecutor(max_workers=AD_SCAN_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            except (OSError, NotImplementedError) as e:
+                if logger: logger.warning(f"无法创建广告检测进程池，改为单线程检测: {e}")
+                return None
+        return _pool
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _run_inline(data: bytes, known: List[Tuple[int, int]]) -> Future:
+    future = Future()
+    try:
+        future.set_result(scan_ad_page(data, known))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
-    # 黑白图肯定不是广告
-    if not is_color_img(img):
-        if logger: logger.debug("图片为黑白，不是广告")
-        else: print("[DEBUG] 图片为黑白，不是广告")
-        return False
+def detect_ad_pages(img_files: List[str], read_page: Callable[[str], bytes], logger=None) -> Set[int]:
+    """
+    检测画廊末尾的广告页，返回广告页在 img_files 中的索引集合
 
-    # 转灰度二值化
-    gray = ImageOps.grayscale(img)
-    binary = gray.point(lambda p: 255 if p >= 200 else 0)
+    从最后一页往前最多检查 AD_TAIL_PAGES 页：文件名命中广告规则的直接判定为广告，
+    其余页面通过 read_page(name) 读取原始数据后交给进程池并行检测：与已知广告页的感知哈希
+    足够接近的直接判定为广告，否则识别二维码，识别出的广告页哈希会写入索引。
+    按从后往前的顺序汇总结果，连续遇到 4 张正常图片即停止，之后的识别任务会被取消；
+    最后按邻页规则补充夹在广告页之间的页面。
+    """
+    log = logger.debug if logger else print
+    ad_pages: Set[int] = set()
+    start_idx = max(0, len(img_files) - AD_TAIL_PAGES)
+    candidates = list(range(len(img_files) - 1, start_idx - 1, -1))
 
-    # 全图识别二维码
-    text = get_qr_code(binary)
-    if logger: logger.debug(f"[DEBUG] 全图二维码识别结果: {text}")
-    else: print(f"[DEBUG] 全图二维码识别结果: {text}")
+    # 需要识别图片内容的页面，按检查顺序派发，最多领先消费位置一个进程池的任务量
+    scan_queue = deque(i for i in candidates if not ad_file_pattern.search(os.path.basename(img_files[i])))
+    futures: Dict[int, Future] = {}
+    pool = _get_pool(logger)
+    # 只在主进程中访问广告哈希库，已知哈希随任务传给子进程
+    from database import ad_hash_db
+    known = ad_hash_db.get_hashes()
 
-    # 分块扫描
-    if not text:
-        w, h = img.width // 2, img.height // 2
-        for sx, sy in [(w, h), (0, h), (w, 0), (0, 0)]:
+    def submit_ahead():
+        nonlocal pool
+        while scan_queue and len(futures) < AD_SCAN_WORKERS:
+            i = scan_queue.popleft()
             try:
-                block = img.crop((sx, sy, sx + w, sy + h))
-                text = get_qr_code(block)
-                if logger: logger.debug(f"[DEBUG] 块({sx},{sy},{w},{h})二维码识别结果: {text}")
-                else: print(f"[DEBUG] 块({sx},{sy},{w},{h})二维码识别结果: {text}")
-                if text:
-                    break
+                data = read_page(img_files[i])
             except Exception as e:
-                if logger: logger.debug(f"[DEBUG] 块({sx},{sy},{w},{h}) decode 异常: {e}")
-                else: print(f"[DEBUG] 块({sx},{sy},{w},{h}) decode 异常: {e}")
+                future = Future()
+                future.set_exception(e)
+                futures[i] = future
                 continue
+            if pool is not None:
+                try:
+                    futures[i] = pool.submit(scan_ad_page, data, known)
+                    continue
+                except (BrokenProcessPool, RuntimeError) as e:
+                    if logger: logger.warning(f"广告检测进程池不可用，改为单线程检测: {e}")
+                    _reset_pool()
+                    pool = None
+            futures[i] = _run_inline(data, known)
 
-    if text:
-        matched = [reg for reg in qr_code_white_list if re.match(reg, text)]
-        if logger: logger.debug(f"[DEBUG] 匹配到白名单: {matched}")
-        else: print(f"[DEBUG] 匹配到白名单: {matched}")
-        return all(not re.match(reg, text) for reg in qr_code_white_list)
-    else:
-        if logger: logger.debug("[DEBUG] 未识别到二维码，非广告")
-        else: print("[DEBUG] 未识别到二维码，非广告")
-        return False
+    normal_num = 0
+    try:
+        for i in candidates:
+            name = img_files[i]
+            basename = os.path.basename(name)
+            # 文件名匹配
+            if ad_file_pattern.search(basename):
+                ad_pages.add(i)
+                log(f"[DEBUG] 文件名匹配广告: {i} => {basename}")
+                continue
+            # 图像检测
+            submit_ahead()
+            try:
+                result = futures.pop(i).result()
+            except BrokenProcessPool as e:
+                if logger: logger.warning(f"广告检测进程池异常退出，改为单线程检测: {e}")
+                _reset_pool()
+                pool = None
+                try:
+                    result = scan_ad_page(read_page(name), known)
+                except Exception as e:
+                    log(f"[DEBUG] 打开图片 {name} 异常: {e}")
+                    continue
+            except Exception as e:
+                log(f"[DEBUG] 打开图片 {name} 异常: {e}")
+                continue
+            is_ad = result["is_ad"]
+            log(f"[DEBUG] 第 {i} 页 {name} 检测耗时 {result['elapsed'] * 1000:.0f} ms，"
+                f"{'命中已知广告哈希' if result['matched'] else '二维码: ' + str(result['text'])}，{'广告' if is_ad else '正常'}")
+            if result["matched"]:
+                ad_pages.add(i)
+                ad_hash_db.record_hit(*result["matched"])
+                log(f"[DEBUG] 哈希匹配广告: {i} => {name}")
+            elif is_ad:
+                ad_pages.add(i)
+                if is_informative_hash(result["hashes"]):
+                    ad_hash_db.add_hash(*result["hashes"], source=basename)
+                    known.append(result["hashes"])
+                log(f"[DEBUG] 二维码检测广告: {i} => {name}")
+            elif normal_num > 2:
+                break
+            else:
+                normal_num += 1
+    finally:
+        # 已确定结果，取消尚未开始的识别任务
+        for future in futures.values():
+            future.cancel()
 
+    # 邻页补充
+    if ad_pages:
+        start_idx = min(ad_pages)
+        ad_num = 0
+        for i in range(start_idx, len(img_files)):
+            if i in ad_pages:
+                ad_num += 1
+                continue
+            if ad_num >= 2 or ((i - 1 in ad_pages) and (i + 1 in ad_pages)):
+                ad_pages.add(i)
+                log(f"[DEBUG] 根据邻页规则补充广告: {i} => {img_files[i]}")
+            else:
+                ad_num = 0
+    return ad_pages
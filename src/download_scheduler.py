@@ -0,0 +1,231 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+# 优先级通道，按顺序排列，越靠前越先执行
+PRIORITY_MANUAL = 'manual'
+PRIORITY_RSS = 'rss'
+PRIORITY_FAVORITES = 'favorites'
+PRIORITIES = (PRIORITY_MANUAL, PRIORITY_RSS, PRIORITY_FAVORITES)
+
+# 下载任务所属的 provider，用于分别限制并发
+PROVIDERS = ('archive', 'torrent', 'nhentai', 'hitomi', 'hdoujin')
+
+DEFAULT_MAX_WORKERS = 5
+DEFAULT_PROVIDER_LIMITS = {
+    'archive': 2,
+    'torrent': 5,
+    'nhentai': 2,
+    'hitomi': 2,
+    'hdoujin': 1,
+}
+
+
+def normalize_priority(value):
+    """将请求中的优先级转换为通道名，未知值按手动下载处理"""
+    value = str(value or '').strip().lower()
+    return value if value in PRIORITIES else PRIORITY_MANUAL
+
+
+class _QueuedTask:
+    __slots__ = ('task_id', 'provider', 'priority', 'fn', 'args', 'future')
+
+    def __init__(self, task_id, provider, priority, fn, args):
+        self.task_id = task_id
+        self.provider = provider
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+
+
+class DownloadScheduler:
+    """
+    下载任务调度器：位于线程池之前，按优先级通道排队，并分别限制每个 provider 的并发数
+
+    - 通道顺序为 manual > rss > favorites，同一通道内先进先出
+    - 总并发不超过 max_workers，每个 provider 的并发不超过 provider_limits 中的值
+    - 排在前面的任务所属 provider 已满时，跳过它派发后面其他 provider 的任务，
+      避免例如 nhentai 任务占满所有线程而 aria2 空闲
+    - submit 立即返回 Future，任务未开始前 future.cancel() 可将其移出队列
+    - released_slot 归还的名额在任务继续时重新占用，等待重新占用的任务优先于排队中的任务
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, provider_limits=None, logger=None):
+        self.lock = threading.Lock()
+        self.lanes = {priority: deque() for priority in PRIORITIES}
+        self.running = {provider: 0 for provider in PROVIDERS}
+        # 等待重新占用名额的任务数（released_slot 退出时），派发新任务时为它们预留名额
+        self.reclaiming = {provider: 0 for provider in PROVIDERS}
+        self.slot_freed = threading.Condition(self.lock)
+        self.logger = logger
+        self.max_workers = max(1, int(max_workers))
+        self.provider_limits = dict(DEFAULT_PROVIDER_LIMITS)
+        if provider_limits:
+            self.provider_limits.update(provider_limits)
+        self.threads = set()
+        self.local = threading.local()
+
+    def configure(self, max_workers=None, provider_limits=None, logger=None):
+        """更新并发上限，已在运行的任务不受影响"""
+        with self.lock:
+            if logger is not None:
+                self.logger = logger
+            if provider_limits:
+                for provider, limit in provider_limits.items():
+                    try:
+                        self.provider_limits[provider] = max(1, int(limit))
+                    except (TypeError, ValueError):
+                        if self.logger:
+                            self.logger.error(f"download_queue.providers.{provider} 配置无效，已忽略: {limit}")
+            if max_workers:
+                try:
+                    self.max_workers = max(1, int(max_workers))
+                except (TypeError, ValueError):
+                    if self.logger:
+                        self.logger.error(f"download_queue.max_workers 配置无效，已忽略: {max_workers}")
+            self.slot_freed.notify_all()
+        self._dispatch()
+
+    def submit(self, task_id, provider, priority, fn, *args):
+        """将下载任务加入队列，返回 Future"""
+        provider = provider if provider in PROVIDERS else 'archive'
+        item = _QueuedTask(task_id, provider, normalize_priority(priority), fn, args)
+        with self.lock:
+            self.lanes[item.priority].append(item)
+        self._dispatch()
+        return item.future
+
+    def _total_running(self):
+        return sum(self.running.values())
+
+    def _dispatch(self):
+        """派发所有当前可以运行的任务"""
+        while True:
+            with self.lock:
+                item = self._take_next()
+                if item is None:
+                    return
+                self.running[item.provider] += 1
+                # 并发数由调度器控制，每个任务使用独立线程
+                thread = threading.Thread(target=self._run, args=(item,), name=f'download-{item.task_id}')
+                self.threads.add(thread)
+            thread.start()
+
+    def _has_slot(self, provider, reserved=0, provider_reserved=0):
+        """在持有锁时调用：总并发和 provider 并发（加上预留的名额）是否都未达到上限"""
+        return (self._total_running() + reserved < self.max_workers
+                and self.running[provider] + provider_reserved < self.provider_limits.get(provider, 1))
+
+    def _take_next(self):
+        """在持有锁时调用：取出下一个可运行的任务，已取消的任务直接丢弃"""
+        reserved = sum(self.reclaiming.values())
+        if self._total_running() + reserved >= self.max_workers:
+            return None
+        for priority in PRIORITIES:
+            lane = self.lanes[priority]
+            for item in list(lane):
+                if item.future.cancelled():
+                    lane.remove(item)
+                    continue
+                if not self._has_slot(item.provider, reserved, self.reclaiming[item.provider]):
+                    continue
+                lane.remove(item)
+                if item.future.set_running_or_notify_cancel():
+                    return item
+        return None
+
+    def _run(self, item):
+        self.local.item = item
+        try:
+            result = item.fn(*item.args)
+        except BaseException as e:
+            item.future.set_exception(e)
+        else:
+            item.future.set_result(result)
+        finally:
+            with self.lock:
+                self.running[item.provider] -= 1
+                self.threads.discard(threading.current_thread())
+                self.slot_freed.notify_all()
+            self._dispatch()
+
+    @contextmanager
+    def released_slot(self):
+        """
+        在调度器线程中使用：等待外部下载（如 aria2）期间归还当前任务占用的并发名额，让排队的任务先运行
+        退出时等待名额空出后再重新占用，以完成后续的打包和入库，运行中的任务数不会超过并发上限；
+        等待期间不再派发新任务占用这些名额
+        """
+        item = getattr(self.local, 'item', None)
+        if item is None:
+            yield
+            return
+        with self.lock:
+            self.running[item.provider] -= 1
+        self._dispatch()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.reclaiming[item.provider] += 1
+                try:
+                    self.slot_freed.wait_for(lambda: self._has_slot(item.provider))
+                    self.running[item.provider] += 1
+                finally:
+                    self.reclaiming[item.provider] -= 1
+
+    def queue_position(self, task_id):
+        """返回任务在等待队列中的位置（从 1 开始，按派发顺序），不在队列中返回 None"""
+        with self.lock:
+            position = 0
+            for priority in PRIORITIES:
+                for item in self.lanes[priority]:
+                    if item.future.cancelled():
+                        continue
+                    position += 1
+                    if item.task_id == task_id:
+                        return position
+        return None
+
+    def snapshot(self):
+        """返回队列深度和各 provider 的运行情况"""
+        with self.lock:
+            queued = {priority: 0 for priority in PRIORITIES}
+            provider_queued = {provider: 0 for provider in PROVIDERS}
+            for priority in PRIORITIES:
+                for item in self.lanes[priority]:
+                    if item.future.cancelled():
+                        continue
+                    queued[priority] += 1
+                    provider_queued[item.provider] += 1
+            return {
+                'max_workers': self.max_workers,
+                'running': self._total_running(),
+                'queued': sum(queued.values()),
+                'lanes': queued,
+                'providers': {
+                    provider: {
+                        'running': self.running[provider],
+                        'queued': provider_queued[provider],
+                        'limit': self.provider_limits.get(provider, 1),
+                    }
+                    for provider in PROVIDERS
+                },
+            }
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            for lane in self.lanes.values():
+                for item in lane:
+                    item.future.cancel()
+                lane.clear()
+            threads = list(self.threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+# 全局实例
+download_scheduler = DownloadScheduler()
@@ -1,9 +1,9 @@
-import os, re, shutil, sqlite3
+import os, re, shutil
 import json, html
-from datetime import datetime, timezone
 import subprocess # 导入 subprocess 模块
 import sys # 导入 sys 模块
 import functools
+from collections import namedtuple
 import jinja2
 
 
@@ -24,7 +24,13 @@ from providers import nhentai
 from providers import hitomi
 from providers import hdoujin
 from providers.ehtranslator import EhTagTranslator
-from utils import check_dirs, is_valid_zip, TaskStatus, parse_gallery_url, parse_interval_to_hours, sanitize_filename, truncate_filename
+from utils import check_dirs, get_task_info, is_valid_zip, mark_zip_verified, ZIP_CHECK_STRUCTURE, TaskStatus, parse_gallery_url, parse_interval_to_hours, sanitize_filename, truncate_filename
+from page_downloader import normalize_concurrency, DEFAULT_PAGE_CONCURRENCY
+from ratelimit import rate_limiter
+from download_scheduler import download_scheduler, normalize_priority
+from aria2_monitor import aria2_monitor
+from bandwidth import bandwidth_limiter
+from metadata_cache import metadata_cache
 from notification import notify
 import cbztool
 from database import task_db
@@ -124,13 +130,25 @@ class StatsFilter(logging.Filter):
 logging.getLogger('werkzeug').addFilter(StatsFilter())
 # 设置5001端口为默认端口
 
-# 创建一个线程池用于并发处理任务
+# 创建一个线程池用于处理后台任务（下载任务由 download_scheduler 排队调度）
 executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
 
 tasks = {}
 tasks_lock = threading.Lock()
 
+# 任务连续因应用重启而中断达到该次数后不再自动恢复，避免反复导致崩溃的任务无限重启
+MAX_RESUME_ATTEMPTS = 3
+
+# 任务进度快照，只由任务自己的工作线程整体替换，读取方无需加锁即可得到一致的数据
+TaskProgress = namedtuple('TaskProgress', ['progress', 'downloaded', 'total_size', 'speed', 'eta'])
+
 class TaskInfo:
+    """
+    内存中的任务记录
+
+    tasks_lock 只保护 tasks 字典的增删。取消标志是每个任务独立的 threading.Event，
+    进度由工作线程通过 update_progress() 写入，下载循环中检查取消和更新进度都不需要加锁。
+    """
     def __init__(self, future, logger, log_buffer):
         self.future = future
         self.logger = logger
@@ -138,12 +156,72 @@ class TaskInfo:
         self.status = TaskStatus.IN_PROGRESS  # "完成"、"取消"、"错误"
         self.error = None
         self.filename = None # 初始 filename 为 None
-        self.progress = 0  # 进度百分比 0-100
-        self.downloaded = 0  # 已下载字节数
-        self.total_size = 0  # 总字节数
-        self.speed = 0  # 下载速度 B/s
-        self.cancelled = False  # 取消标志
+        self.cancel_event = threading.Event()  # 取消标志
         self.aria2_gid = None  # Aria2 下载任务的 gid
+        # 进度百分比 0-100、已下载字节数、总字节数、下载速度 B/s、预计剩余秒数（未知为 None）
+        self._progress = TaskProgress(0, 0, 0, 0, None)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @cancelled.setter
+    def cancelled(self, value):
+        if value:
+            self.cancel_event.set()
+        else:
+            self.cancel_event.clear()
+
+    def update_progress(self, **fields):
+        """更新进度字段（progress、downloaded、total_size、speed、eta），整体替换快照"""
+        self._progress = self._progress._replace(**fields)
+
+    @property
+    def progress(self):
+        return self._progress.progress
+
+    @progress.setter
+    def progress(self, value):
+        self.update_progress(progress=value)
+
+    @property
+    def downloaded(self):
+        return self._progress.downloaded
+
+    @downloaded.setter
+    def downloaded(self, value):
+        self.update_progress(downloaded=value)
+
+    @property
+    def total_size(self):
+        return self._progress.total_size
+
+    @total_size.setter
+    def total_size(self, value):
+        self.update_progress(total_size=value)
+
+    @property
+    def speed(self):
+        return self._progress.speed
+
+    @speed.setter
+    def speed(self, value):
+        self.update_progress(speed=value)
+
+    def snapshot(self):
+        """返回供 API 使用的任务状态快照，不阻塞工作线程"""
+        progress = self._progress
+        return {
+            'status': self.status,
+            'error': self.error,
+            'filename': self.filename,
+            'progress': progress.progress,
+            'downloaded': progress.downloaded,
+            'total_size': progress.total_size,
+            'speed': progress.speed,
+            'eta': progress.eta,
+            'log': self.log_buffer.getvalue(),
+        }
 
 class SafeDict(dict):
     def __missing__(self, key):
@@ -245,6 +323,9 @@ def check_config(app_instance=None):
     app_instance.config['AGGRESSIVE_SERIES_DETECTION'] = advanced.get('aggressive_series_detection', False)
     app_instance.config['OPENAI_SERIES_DETECTION'] = advanced.get('openai_series_detection', False)
     app_instance.config['PREFER_OPENAI_SERIES'] = advanced.get('prefer_openai_series', False)
+    app_instance.config['PAGE_DOWNLOAD_CONCURRENCY'] = normalize_concurrency(advanced.get('page_download_concurrency', DEFAULT_PAGE_CONCURRENCY))
+    app_instance.config['STREAM_CBZ'] = advanced.get('stream_cbz', True)
+    app_instance.config['CBZ_COMPRESSION'] = str(advanced.get('cbz_compression', 'stored')).lower()
 
     # E-Hentai 设置
     ehentai_config = config_data.get('ehentai', {})
@@ -295,6 +376,15 @@ def check_config(app_instance=None):
         app_instance.config['EH_FAV_SYNC_FAVCAT'] = [str(cat).strip() for cat in favcat_whitelist]
     
 
+    # 按主机限速设置
+    rate_limiter.configure(config_data.get('rate_limit', {}), logger=global_logger)
+    download_queue_config = config_data.get('download_queue', {})
+    download_scheduler.configure(
+        max_workers=download_queue_config.get('max_workers'),
+        provider_limits=download_queue_config.get('providers'),
+        logger=global_logger
+    )
+
     # nhentai 设置
     nhentai_config = config_data.get('nhentai', {})
     nhentai_cookie = nhentai_config.get('cookie', '')
@@ -366,6 +456,7 @@ def check_config(app_instance=None):
         app_instance.config['ARIA2_TOKEN'] = ''
         app_instance.config['ARIA2_DOWNLOAD_DIR'] = None
         app_instance.config['REAL_DOWNLOAD_DIR'] = None
+    aria2_monitor.configure(app_instance.config['ARIA2_SERVER'], app_instance.config['ARIA2_TOKEN'], logger=global_logger)
 
     # Komga API 设置
     komga_config = config_data.get('komga', {})
@@ -444,6 +535,12 @@ def check_config(app_instance=None):
     app_instance.config['KOMGA_TOGGLE'] = komga_toggle
     app_instance.config['CHECKING_CONFIG'] = False
 
+    # 下载带宽限制（aria2 可用时同时设置其全局限速）
+    bandwidth_limiter.configure(config_data.get('bandwidth', {}), logger=global_logger)
+
+    # 画廊元数据缓存
+    metadata_cache.configure(config_data.get('metadata_cache', {}), logger=global_logger)
+
     # 通知设置
     notification_config = config_data.get('notification', {})
     
@@ -493,6 +590,16 @@ def check_config(app_instance=None):
     update_scheduler_jobs(app_instance)
     global_logger.info("update_scheduler_jobs 调用完成")
 
+def get_task_provider(url, mode):
+    """根据 URL 和下载模式判断任务所属的 provider，供下载调度器按 provider 限制并发"""
+    if 'nhentai.net' in url:
+        return 'nhentai'
+    if 'hitomi.la' in url:
+        return 'hitomi'
+    if 'hdoujin.org' in url:
+        return 'hdoujin'
+    return get_eh_mode(app.config, mode)
+
 def get_eh_mode(config, mode):
     aria2_enabled = config.get('ARIA2_TOGGLE', False)
     eh_valid = config.get('EH_VALID', False)
@@ -511,14 +618,49 @@ def get_eh_mode(config, mode):
     else:
         return "torrent"
 
+def resume_aria2_download(rpc, task_id, logger=None):
+    """返回断点中记录的、在 aria2 中仍可继续的 gid，没有时返回 None"""
+    gid = task_db.get_download_checkpoint(task_id).get('aria2_gid')
+    if not gid:
+        return None
+    try:
+        status = rpc.tell_status(gid, keys=['status']).get('result', {}).get('status')
+    except Exception as e:
+        if logger: logger.warning(f"查询重启前的 aria2 任务 {gid} 失败，将重新添加: {e}")
+        return None
+    if status not in ('active', 'waiting', 'paused', 'complete'):
+        return None
+    if status == 'paused':
+        rpc.unpause(gid)
+    if logger: logger.info(f"继续等待重启前提交的 aria2 任务，gid: {gid} ({status})")
+    return gid
+
+def apply_aria2_bandwidth(limit):
+    """限速时段变化时同步设置 aria2 的全局下载限速（0 表示不限速）"""
+    if not app.config.get('ARIA2_TOGGLE') or aria2_monitor.rpc is None:
+        return
+    result = aria2_monitor.rpc.change_global_option({'max-overall-download-limit': str(int(limit or 0))})
+    if 'result' not in result:
+        raise RuntimeError(f"aria2.changeGlobalOption 失败: {result.get('error')}")
+
+bandwidth_limiter.on_change(apply_aria2_bandwidth)
+
 def send_to_aria2(url=None, torrent=None, dir=None, out=None, logger=None, task_id=None, tasks=None, tasks_lock=None):
     # 检查任务是否被取消
     if task_id:
         check_task_cancelled(task_id, tasks, tasks_lock)
 
-    rpc = aria2.Aria2RPC(app.config.get('ARIA2_SERVER'), app.config.get('ARIA2_TOKEN'))
+    # 复用 aria2 监视器的 RPC 会话（keep-alive 连接）
+    rpc = aria2_monitor.rpc or aria2.Aria2RPC(app.config.get('ARIA2_SERVER'), app.config.get('ARIA2_TOKEN'))
     result = None
-    if url != None:
+
+    # 重启前已提交给 aria2 的任务：aria2 中仍存在时直接继续等待，不重复添加
+    gid = resume_aria2_download(rpc, task_id, logger) if task_id else None
+    if gid:
+        result = {'result': gid}
+        if torrent != None and not app.config.get('KEEP_TORRENTS') == True:
+            os.remove(torrent)
+    elif url != None:
         result = rpc.add_uri(url, dir=dir, out=out)
         if logger: logger.info(result)
     elif torrent != None:
@@ -535,6 +677,8 @@ def send_to_aria2(url=None, torrent=None, dir=None, out=None, logger=None, task_
         return None
 
     gid = result['result']
+    if task_id:
+        task_db.set_download_checkpoint(task_id, {'aria2_gid': gid})
 
     # 保存 gid 到任务信息中
     if task_id and tasks and tasks_lock:
@@ -548,8 +692,14 @@ def send_to_aria2(url=None, torrent=None, dir=None, out=None, logger=None, task_
     if task_id:
         check_task_cancelled(task_id, tasks, tasks_lock)
 
-    # 监视 aria2 的下载进度
-    file = rpc.listen_status(gid, logger=logger, task_id=task_id, tasks=tasks, tasks_lock=tasks_lock)
+    # 由 aria2 监视器等待下载结束，期间归还调度器的并发名额
+    future = aria2_monitor.watch(gid, logger=logger, task_id=task_id, tasks=tasks, tasks_lock=tasks_lock)
+    if task_id:
+        task_db.update_download_state(task_id, task_db.QUEUE_LEASED)
+    with download_scheduler.released_slot():
+        file = future.result()
+    if task_id:
+        task_db.update_download_state(task_id, task_db.QUEUE_RUNNING)
     
     # 下载完成或取消后，清除 gid
     if task_id and tasks and tasks_lock:
@@ -580,11 +730,9 @@ def check_task_cancelled(task_id, tasks=None, tasks_lock=None):
     if tasks_lock is None:
         tasks_lock = app.config.get('TASKS_LOCK')
     
-    if tasks_lock:
-        with tasks_lock:
-            task = tasks.get(task_id)
-            if task and task.cancelled:
-                raise Exception("Task was cancelled by user")
+    task = get_task_info(task_id, tasks, tasks_lock)
+    if task and task.cancel_event.is_set():
+        raise Exception("Task was cancelled by user")
 
 def try_fallback_download(gmetadata, logger=None):
     """
@@ -652,7 +800,7 @@ def try_fallback_download(gmetadata, logger=None):
     try:
         gid = gmetadata.get('gid')
         if gid:
-            hitomi_tool = hitomi.HitomiTools(logger=logger)
+            hitomi_tool = hitomi.HitomiTools(logger=logger, page_concurrency=app.config['PAGE_DOWNLOAD_CONCURRENCY'], stream_cbz=app.config['STREAM_CBZ'])
 
             # 先检查画廊是否存在
             try:
@@ -684,7 +832,7 @@ def try_fallback_download(gmetadata, logger=None):
             return None, None
 
         # 使用 nhentai 工具进行搜索
-        nhentai_tool = nhentai.NHentaiTools(cookie=app.config['NHENTAI_COOKIE'], logger=logger)
+        nhentai_tool = nhentai.NHentaiTools(cookie=app.config['NHENTAI_COOKIE'], logger=logger, page_concurrency=app.config['PAGE_DOWNLOAD_CONCURRENCY'], stream_cbz=app.config['STREAM_CBZ'])
 
         # 获取原始标题和语言信息用于更精确的匹配
         original_title = gmetadata.get('title_jpn')
@@ -841,6 +989,8 @@ def post_download_processing(dl, metadata, task_id, logger=None, tasks=None, tas
                 move_file_path = os.path.splitext(move_file_path)[0] + '.cbz'
                 os.makedirs(os.path.dirname(move_file_path), exist_ok=True)
                 shutil.move(cbz, move_file_path)
+                # 上面已完整校验过，移动不改变内容，沿用校验结果
+                mark_zip_verified(move_file_path)
                 (logger.info if logger else print)(f"文件移动到指定目录: {move_file_path}")
                 dl = move_file_path
             else:
@@ -850,7 +1000,7 @@ def post_download_processing(dl, metadata, task_id, logger=None, tasks=None, tas
         check_task_cancelled(task_id, tasks, tasks_lock)
 
         # 触发 Komga 媒体库入库扫描
-        if app.config['KOMGA_TOGGLE'] and is_valid_zip(dl):
+        if app.config['KOMGA_TOGGLE'] and is_valid_zip(dl, mode=ZIP_CHECK_STRUCTURE):
             if app.config['KOMGA_LIBRARY_ID']:
                 kmg = komga.KomgaAPI(server=app.config['KOMGA_SERVER'], username=app.config['KOMGA_USERNAME'], password=app.config['KOMGA_PASSWORD'], logger=logger)
                 if app.config['KOMGA_LIBRARY_ID']:
@@ -880,9 +1030,9 @@ def download_gallery_task(url, mode, task_id, logger=None, favcat=False, tasks=N
     is_hdoujin = 'hdoujin.org' in url
 
     if is_nhentai:
-        gallery_tool = nhentai.NHentaiTools(cookie=app.config.get('NHENTAI_COOKIE'), logger=logger)
+        gallery_tool = nhentai.NHentaiTools(cookie=app.config.get('NHENTAI_COOKIE'), logger=logger, page_concurrency=app.config['PAGE_DOWNLOAD_CONCURRENCY'], stream_cbz=app.config['STREAM_CBZ'])
     elif is_hitomi:
-        gallery_tool = hitomi.HitomiTools(logger=logger)
+        gallery_tool = hitomi.HitomiTools(logger=logger, page_concurrency=app.config['PAGE_DOWNLOAD_CONCURRENCY'], stream_cbz=app.config['STREAM_CBZ'])
     elif is_hdoujin:
         gallery_tool = hdoujin.HDoujinTools(
             session_token=app.config['HDOUJIN_SESSION_TOKEN'],
@@ -948,6 +1098,9 @@ def download_gallery_task(url, mode, task_id, logger=None, favcat=False, tasks=N
         ext = ".cbz"
     elif not is_nhentai and not is_hitomi:
         ext = ".zip"
+    elif app.config.get('STREAM_CBZ'):
+        # 流式打包直接生成 CBZ
+        ext = ".cbz"
     else:
         ext = ""
     filename = truncate_filename(sanitized_title, f"{gid_suffix}{ext}")
@@ -1140,6 +1293,7 @@ def task_failure_processing(url, task_id, logger, tasks, tasks_lock):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            task_db.update_download_state(task_id, task_db.QUEUE_RUNNING, new_attempt=True)
             try:
                 return func(*args, **kwargs)
             except Exception as e:
@@ -1151,7 +1305,6 @@ def task_failure_processing(url, task_id, logger, tasks, tasks_lock):
                             if task_id in tasks:
                                 tasks[task_id].status = TaskStatus.CANCELLED
                     # 更新数据库状态
-                    from database import task_db
                     task_db.update_task(task_id, status=TaskStatus.CANCELLED)
                 else:
                     if logger: logger.error(f"Task {task_id} failed with error: {e}")
@@ -1161,7 +1314,6 @@ def task_failure_processing(url, task_id, logger, tasks, tasks_lock):
                                 tasks[task_id].status = TaskStatus.ERROR
                                 tasks[task_id].error = str(e)
                     # 更新数据库状态
-                    from database import task_db
                     task_db.update_task(task_id, status=TaskStatus.ERROR, error=str(e))
                     
                     if app.config['NOTIFICATION'].get('enable'):
@@ -1172,9 +1324,65 @@ def task_failure_processing(url, task_id, logger, tasks, tasks_lock):
                         }
                         notify(event="task.error", data=event_data, logger=logger, notification_config=app.config['NOTIFICATION'])
                 raise e
+            finally:
+                # 任务已结束，从持久化队列中移除（进程被终止时不会执行，重启后据此恢复）
+                task_db.remove_download(task_id)
         return wrapper
     return decorator
 
+def submit_download_task(task_id, url, mode=None, favcat=False, priority=None):
+    """
+    创建下载任务并交给下载调度器排队，同时写入 tasks.db 的持久化队列
+    favcat 为 '0'-'9' 或 False
+
+    持久化队列对同一画廊只接受一个排队中或执行中的任务，并发的重复请求会加入已有任务。
+    返回实际负责该下载的任务 ID：新建时为 task_id，重复时为已有任务的 ID
+    """
+    provider = get_task_provider(url, mode)
+    owner_id = task_db.enqueue_download(task_id, url, mode=mode, favcat=str(favcat) if favcat is not False else None,
+                                        provider=provider, priority=normalize_priority(priority))
+    if owner_id and owner_id != task_id:
+        global_logger.info(f"画廊 {url} 已有排队中或执行中的任务 {owner_id}，不再重复下载")
+        return owner_id
+
+    logger, log_buffer = get_task_logger(task_id)
+    decorated_download_task = task_failure_processing(url, task_id, logger, tasks, tasks_lock)(download_gallery_task)
+
+    # 先登记任务再入队，避免任务立即开始时找不到内存记录
+    with tasks_lock:
+        future = download_scheduler.submit(task_id, provider, priority,
+                                           decorated_download_task, url, mode, task_id, logger, favcat, tasks, tasks_lock)
+        tasks[task_id] = TaskInfo(future, logger, log_buffer)
+    return task_id
+
+def resume_interrupted_tasks():
+    """启动时恢复重启前排队中和执行中的下载任务，多次中断的任务标记为失败"""
+    interrupted = task_db.get_interrupted_downloads()
+    if not interrupted:
+        global_logger.info("没有发现需要恢复的任务")
+    resumed = 0
+    for item in interrupted:
+        task_id = item['task_id']
+        if not item['url'] or item['attempts'] >= MAX_RESUME_ATTEMPTS:
+            reason = '任务因应用重启而中断' if item['url'] else '任务因应用重启而中断，且缺少 URL 无法恢复'
+            if item['attempts'] >= MAX_RESUME_ATTEMPTS:
+                reason = f"任务已连续 {item['attempts']} 次因应用重启而中断，不再自动恢复"
+            task_db.update_task(task_id, status=TaskStatus.ERROR, error=reason)
+            task_db.remove_download(task_id)
+            global_logger.warning(f"任务 {task_id} 无法恢复: {reason}")
+            continue
+
+        favcat = item['favcat'] if item['favcat'] and item['favcat'].isdigit() else False
+        submit_download_task(task_id, item['url'], mode=item['mode'], favcat=favcat, priority=item['priority'])
+        if item['state'] == task_db.QUEUE_PENDING:
+            global_logger.info(f"任务 {task_id} 已重新排队: {item['url']}")
+        else:
+            global_logger.info(f"任务 {task_id} 在重启前被中断，将继续下载 (第 {item['attempts'] + 1} 次尝试): {item['url']}")
+        resumed += 1
+    task_db.clear_stale_downloads()
+    if resumed:
+        global_logger.info(f"已恢复 {resumed} 个重启前未完成的任务")
+
 # 确保这个路由在所有 API 路由之后定义
 # 只处理 GET 请求，避免拦截 API 的 POST/PUT/DELETE 等请求
 @app.route('/', defaults={'path': ''}, methods=['GET'])
@@ -1217,11 +1425,14 @@ if __name__ == '__main__':
     app.config['TASKS'] = tasks
     app.config['TASKS_LOCK'] = tasks_lock
     app.config['EXECUTOR'] = executor
+    app.config['DOWNLOAD_SCHEDULER'] = download_scheduler
     # 将函数和类放入 app.config 供 Blueprint 使用
     app.config['GET_TASK_LOGGER'] = get_task_logger
     app.config['TASK_FAILURE_PROCESSING'] = task_failure_processing
     app.config['DOWNLOAD_GALLERY_TASK'] = download_gallery_task
     app.config['TASK_INFO_CLASS'] = TaskInfo
+    app.config['GET_TASK_PROVIDER'] = get_task_provider
+    app.config['SUBMIT_DOWNLOAD_TASK'] = submit_download_task
     app.register_blueprint(ehentai_bp)
     app.register_blueprint(task_bp)
     app.register_blueprint(config_bp)
@@ -1249,23 +1460,9 @@ if __name__ == '__main__':
             else:
                 global_logger.error("任务迁移失败")
 
-        # 将重启前的进行中任务标记为失败
-        global_logger.info("正在检查并标记重启前的进行中任务...")
-        try:
-            with sqlite3.connect('./data/tasks.db') as conn:
-                cursor = conn.execute('SELECT id FROM tasks WHERE status = ?', (TaskStatus.IN_PROGRESS,))
-                in_progress_tasks = cursor.fetchall()
-                if in_progress_tasks:
-                    for task_row in in_progress_tasks:
-                        task_id = task_row[0]
-                        conn.execute('UPDATE tasks SET status = ?, error = ?, updated_at = ? WHERE id = ?',
-                                   (TaskStatus.ERROR, '任务因应用重启而中断', datetime.now(timezone.utc).isoformat(), task_id))
-                    conn.commit()
-                    global_logger.info(f"已将 {len(in_progress_tasks)} 个进行中任务标记为失败")
-                else:
-                    global_logger.info("没有发现进行中的任务")
-        except sqlite3.Error as e:
-            global_logger.error(f"标记进行中任务失败时发生数据库错误: {e}")
+        # 恢复重启前排队中和执行中的任务
+        global_logger.info("正在恢复重启前未完成的任务...")
+        resume_interrupted_tasks()
 
         # 初始化并启动调度器
         init_scheduler(app)
@@ -1278,5 +1475,6 @@ if __name__ == '__main__':
         app.run(host='0.0.0.0', port=app.config.get('PORT', 5001), debug=app.debug)
     finally:
         executor.shutdown()
+        download_scheduler.shutdown(wait=False)
         # 确保在主应用终止时关闭子进程
         stop_notification_process()
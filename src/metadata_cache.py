@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from utils import check_dirs, parse_interval_to_hours
+
+# 按变化频率划分的字段类别：tags 类为标签、评分、种子等经常变化的字段，其余字段（标题、分类、页数等）属于 info 类
+TAG_FIELDS = frozenset({
+    'tags', 'rating', 'torrentcount', 'torrents', 'expunged',
+    'archiver_key', 'current_gid', 'current_key',
+})
+FIELD_CLASSES = ('info', 'tags')
+# 各类别的默认有效期
+DEFAULT_TTL = {
+    'info': '30d',
+    'tags': '1d',
+}
+
+
+def split_fields(metadata):
+    """把元数据按字段类别拆分为 {类别: {字段: 值}}"""
+    classes = {name: {} for name in FIELD_CLASSES}
+    for key, value in metadata.items():
+        classes['tags' if key in TAG_FIELDS else 'info'][key] = value
+    return classes
+
+
+class MetadataCache:
+    """
+    画廊元数据的读穿透缓存，以 (站点, 画廊 ID) 为键，保存在 data/metadata.db 中
+
+    每个字段类别单独记录获取时间和有效期，get() 只在所需类别都未过期时命中；
+    只需要标题等稳定字段的调用方可以通过 classes 参数只要求 info 类。
+    元数据以紧凑 JSON 保存，统计各站点的命中/未命中次数。
+    """
+
+    def __init__(self, db_path='./data/metadata.db'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.enabled = True
+        self.ttl = {name: parse_interval_to_hours(value) * 3600 for name, value in DEFAULT_TTL.items()}
+        self.logger = None
+        self.hits = {}
+        self.misses = {}
+
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            check_dirs(db_dir)
+        self._init_database()
+
+    def _get_conn(self):
+        return sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+
+    def _init_database(self):
+        with self._get_conn() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS gallery_metadata (
+                    site TEXT NOT NULL,
+                    gid TEXT NOT NULL,
+                    field_class TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (site, gid, field_class)
+                )
+            ''')
+            conn.commit()
+
+    def configure(self, config, logger=None):
+        """根据 metadata_cache 配置段设置开关和各类别的有效期，并清理已过期的记录"""
+        config = config or {}
+        ttl = {}
+        for name, default in DEFAULT_TTL.items():
+            value = (config.get('ttl') or {}).get(name, default)
+            hours = parse_interval_to_hours(value)
+            if hours is None:
+                if logger:
+                    logger.error(f"metadata_cache.ttl.{name} 配置无效（{value}），使用默认值 {default}")
+                hours = parse_interval_to_hours(default)
+            ttl[name] = hours * 3600
+        with self.lock:
+            self.enabled = bool(config.get('enable', True))
+            self.ttl = ttl
+            self.logger = logger
+        self.purge()
+
+    def _count(self, counter, site, count=1):
+        with self.lock:
+            counter[site] = counter.get(site, 0) + count
+
+    def get(self, site, gid, classes=None):
+        """读取缓存的元数据，所需类别（默认全部）有任何一个缺失或过期时返回 None"""
+        return self.get_many(site, [gid], classes).get(str(gid))
+
+    def get_many(self, site, gids, classes=None):
+        """批量读取缓存，返回 {str(gid): 元数据}，只包含命中的画廊"""
+        classes = classes or FIELD_CLASSES
+        gids = [str(gid) for gid in gids]
+        if not gids:
+            return {}
+        if not self.enabled:
+            self._count(self.misses, site, len(gids))
+            return {}
+
+        now = time.time()
+        rows = {}
+        try:
+            with self._get_conn() as conn:
+                for start in range(0, len(gids), 500):
+                    chunk = gids[start:start + 500]
+                    placeholders = ','.join('?' for _ in chunk)
+                    cursor = conn.execute(
+                        f'SELECT gid, field_class, data, fetched_at FROM gallery_metadata WHERE site = ? AND gid IN ({placeholders})',
+                        [site] + chunk)
+                    for gid, field_class, data, fetched_at in cursor.fetchall():
+                        if now - fetched_at < self.ttl.get(field_class, 0):
+                            rows.setdefault(gid, {})[field_class] = data
+        except sqlite3.Error as e:
+            if self.logger:
+                self.logger.warning(f"读取元数据缓存失败: {e}")
+            rows = {}
+
+        results = {}
+        for gid in gids:
+            fields = rows.get(gid, {})
+            if all(name in fields for name in classes):
+                metadata = {}
+                for data in fields.values():
+                    metadata.update(json.loads(data))
+                results[gid] = metadata
+        self._count(self.hits, site, len(results))
+        self._count(self.misses, site, len(gids) - len(results))
+        return results
+
+    def put(self, site, gid, metadata):
+        """写入元数据；包含 error 字段（gid/token 无效）的结果不缓存"""
+        if not self.enabled or not metadata or 'error' in metadata:
+            return
+        now = time.time()
+        records = [
+            (site, str(gid), name, json.dumps(fields, ensure_ascii=False, separators=(',', ':')), now)
+            for name, fields in split_fields(metadata).items()
+        ]
+        try:
+            with self._get_conn() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO gallery_metadata (site, gid, field_class, data, fetched_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', records)
+                conn.commit()
+        except sqlite3.Error as e:
+            if self.logger:
+                self.logger.warning(f"写入元数据缓存失败: {e}")
+
+    def purge(self):
+        """删除所有已过期的记录"""
+        now = time.time()
+        try:
+            with self._get_conn() as conn:
+                for name, ttl in self.ttl.items():
+                    conn.execute('DELETE FROM gallery_metadata WHERE field_class = ? AND fetched_at < ?', (name, now - ttl))
+                conn.commit()
+        except sqlite3.Error as e:
+            if self.logger:
+                self.logger.warning(f"清理元数据缓存失败: {e}")
+
+    def stats(self):
+        """命中/未命中统计：总数及各站点的次数"""
+        with self.lock:
+            sites = sorted(set(self.hits) | set(self.misses))
+            by_site = {site: {'hits': self.hits.get(site, 0), 'misses': self.misses.get(site, 0)} for site in sites}
+        hits = sum(item['hits'] for item in by_site.values())
+        misses = sum(item['misses'] for item in by_site.values())
+        return {
+            'enabled': self.enabled,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+            'sites': by_site,
+        }
+
+
+# 全局实例
+metadata_cache = MetadataCache()
@@ -0,0 +1,303 @@
+import io
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import is_valid_image, get_task_info
+from transfer_meter import TransferMeter, format_size, format_speed
+
+# 每个画廊默认的并发页面下载数
+DEFAULT_PAGE_CONCURRENCY = 4
+
+# 画廊目录中记录已完成页面的清单文件
+MANIFEST_NAME = '.pages.json'
+# 清单按批写入：累计完成这么多页或距上次写入超过这么多秒时写入一次，下载结束时再写入剩余部分
+# 进程意外退出时最多丢失一批记录，这些页面在重试时重新下载
+MANIFEST_SAVE_PAGES = 20
+MANIFEST_SAVE_INTERVAL = 5
+
+# 流式打包时，每个并发槽位最多允许领先写入位置的页数（限制内存中的乱序页面数量）
+STREAM_WINDOW_FACTOR = 4
+
+
+def normalize_concurrency(value, default=DEFAULT_PAGE_CONCURRENCY):
+    """将配置中的并发数转换为正整数，非法值回退到默认值"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, value)
+
+
+class PageBuffer(io.BytesIO):
+    """流式打包模式下的内存页面，name 为页面在 CBZ 中的文件名"""
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+@contextmanager
+def open_page(target):
+    """打开页面输出：target 为文件路径或 PageBuffer，重复打开时会清空之前写入的内容"""
+    if isinstance(target, PageBuffer):
+        target.seek(0)
+        target.truncate()
+        yield target
+    else:
+        with open(target, 'wb') as f:
+            yield f
+
+
+def discard_page(target):
+    """丢弃未完成的页面输出"""
+    if isinstance(target, PageBuffer):
+        target.seek(0)
+        target.truncate()
+    elif os.path.exists(target):
+        os.remove(target)
+
+
+class PageDownloader:
+    """
+    逐页下载画廊图片的并发引擎（nhentai、Hitomi 共用）
+
+    pages 为 (path, fetch) 列表，fetch(target) 负责把单页写入 target 并返回是否成功，
+    target 通过 open_page() 打开。任意一页失败或任务被取消时停止派发剩余页面。
+
+    目录模式（sink 为空）：页面写入 path，已完成的页面记录在画廊目录的 .pages.json 清单中
+    （页码、大小、sha1，按批写入）。下载失败时保留已完成的页面，重试时清单中大小一致且文件头尾完整的页面
+    直接跳过，只重新下载缺失或损坏的页面；用户取消时删除所有页面和清单。
+
+    流式模式（sink 为 CbzStreamWriter）：页面下载到内存，按页码顺序直接写入 CBZ，
+    乱序完成的页面暂存在内存中，并通过派发窗口限制其数量。已写入 CBZ 的页面在重试时跳过。
+    """
+
+    def __init__(self, concurrency=DEFAULT_PAGE_CONCURRENCY, logger=None, task_id=None, tasks=None, tasks_lock=None):
+        self.concurrency = normalize_concurrency(concurrency)
+        self.logger = logger
+        self.task_id = task_id
+        # 只在创建时查找一次任务记录，之后检查取消和更新进度都不需要 tasks_lock
+        self.task = get_task_info(task_id, tasks, tasks_lock)
+        self._stop = threading.Event()
+
+    def _is_cancelled(self):
+        if self._stop.is_set():
+            return True
+        if self.task and self.task.cancel_event.is_set():
+            self._stop.set()
+            return True
+        return False
+
+    def _update_progress(self, done, total):
+        if self.task:
+            self.task.update_progress(progress=int((done / total) * 100))
+
+    def _fetch(self, target, fetch):
+        """工作线程：下载单页并校验，返回 (是否成功, sha1)，被取消时返回 (None, None)"""
+        if self._is_cancelled():
+            return None, None
+        try:
+            if not fetch(target):
+                return False, None
+            if isinstance(target, PageBuffer):
+                data = target.getbuffer()
+                valid = is_valid_image(target.name, data=data)
+                sha1 = hashlib.sha1(data).hexdigest() if valid else None
+                data.release()
+            else:
+                valid = is_valid_image(target)
+                sha1 = self._file_sha1(target) if valid else None
+            if not valid:
+                if self.logger:
+                    self.logger.error(f"下载的页面不完整或不是有效图片: {os.path.basename(str(target))}")
+                return False, None
+            return True, sha1
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f"下载页面出错: {os.path.basename(str(target))} - {e}")
+            return False, None
+
+    def _cleanup(self, paths):
+        for file_path in paths:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def _load_manifest(self, manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            return manifest.get('pages', {}) if isinstance(manifest, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest_path, entries):
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'pages': entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, manifest_path)
+
+    def _file_sha1(self, path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def _is_complete(self, path, entry):
+        """清单中记录的页面是否仍然完整：大小一致且文件头尾检查通过"""
+        try:
+            return bool(entry) and os.path.getsize(path) == entry.get('size') and is_valid_image(path)
+        except OSError:
+            return False
+
+    def run(self, pages, gallery_dir=None, sink=None):
+        """
+        并发下载所有页面，成功时按页面顺序返回文件路径列表，失败或取消返回 None
+        流式模式下成功时 sink 已写入中央目录并重命名为最终文件
+        """
+        total = len(pages)
+        if total == 0:
+            if sink is not None:
+                sink.close()
+            return []
+
+        results = [None] * total
+        entries = {}
+        manifest_path = None
+        if sink is not None:
+            for index, (path, _) in enumerate(pages):
+                if os.path.basename(path) in sink.names:
+                    results[index] = path
+        else:
+            gallery_dir = gallery_dir or os.path.dirname(pages[0][0])
+            manifest_path = os.path.join(gallery_dir, MANIFEST_NAME)
+            previous = self._load_manifest(manifest_path)
+            for index, (path, _) in enumerate(pages):
+                name = os.path.basename(path)
+                entry = previous.get(name)
+                if entry and entry.get('index') == index + 1 and self._is_complete(path, entry):
+                    results[index] = path
+                    entries[name] = entry
+
+        pending = deque(index for index in range(total) if not results[index])
+        # 流式模式下页面的写入顺序
+        write_order = list(pending)
+        write_pos = 0
+        buffered = {}
+
+        done = total - len(pending)
+        if done:
+            if self.logger:
+                self.logger.info(f"已有 {done}/{total} 页通过校验，仅下载剩余 {len(pending)} 页")
+            self._update_progress(done, total)
+        failed = False
+
+        if pending:
+            window = self.concurrency * STREAM_WINDOW_FACTOR if sink is not None else total
+            in_flight = {}
+            # 统计本次下载的字节数和速度，总大小按已完成页面的平均大小估算；进度仍按页数计算
+            meter = TransferMeter(self.task, report_progress=False)
+            to_fetch = len(pending)
+            fetched = 0
+            # 尚未写入清单的页面数和上次写入时间
+            unsaved = 0
+            last_saved = time.monotonic()
+            try:
+                with ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending)), thread_name_prefix='page') as executor:
+                    while pending or in_flight:
+                        # 按窗口派发页面，失败或取消后不再派发
+                        while pending and not self._stop.is_set() and len(in_flight) + len(buffered) < window:
+                            index = pending.popleft()
+                            path, fetch = pages[index]
+                            target = PageBuffer(os.path.basename(path)) if sink is not None else path
+                            in_flight[executor.submit(self._fetch, target, fetch)] = (index, target)
+                        if not in_flight:
+                            break
+
+                        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            index, target = in_flight.pop(future)
+                            path = pages[index][0]
+                            success, sha1 = future.result()
+
+                            if success:
+                                done += 1
+                                fetched += 1
+                                if self.logger:
+                                    self.logger.info(f"图片 {index + 1}/{total} 下载成功: {os.path.basename(path)}")
+                                self._update_progress(done, total)
+                                page_size = target.seek(0, io.SEEK_END) if sink is not None else os.path.getsize(path)
+                                meter.set_total((meter.downloaded + page_size) * to_fetch // fetched)
+                                meter.add(page_size)
+                                if sink is None:
+                                    results[index] = path
+                                    entries[os.path.basename(path)] = {
+                                        'index': index + 1,
+                                        'size': page_size,
+                                        'sha1': sha1,
+                                    }
+                                    unsaved += 1
+                                    if unsaved >= MANIFEST_SAVE_PAGES or time.monotonic() - last_saved >= MANIFEST_SAVE_INTERVAL:
+                                        self._save_manifest(manifest_path, entries)
+                                        unsaved = 0
+                                        last_saved = time.monotonic()
+                                    continue
+
+                                # 按页码顺序写入 CBZ，乱序完成的页面先暂存
+                                buffered[index] = target
+                                while write_pos < len(write_order) and write_order[write_pos] in buffered:
+                                    next_index = write_order[write_pos]
+                                    page = buffered.pop(next_index)
+                                    sink.write(page.name, page.getvalue())
+                                    page.close()
+                                    results[next_index] = pages[next_index][0]
+                                    write_pos += 1
+                                continue
+
+                            if success is False and not failed and not self._stop.is_set():
+                                failed = True
+                                if self.logger:
+                                    self.logger.error(f"图片 {index + 1}/{total} 下载失败: {os.path.basename(path)}，停止下载")
+                            # 停止派发剩余页面，已在进行中的页面会自行结束
+                            self._stop.set()
+            finally:
+                if unsaved:
+                    self._save_manifest(manifest_path, entries)
+
+            meter.finish()
+            if self.logger and fetched:
+                self.logger.info(f"本次下载 {fetched} 页，共 {format_size(meter.downloaded)}，平均 {format_speed(meter.average_speed)}")
+
+        if self._stop.is_set():
+            if failed:
+                if sink is not None:
+                    # 保留已按顺序写入的页面，重试时继续追加
+                    sink.suspend()
+                    if self.logger:
+                        self.logger.info(f"CBZ 中已保留 {len(sink.names)}/{total} 页，重试时将继续下载")
+                else:
+                    # 保留已完成的页面和清单，删除未完成的页面，重试时只下载缺失部分
+                    self._cleanup(path for index, (path, _) in enumerate(pages) if not results[index])
+                    if self.logger:
+                        self.logger.info(f"已保留 {done}/{total} 个已完成页面，重试时将继续下载")
+            else:
+                if self.logger:
+                    self.logger.info("任务已取消，停止下载剩余页面")
+                if sink is not None:
+                    sink.abort()
+                else:
+                    self._cleanup([path for path, _ in pages] + [manifest_path])
+            return None
+
+        if sink is not None:
+            sink.close()
+        return [path for path in results if path]
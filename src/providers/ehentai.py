@@ -4,6 +4,15 @@ from bs4 import BeautifulSoup
 from datetime import datetime
 
 from utils import check_dirs
+from ratelimit import rate_limiter
+from resumable import download_resumable
+from providers.ehentai_api import GDataBatcher, GDataError
+from metadata_cache import metadata_cache
+from providers import ehentai_parser
+from providers.ehentai_parser import make_soup
+
+# 收藏夹分类编号
+FAVCAT_IDS = tuple(str(i) for i in range(10))
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/85.0.4183.102 Safari/537.36',
@@ -51,7 +60,7 @@ def male_only_taglist():
     try:
         response = requests.get(url, headers=headers, timeout=30)
         if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
+            soup = make_soup(response.text)
             
             # 查找所有带有 "♂" 的 <a> 标签
             for a_tag in soup.find_all('a'):
@@ -75,6 +84,9 @@ class EHentaiTools:
         self.logger = logger
         self.session = requests.Session()
         self.session.headers.update(headers)
+        rate_limiter.install(self.session)
+        # gdata 批量查询：合并并发的元数据查询，每次请求最多 25 个画廊
+        self.gdata = GDataBatcher(self.session, logger=logger)
 
         # 临时cookie缓存（运行时自动获取）
         self.cached_sk = None
@@ -87,6 +99,8 @@ class EHentaiTools:
                 self.session.cookies.set('ipb_pass_hash', ipb_pass_hash, domain=domain)
 
         self.favcat_map = {}
+        # 收藏夹页面的解析后端，安装了 lxml 时使用 lxml
+        self.html_backend = ehentai_parser.DEFAULT_BACKEND
     
     def _update_cached_cookies(self):
         """在每次请求成功后更新缓存的临时cookies"""
@@ -214,7 +228,7 @@ class EHentaiTools:
         返回格式: {'GP': str, 'Credits': int} 或 None
         GP 会带上 'k' 单位，例如 "158k"
         """
-        soup = BeautifulSoup(html_text, 'html.parser')
+        soup = make_soup(html_text)
         funds = {}
         
         try:
@@ -256,78 +270,50 @@ class EHentaiTools:
                 self.logger.error(f"解析 funds 时发生错误: {e}")
             return None
 
-    # 从 E-Hentai API 获取画廊信息
+    # 从 E-Hentai API 获取画廊信息（优先读取元数据缓存）
     def get_gmetadata(self, url):
-        API = 'https://api.e-hentai.org/api.php'
         searchUrl = re.search(r'g\/(\d+?)\/(.+?)(\/|$)', url)
         if not searchUrl == None:
             gid = searchUrl.group(1)
             gtoken = searchUrl.group(2)
-            data = {
-                "method": "gdata",
-                "gidlist": [
-                    [gid,gtoken]
-                ],
-                "namespace": 1
-                }
-            response = self.session.post(API,json=data)
-            if response.status_code == 200:
-                if self.logger: self.logger.info(response.json())
-                gmetadata_dir = check_dirs(os.path.join('data', 'ehentai', 'gmetadata'))
-                with open(os.path.join(gmetadata_dir, f'{gid}.json'), 'w+', encoding='utf-8') as wf:
-                    json.dump(response.json(),wf,ensure_ascii=False,indent=4)
-                return response.json()['gmetadata'][0]
+            gmetadata = metadata_cache.get('ehentai', gid)
+            if gmetadata:
+                if self.logger: self.logger.info(f'使用缓存的画廊元数据: {gid}')
+                return gmetadata
+            try:
+                gmetadata = self.gdata.get(gid, gtoken)
+            except GDataError as e:
+                if self.logger: self.logger.error(f'获取{url}的元数据失败: {e}')
+                return None
+            if self.logger: self.logger.info(gmetadata)
+            metadata_cache.put('ehentai', gid, gmetadata)
+            return gmetadata
         else:
             if self.logger: self.logger.error(f'解析{url}时遇到了错误')
 
-    def _download(self, url, path, task_id=None, tasks=None, tasks_lock=None):
-        try:
-            with self.session.get(url, stream=True, timeout=30) as r:
-                r.raise_for_status()
-                total_size = int(r.headers.get('content-length', 0))
-                downloaded = 0
+    def get_gmetadata_many(self, galleries, classes=None):
+        """
+        批量获取画廊信息，缓存未命中的画廊每 25 个一次 gdata 请求
 
-                with open(path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        # 检查任务是否被取消
-                        if task_id and tasks and tasks_lock:
-                            with tasks_lock:
-                                task = tasks.get(task_id)
-                                if task and task.cancelled:
-                                    if self.logger:
-                                        self.logger.info(f"任务 {task_id} 被用户取消，正在清理文件")
-                                    # 删除已下载的文件
-                                    if os.path.exists(path):
-                                        os.remove(path)
-                                    # 返回None而不是抛出异常，避免中断线程
-                                    return None
+        Args:
+            galleries: [(gid, token), ...]
+            classes: 需要的元数据字段类别（见 metadata_cache），默认需要全部字段
 
-                        if chunk:
-                            f.write(chunk)
-                            downloaded += len(chunk)
+        Returns:
+            {gid: gmetadata}，请求失败的画廊不包含在结果中
+        """
+        cached = metadata_cache.get_many('ehentai', [gid for gid, _ in galleries], classes)
+        results = {int(gid): gmetadata for gid, gmetadata in cached.items()}
+        missing = [(gid, token) for gid, token in galleries if int(gid) not in results]
+        for gid, gmetadata in self.gdata.get_many(missing).items():
+            metadata_cache.put('ehentai', gid, gmetadata)
+            results[gid] = gmetadata
+        return results
 
-                            # 更新进度信息
-                            if task_id and tasks and tasks_lock:
-                                progress = 0
-                                if total_size > 0:
-                                    progress = min(100, int((downloaded / total_size) * 100))
+    def _download(self, url, path, task_id=None, tasks=None, tasks_lock=None):
+        # 写入 .part 临时文件，失败后重试可通过 Range 续传
+        return download_resumable(self.session, url, path, self.logger, task_id, tasks, tasks_lock, timeout=30, provider='archive')
 
-                                with tasks_lock:
-                                    if task_id in tasks:
-                                        tasks[task_id].progress = progress
-                                        tasks[task_id].downloaded = downloaded
-                                        tasks[task_id].total_size = total_size
-                                        # 直接下载模式无法获取实时速度，设置为0
-                                        tasks[task_id].speed = 0
-                if self.logger:
-                    self.logger.info(f"下载完成: {path}")
-                print(f"下载完成: {path}")
-                return path
-        except Exception as e:
-            if self.logger:
-                self.logger.error(f"下载失败: {e}")
-            return None
-        
     def _download_torrent(self, torrent_url, torrent_name):
         try:
             if self.logger: self.logger.info(f"尝试下载种子: {torrent_url}")
@@ -406,14 +392,14 @@ class EHentaiTools:
     def get_download_link(self, url, mode):
         response = self.session.get(url)
         if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
+            soup = make_soup(response.text)
             # 检查是否有内容警告
             h1 = soup.find('h1')
             if h1 and h1.text == 'Content Warning':
                 if self.logger: self.logger.info("检测到内容警告, 选择忽略并尝试重新加载")
                 response = self.session.get(url + '/?nw=always')
                 if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
+                    soup = make_soup(response.text)
                 else:
                     if self.logger: self.logger.error("添加 'nw=always' 参数后请求失败，请仔细联系脚本维护者排查问题")
                     return None, None
@@ -443,7 +429,7 @@ class EHentaiTools:
                                 if self.logger: self.logger.info('发现 Outdated Torrent')
                                 t_html = search_outdated_text.group(1)
                             else: t_html = text
-                            t_soup = BeautifulSoup(t_html, 'html.parser')
+                            t_soup = make_soup(t_html)
                             form_list = t_soup.find_all('form', method="post")
                             torrent_list = []
                             for form in form_list:
@@ -489,7 +475,7 @@ class EHentaiTools:
             }
             try:
                 response = self.session.post(download_url, data)
-                a_soup = BeautifulSoup(response.text, 'html.parser')
+                a_soup = make_soup(response.text)
                 # 查找所有带有 onclick 属性的 <a> 标签
                 a_tags_with_onclick = a_soup.find_all('a', onclick=True)
                 # 提取 href 属性内容
@@ -670,6 +656,28 @@ class EHentaiTools:
         elif layout == 'extended':
             galleries_data = self._extract_extended_galleries(soup)
 
+        self._assign_favcat(galleries_data)
+        return layout, galleries_data
+
+    def _parse_favorites_html(self, html_text: str) -> tuple[str, list, str]:
+        """
+        解析收藏夹页面，返回 (layout, galleries, next_url)
+        html_backend 为 lxml 时用 XPath 直接提取字段，否则使用 BeautifulSoup，两者结果一致
+        """
+        if self.html_backend == ehentai_parser.BACKEND_LXML:
+            layout, galleries_data, favcat_map, next_url = ehentai_parser.parse_favorites_page(html_text, self._normalize_time)
+            if favcat_map:
+                self.favcat_map.update(favcat_map)
+            self._assign_favcat(galleries_data)
+            return layout, galleries_data, next_url
+
+        soup = make_soup(html_text)
+        layout, galleries_data = self._parse_favorites_page(soup)
+        next_link = soup.select_one('div.searchnav a#dnext')
+        next_url = next_link['href'] if next_link and next_link.get('href') else None
+        return layout, galleries_data, next_url
+
+    def _assign_favcat(self, galleries_data: list):
         # 从页面中提取每个画廊的 favcat
         # 创建收藏夹名称到ID的反向映射
         name_to_id = {name: fav_id for fav_id, name in self.favcat_map.items()}
@@ -683,7 +691,6 @@ class EHentaiTools:
                     gallery['favcat'] = name_to_id[favcat_name]
                 else:
                     gallery['favcat'] = None
-        return layout, galleries_data
 
     def get_favcat_list(self) -> list:
         """获取用户收藏夹列表, 如果缓存为空则主动获取"""
@@ -694,7 +701,7 @@ class EHentaiTools:
             try:
                 response = self.session.get(url, allow_redirects=True, timeout=10)
                 if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
+                    soup = make_soup(response.text)
                     # _build_favcat_map 会自动更新 self.favcat_map
                     self._build_favcat_map(soup)
                     if self.logger:
@@ -717,74 +724,160 @@ class EHentaiTools:
             favcat_list.sort(key=lambda x: int(x['id']))
         return favcat_list
 
-    def get_favorites(self, favcat_list: list, existing_gids: set = None, initial_scan_pages: int = 1) -> list:
+    def get_favcat_counts(self) -> dict | None:
         """
-        获取收藏夹画廊列表
+        读取收藏夹页面顶部各分类的画廊数量（一次请求），同时更新收藏夹名称缓存
+        
+        Returns:
+            {favcat ID: 画廊数量}，获取或解析失败时返回 None
+        """
+        url = "https://exhentai.org/favorites.php"
+        try:
+            response = self.session.get(url, allow_redirects=True, timeout=10)
+            if response.status_code != 200:
+                if self.logger:
+                    self.logger.error(f"获取收藏夹分类数量失败: status_code={response.status_code}")
+                return None
+        except requests.RequestException as e:
+            if self.logger:
+                self.logger.error(f"获取收藏夹分类数量时发生网络错误: {e}")
+            return None
+
+        if self.html_backend == ehentai_parser.BACKEND_LXML:
+            root = ehentai_parser.lxml_html.fromstring(response.text)
+            self.favcat_map.update(ehentai_parser.parse_favcat_map(root))
+            favcat_counts = ehentai_parser.parse_favcat_counts(root)
+        else:
+            soup = make_soup(response.text)
+            self._build_favcat_map(soup)
+            favcat_counts = {}
+            for element in soup.select('div.nosel div.fp[onclick]'):
+                match = re.search(r"favcat=(\d+)", element.get('onclick', ''))
+                count = ehentai_parser.parse_favcat_count(div.get_text(strip=True) for div in element.find_all('div', recursive=False))
+                if match and count is not None:
+                    favcat_counts[match.group(1)] = count
+
+        if not favcat_counts:
+            if self.logger:
+                self.logger.warning("未能从收藏夹页面解析出各分类的画廊数量")
+            return None
+        return favcat_counts
+
+    def get_favorites_by_favcat(self, favcat_list: list, existing_gids=None, initial_scan_pages: int = 1,
+                                full_scan_favcats=()) -> tuple[list, list, list]:
+        """
+        按收藏夹分类获取画廊列表
+        
+        每个分类单独请求 favorites.php?favcat=N，并各自判断扫描模式和增量扫描的停止条件，
+        请求的页数只取决于要同步的分类中的画廊数量。要同步全部 10 个分类时直接扫描全部收藏。
         
         Args:
             favcat_list: 要同步的收藏夹分类ID列表
-            existing_gids: 数据库中已存在的GID集合，用于增量扫描
+            existing_gids: 数据库中已存在的GID，用于增量扫描；{favcat: GID集合}，或所有分类共用的GID集合
             initial_scan_pages: 首次扫描页数，0表示全量扫描，其他数字表示扫描指定页数
+            full_scan_favcats: 忽略已存在的GID、强制全量扫描的分类ID列表（用于核对删除）
             
         Returns:
-            画廊列表
+            (画廊列表, 返回了完整线上列表的分类ID列表, 请求失败的分类ID列表)
+        """
+        favcat_list = [str(favcat) for favcat in favcat_list]
+        if not isinstance(existing_gids, dict):
+            existing_gids = {favcat: existing_gids or set() for favcat in favcat_list}
+
+        full_scan_favcats = {str(favcat) for favcat in full_scan_favcats}
+
+        if set(FAVCAT_IDS) <= set(favcat_list):
+            scopes = {'all': favcat_list}
+        else:
+            scopes = {favcat: [favcat] for favcat in favcat_list}
+
+        all_galleries = []
+        complete_favcats = []
+        failed_favcats = []
+        for index, (scope, favcats) in enumerate(scopes.items()):
+            if index > 0:
+                time.sleep(10) # 避免请求过于频繁
+            if full_scan_favcats & set(favcats):
+                galleries, complete, failed = self._scan_favorites(scope, favcat_list, set(), 0)
+            else:
+                gids = set().union(*(existing_gids.get(favcat) or set() for favcat in favcats))
+                galleries, complete, failed = self._scan_favorites(scope, favcat_list, gids, initial_scan_pages)
+            all_galleries.extend(galleries)
+            if complete:
+                complete_favcats.extend(favcats)
+            if failed:
+                failed_favcats.extend(favcats)
+        return all_galleries, complete_favcats, failed_favcats
+
+    def _scan_favorites(self, favcat: str, favcat_list: list, existing_gids: set, initial_scan_pages: int) -> tuple[list, bool, bool]:
+        """
+        扫描单个收藏夹分类（favcat 为 'all' 时扫描全部收藏）
+        
+        Returns:
+            (画廊列表, 是否返回了该分类完整的线上列表（非增量模式下扫描到了最后一页）, 是否因请求失败而中断)
         """
         all_galleries = []
         stop_scanning = False
+        complete = False
+        failed = False
         consecutive_matches = 0  # 连续匹配计数器
         MATCH_THRESHOLD = 5  # 固定连续匹配阈值
+        label = "全部收藏夹" if favcat == 'all' else f"收藏夹分类 {favcat}"
         
         # 判断扫描模式
-        if existing_gids is None or len(existing_gids) == 0:
+        if not existing_gids:
             if initial_scan_pages == 0:
                 scan_mode = "full_scan"
                 max_pages = None  # 无限制
                 if self.logger:
-                    self.logger.info("数据库为空，将进行全量扫描（所有页）")
+                    self.logger.info(f"{label}: 数据库中没有记录，将进行全量扫描（所有页）")
             else:
                 scan_mode = "initial_scan"
                 max_pages = initial_scan_pages
                 if self.logger:
-                    self.logger.info(f"数据库为空，将扫描前 {initial_scan_pages} 页")
+                    self.logger.info(f"{label}: 数据库中没有记录，将扫描前 {initial_scan_pages} 页")
         elif len(existing_gids) < MATCH_THRESHOLD:
             if initial_scan_pages == 0:
                 scan_mode = "full_scan"
                 max_pages = None
                 if self.logger:
-                    self.logger.info(f"数据库中只有 {len(existing_gids)} 个记录（少于{MATCH_THRESHOLD}个），将进行全量扫描")
+                    self.logger.info(f"{label}: 数据库中只有 {len(existing_gids)} 个记录（少于{MATCH_THRESHOLD}个），将进行全量扫描")
             else:
                 scan_mode = "initial_scan"
                 max_pages = initial_scan_pages
                 if self.logger:
-                    self.logger.info(f"数据库中只有 {len(existing_gids)} 个记录（少于{MATCH_THRESHOLD}个），将扫描前 {initial_scan_pages} 页")
+                    self.logger.info(f"{label}: 数据库中只有 {len(existing_gids)} 个记录（少于{MATCH_THRESHOLD}个），将扫描前 {initial_scan_pages} 页")
         else:
             scan_mode = "incremental"
             max_pages = None  # 增量扫描不限制页数，由匹配阈值控制
             if self.logger:
-                self.logger.info(f"数据库中有 {len(existing_gids)} 个记录，将进行增量扫描（连续匹配{MATCH_THRESHOLD}个时停止）")
+                self.logger.info(f"{label}: 数据库中有 {len(existing_gids)} 个记录，将进行增量扫描（连续匹配{MATCH_THRESHOLD}个时停止）")
         
-        # 从收藏夹首页开始, 强制按收藏时间排序
-        url = "https://exhentai.org/favorites.php?inline_set=fs_f"
+        # 从该分类的首页开始, 强制按收藏时间排序
+        url = f"https://exhentai.org/favorites.php?favcat={favcat}&inline_set=fs_f"
         page_count = 0
 
         while url and not stop_scanning:
             page_count += 1
             if self.logger:
-                self.logger.info(f"正在获取收藏夹页面 {page_count}: {url}")
+                self.logger.info(f"正在获取{label}页面 {page_count}: {url}")
             
             try:
                 response = self.session.get(url, allow_redirects=True, timeout=10)
                 if response.status_code != 200:
                     if self.logger:
                         self.logger.error(f"获取收藏夹页面失败: {url}, status_code: {response.status_code}")
+                    failed = True
                     break
                 
-                soup = BeautifulSoup(response.text, 'html.parser')
                 # 从页面中提取画廊信息
-                _, galleries_data = self._parse_favorites_page(soup)
+                _, galleries_data, next_url = self._parse_favorites_html(response.text)
                 
                 if galleries_data:
                     for gallery in galleries_data:
+                        # 按分类请求时页面中只有该分类的画廊
+                        if favcat != 'all':
+                            gallery['favcat'] = favcat
                         # 检查画廊是否属于指定的 favcat
                         if gallery.get('favcat') not in favcat_list:
                             continue
@@ -793,7 +886,7 @@ class EHentaiTools:
                         from utils import parse_gallery_url
                         gid, _ = parse_gallery_url(gallery.get('url', ''))
                         
-                        if scan_mode == "incremental" and existing_gids and gid:
+                        if scan_mode == "incremental" and gid:
                             # 增量扫描模式
                             if gid in existing_gids:
                                 consecutive_matches += 1
@@ -804,7 +897,7 @@ class EHentaiTools:
                                 if consecutive_matches >= MATCH_THRESHOLD:
                                     stop_scanning = True
                                     if self.logger:
-                                        self.logger.info(f"连续匹配 {MATCH_THRESHOLD} 个已存在的 GID，停止增量扫描。")
+                                        self.logger.info(f"{label}: 连续匹配 {MATCH_THRESHOLD} 个已存在的 GID，停止增量扫描。")
                                     break
                             else:
                                 # 遇到新画廊，重置计数器并添加
@@ -817,27 +910,29 @@ class EHentaiTools:
                 if stop_scanning:
                     break
                 
+                # 查找下一页链接
+                if not next_url:
+                    # 没有下一页了；增量模式只返回新画廊，不是完整列表
+                    complete = scan_mode != "incremental"
+                    break
+
                 # initial_scan 模式：检查是否达到页数限制
                 if scan_mode == "initial_scan" and max_pages is not None:
                     if page_count >= max_pages:
                         if self.logger:
-                            self.logger.info(f"已扫描 {page_count} 页，达到配置的页数限制，停止扫描。")
+                            self.logger.info(f"{label}: 已扫描 {page_count} 页，达到配置的页数限制，停止扫描。")
                         break
 
-                # 查找下一页链接
-                next_link = soup.select_one('div.searchnav a#dnext')
-                if next_link and next_link.get('href'):
-                    url = next_link['href']
-                    time.sleep(10) # 避免请求过于频繁
-                else:
-                    url = None # 没有下一页了
+                url = next_url
+                time.sleep(10) # 避免请求过于频繁
 
             except requests.RequestException as e:
                 if self.logger:
                     self.logger.error(f"获取收藏夹页面时发生网络错误: {url}, error: {e}")
+                failed = True
                 break
         
-        return all_galleries
+        return all_galleries, complete, failed
 
     def add_to_favorites(self, gid: int, token: str, favcat: str = '1', note: str = '') -> bool:
         """将画廊添加到收藏夹"""
@@ -922,7 +1017,7 @@ class EHentaiTools:
                     self.logger.error(f"获取 H@H 状态页面失败: status_code={response.status_code}")
                 return None
             
-            soup = BeautifulSoup(response.text, 'html.parser')
+            soup = make_soup(response.text)
             
             # 检查是否需要登录
             if 'login' in response.url.lower():
@@ -0,0 +1,131 @@
+import time
+import threading
+from concurrent.futures import Future
+
+
+API_URL = 'https://api.e-hentai.org/api.php'
+# gdata 单次请求最多支持的画廊数
+GDATA_MAX_BATCH = 25
+# 收集并发查询的时间窗口（秒），窗口内的查询合并为一次 gdata 请求
+BATCH_WINDOW = 0.2
+# 没有查询时后台线程的存活时间（秒）
+IDLE_TIMEOUT = 30
+
+
+class GDataError(Exception):
+    """gdata 请求失败或返回了错误"""
+
+
+class GDataBatcher:
+    """
+    E-Hentai gdata 批量查询客户端
+
+    get() / get_many() 把查询放入待发送队列，后台线程在 BATCH_WINDOW 内收集来自各线程的查询，
+    每 GDATA_MAX_BATCH 个 [gid, token] 合并为一次 gdata 请求，再把结果分发给各自的调用方。
+    同一画廊的并发查询只发送一次。请求通过传入的 session 发送，因此遵守 rate_limit 中
+    api.e-hentai.org 的限速设置。
+
+    返回的元数据为 gmetadata 中的单项；gid 或 token 无效时该项包含 error 字段。
+    """
+
+    def __init__(self, session, logger=None, window=BATCH_WINDOW, max_batch=GDATA_MAX_BATCH):
+        self.session = session
+        self.logger = logger
+        self.window = window
+        self.max_batch = max(1, min(int(max_batch), GDATA_MAX_BATCH))
+        self.cond = threading.Condition()
+        # (gid, token) -> Future，保持提交顺序
+        self.pending = {}
+        self.thread = None
+
+    def submit(self, gid, token):
+        """提交一个查询，返回 Future，结果为该画廊的元数据"""
+        key = (int(gid), str(token))
+        with self.cond:
+            future = self.pending.get(key)
+            if future is None:
+                future = Future()
+                self.pending[key] = future
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='ehentai-gdata', daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+        return future
+
+    def get(self, gid, token, timeout=None):
+        """查询单个画廊的元数据，失败时抛出 GDataError"""
+        return self.submit(gid, token).result(timeout)
+
+    def get_many(self, pairs, timeout=None):
+        """
+        查询多个画廊的元数据
+
+        Args:
+            pairs: [(gid, token), ...]
+
+        Returns:
+            {gid: 元数据}，所在批次请求失败的画廊不包含在结果中
+        """
+        futures = {int(gid): self.submit(gid, token) for gid, token in pairs}
+        results = {}
+        for gid, future in futures.items():
+            try:
+                results[gid] = future.result(timeout)
+            except GDataError as e:
+                if self.logger:
+                    self.logger.warning(f"获取画廊 {gid} 的元数据失败: {e}")
+        return results
+
+    def _run(self):
+        while True:
+            with self.cond:
+                idle_deadline = time.monotonic() + IDLE_TIMEOUT
+                while not self.pending:
+                    remaining = idle_deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.thread = None
+                        return
+                    self.cond.wait(remaining)
+
+                # 从第一个查询到达起等待 window 秒，或攒满一批后立即发送
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                keys = list(self.pending)[:self.max_batch]
+                batch = {key: self.pending.pop(key) for key in keys}
+            self._send(batch)
+
+    def _send(self, batch):
+        data = {
+            'method': 'gdata',
+            'gidlist': [[gid, token] for gid, token in batch],
+            'namespace': 1,
+        }
+        try:
+            response = self.session.post(API_URL, json=data, timeout=30)
+            if response.status_code != 200:
+                raise GDataError(f"HTTP {response.status_code}")
+            result = response.json()
+            if 'error' in result:
+                raise GDataError(result['error'])
+            gmetadata = {int(item['gid']): item for item in result.get('gmetadata', [])}
+        except Exception as e:
+            error = e if isinstance(e, GDataError) else GDataError(str(e))
+            if self.logger:
+                self.logger.error(f"gdata 请求失败（{len(batch)} 个画廊）: {error}")
+            for future in batch.values():
+                future.set_exception(error)
+            return
+
+        if self.logger:
+            self.logger.info(f"gdata 批量查询了 {len(batch)} 个画廊")
+        for (gid, _), future in batch.items():
+            item = gmetadata.get(gid)
+            if item is None:
+                future.set_exception(GDataError(f"gdata 响应中缺少画廊 {gid}"))
+            else:
+                future.set_result(item)
@@ -0,0 +1,226 @@
+import re
+
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    # 未安装 lxml 时回退到 BeautifulSoup 自带的 html.parser
+    lxml_html = None
+
+# BeautifulSoup 使用的解析器，lxml 比 html.parser 快数倍
+SOUP_FEATURES = 'lxml' if lxml_html is not None else 'html.parser'
+
+# 收藏夹页面的解析后端：lxml 直接用 XPath 提取需要的字段，soup 为 BeautifulSoup + CSS 选择器
+BACKEND_LXML = 'lxml'
+BACKEND_SOUP = 'soup'
+DEFAULT_BACKEND = BACKEND_LXML if lxml_html is not None else BACKEND_SOUP
+
+
+def make_soup(text):
+    """创建 BeautifulSoup 对象，安装了 lxml 时使用 lxml 解析器"""
+    return BeautifulSoup(text, SOUP_FEATURES)
+
+
+def _cls(*names):
+    """XPath 条件：元素的 class 包含全部 names（等价于 CSS 的 .a.b）"""
+    return ' and '.join(f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')" for name in names)
+
+
+def _first(element, path):
+    found = element.xpath(path)
+    return found[0] if found else None
+
+
+def _text(element):
+    """等价于 BeautifulSoup 的 get_text(strip=True)"""
+    return ''.join(part.strip() for part in element.itertext())
+
+
+def _raw_text(element):
+    """等价于 BeautifulSoup 的 .text"""
+    return ''.join(element.itertext())
+
+
+def _has_class(element, name):
+    return name in (element.get('class') or '').split()
+
+
+# 与 EHentaiTools.LAYOUT_SELECTORS 对应的 XPath，按相同顺序检测
+LAYOUT_XPATHS = {
+    "thumbnail": "//div[starts-with(@class, 'itg gld')]",
+    "minimal": "//table[starts-with(@class, 'itg gltm')]",
+    "compact": "//table[starts-with(@class, 'itg gltc')]",
+    "extended": "//table[starts-with(@class, 'itg glte')]",
+}
+
+
+def _posted(info, element, normalize_time):
+    time_text = _text(element)
+    info['posted_date'] = time_text
+    info['favcat_title'] = element.get('title', '')
+    info['added'] = normalize_time(time_text)
+
+
+def _extract_thumbnail(root, normalize_time):
+    galleries = []
+    for gallery in root.xpath(f"//div[{_cls('gl1t')}]"):
+        info = {}
+        title_element = _first(gallery, f".//a/span[{_cls('glink')}]")
+        if title_element is not None:
+            info['title'] = _text(title_element)
+            info['url'] = title_element.getparent().get('href')
+        thumb_element = _first(gallery, f".//div[{_cls('gl3t')}]//img")
+        if thumb_element is not None:
+            info['thumbnail_url'] = thumb_element.get('src')
+        for div in gallery.xpath(f".//div[{_cls('gl5t')}]/div/div"):
+            if _has_class(div, 'cs'):
+                info['category'] = _text(div)
+            elif div.get('id', '').startswith('posted_'):
+                _posted(info, div, normalize_time)
+            elif 'pages' in _text(div):
+                info['pages'] = _text(div)
+        info['tags'] = [tag.get('title', '') for tag in gallery.xpath(f".//div[{_cls('gl6t')}]/div[{_cls('gt')}]")]
+        galleries.append(info)
+    return galleries
+
+
+def _rows(root, table_prefix, first_cell):
+    return root.xpath(f"//table[starts-with(@class, '{table_prefix}')]//tr[.//td[{_cls(first_cell)}]]")
+
+
+def _thumb(info, row):
+    thumb_element = _first(row, f".//div[{_cls('glthumb')}]//img")
+    if thumb_element is not None:
+        info['thumbnail_url'] = thumb_element.get('data-src') or thumb_element.get('src')
+
+
+def _title(info, row, cell):
+    title_element = _first(row, f".//td[{_cls(cell)}]//a/div[{_cls('glink')}]")
+    if title_element is not None:
+        info['title'] = _text(title_element)
+        info['url'] = title_element.getparent().get('href')
+
+
+def _authors(info, tags):
+    authors = [_raw_text(tag) for tag in tags if tag.get('title', '').startswith('artist:')]
+    if authors:
+        info['author'] = ' / '.join(authors)
+
+
+def _extract_minimal(root, normalize_time):
+    galleries = []
+    for row in _rows(root, 'itg gltm', 'gl1m'):
+        info = {}
+        _title(info, row, 'gl3m')
+        _thumb(info, row)
+        category_element = _first(row, f".//td[{_cls('gl1m', 'glcat')}]/div[{_cls('cs')}]")
+        if category_element is not None:
+            info['category'] = _text(category_element)
+        posted_element = _first(row, f".//td[{_cls('gl2m')}]/div[starts-with(@id, 'posted_')]")
+        if posted_element is not None:
+            _posted(info, posted_element, normalize_time)
+        info['tags'] = [tag.get('title', '') for tag in row.xpath(f".//div[{_cls('gltm')}]/div[{_cls('gt')}]")]
+        galleries.append(info)
+    return galleries
+
+
+def _extract_compact(root, normalize_time):
+    galleries = []
+    for row in _rows(root, 'itg gltc', 'gl1c'):
+        info = {}
+        _title(info, row, 'gl3c')
+        _thumb(info, row)
+        category_element = _first(row, f".//td[{_cls('gl1c', 'glcat')}]/div[{_cls('cn')}]")
+        if category_element is not None:
+            info['category'] = _text(category_element)
+        posted_element = _first(row, f".//td[{_cls('gl2c')}]/div/div[starts-with(@id, 'posted_')]")
+        if posted_element is not None:
+            _posted(info, posted_element, normalize_time)
+        tags = row.xpath(f".//td[{_cls('gl3c', 'glname')}]//div[{_cls('gt')}]")
+        info['tags'] = [tag.get('title', '') for tag in tags]
+        _authors(info, tags)
+        galleries.append(info)
+    return galleries
+
+
+def _extract_extended(root, normalize_time):
+    galleries = []
+    for row in _rows(root, 'itg glte', 'gl1e'):
+        info = {}
+        link_element = _first(row, f".//td[{_cls('gl1e')}]//a")
+        if link_element is not None:
+            info['url'] = link_element.get('href')
+            thumb_element = _first(link_element, ".//img")
+            if thumb_element is not None:
+                info['title'] = thumb_element.get('title', '')
+                info['thumbnail_url'] = thumb_element.get('src')
+        category_element = _first(row, f".//div[{_cls('gl3e')}]//div[{_cls('cn')}]")
+        if category_element is not None:
+            info['category'] = _text(category_element)
+        posted_element = _first(row, ".//div[starts-with(@id, 'posted_')]")
+        if posted_element is not None:
+            _posted(info, posted_element, normalize_time)
+        tags = row.xpath(f".//div[{_cls('gl4e')}]//table//div[@title]")
+        info['tags'] = [tag.get('title', '') for tag in tags]
+        _authors(info, tags)
+        galleries.append(info)
+    return galleries
+
+
+EXTRACTORS = {
+    "thumbnail": _extract_thumbnail,
+    "minimal": _extract_minimal,
+    "compact": _extract_compact,
+    "extended": _extract_extended,
+}
+
+
+def parse_favcat_map(root):
+    """从收藏夹页面的分类列表中解析 {favcat ID: 名称}"""
+    favcat_map = {}
+    for element in root.xpath(f"//div[{_cls('nosel')}]//div[{_cls('fp')}][@onclick]"):
+        name_div = _first(element, ".//div[count(preceding-sibling::div) = 2]")
+        if name_div is None:
+            continue
+        match = re.search(r"favcat=(\d+)", element.get('onclick', ''))
+        if match:
+            favcat_map[match.group(1)] = _text(name_div)
+    return favcat_map
+
+
+def parse_favcat_count(texts):
+    """从分类按钮各个 div 的文本中找出画廊数量（如 '1,234'），没有时返回 None"""
+    for text in texts:
+        text = text.replace(',', '')
+        if text.isdigit():
+            return int(text)
+    return None
+
+
+def parse_favcat_counts(root):
+    """从收藏夹页面的分类列表中解析 {favcat ID: 画廊数量}"""
+    favcat_counts = {}
+    for element in root.xpath(f"//div[{_cls('nosel')}]//div[{_cls('fp')}][@onclick]"):
+        match = re.search(r"favcat=(\d+)", element.get('onclick', ''))
+        if not match:
+            continue
+        count = parse_favcat_count(_text(div) for div in element.xpath("./div"))
+        if count is not None:
+            favcat_counts[match.group(1)] = count
+    return favcat_counts
+
+
+def parse_favorites_page(text, normalize_time):
+    """
+    用 lxml 解析收藏夹页面，只提取需要的字段，结果与 EHentaiTools 的 BeautifulSoup 提取一致
+
+    Returns:
+        (layout, galleries, favcat_map, next_url)；galleries 中的 favcat 由调用方根据 favcat_map 填写
+    """
+    root = lxml_html.fromstring(text)
+    layout = next((name for name, path in LAYOUT_XPATHS.items() if root.xpath(path)), None)
+    galleries = EXTRACTORS[layout](root, normalize_time) if layout else []
+    next_link = _first(root, f"//div[{_cls('searchnav')}]//a[@id='dnext']")
+    next_url = next_link.get('href') if next_link is not None else None
+    return layout, galleries, parse_favcat_map(root), next_url or None
@@ -12,7 +12,9 @@ from providers.hdoujin_api import (
     login, auth_check, auth_refresh, clearance_check, _wrap_search_term,
     set_user_agent
 )
-from utils import check_dirs
+from utils import get_task_info
+from resumable import download_resumable
+from metadata_cache import metadata_cache
 
 class HDoujinTools:
     def __init__(self, session_token=None, refresh_token=None, clearance_token=None, user_agent=None, logger=None):
@@ -217,6 +219,12 @@ class HDoujinTools:
             gallery_id = match.group(1)
             gallery_key = match.group(2)
 
+            metadata = metadata_cache.get('hdoujin', gallery_id)
+            if metadata:
+                if self.logger:
+                    self.logger.info(f"使用缓存的 hdoujin 元数据: {gallery_id}")
+                return metadata
+
             # 获取详细书籍信息
             detail_result = books_get_detail(gallery_id, gallery_key, self.session_token)
             if detail_result.get('code') != 200 or 'body' not in detail_result:
@@ -268,15 +276,11 @@ class HDoujinTools:
                     namespace_name = namespace_map[namespace]
                     metadata['tags'].append(f"{namespace_name}:{name}")
 
-            # 保存元数据到文件
-            gmetadata = {"gmetadata": [metadata]}
-            metadata_dir = check_dirs('data/hdoujin/gmetadata/')
-            metadata_file = os.path.join(metadata_dir, f'{gallery_id}.json')
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(gmetadata, f, ensure_ascii=False, indent=4)
+            # 保存到元数据缓存
+            metadata_cache.put('hdoujin', gallery_id, metadata)
 
             if self.logger:
-                self.logger.info(f"hdoujin 元数据已保存: {metadata_file}")
+                self.logger.info(f"hdoujin 元数据已缓存: {gallery_id}")
 
             return metadata
 
@@ -324,53 +328,15 @@ class HDoujinTools:
                 self.logger.info(f"开始下载CBZ文件: {download_url}")
 
             # 检查任务取消状态
-            if task_id and tasks and tasks_lock:
-                with tasks_lock:
-                    task = tasks.get(task_id)
-                    if task and task.cancelled:
-                        return None
-
-            # 使用session下载文件
-            response = self.session.get(download_url, stream=True, timeout=60)
-            response.raise_for_status()
-
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded = 0
-
-            with open(path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    # 检查任务取消状态
-                    if task_id and tasks and tasks_lock:
-                        with tasks_lock:
-                            task = tasks.get(task_id)
-                            if task and task.cancelled:
-                                if self.logger:
-                                    self.logger.info(f"任务 {task_id} 被用户取消，正在清理文件")
-                                # 删除已下载的文件
-                                if os.path.exists(path):
-                                    os.remove(path)
-                                return None
-
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-
-                        # 更新进度信息
-                        if task_id and tasks and tasks_lock:
-                            progress = 0
-                            if total_size > 0:
-                                progress = min(100, int((downloaded / total_size) * 100))
-
-                            with tasks_lock:
-                                if task_id in tasks:
-                                    tasks[task_id].progress = progress
-                                    tasks[task_id].downloaded = downloaded
-                                    tasks[task_id].total_size = total_size
-                                    # 直接下载模式无法获取实时速度，设置为0
-                                    tasks[task_id].speed = 0
+            task = get_task_info(task_id, tasks, tasks_lock)
+            if task and task.cancel_event.is_set():
+                return None
+
+            # 使用session下载文件，写入 .part 临时文件，失败后重试可通过 Range 续传
+            if not download_resumable(self.session, download_url, path, self.logger, task_id, tasks, tasks_lock, timeout=60, provider='hdoujin'):
+                return None
 
             if self.logger:
-                self.logger.info(f"下载完成: {path}")
                 self.logger.info(f"hdoujin 画廊 {gallery_id} CBZ下载完成: {path}")
 
             return path
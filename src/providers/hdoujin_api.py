@@ -1,6 +1,8 @@
 from typing import Optional, Dict, Any
 import cloudscraper
 
+from ratelimit import rate_limiter
+
 
 API_BASE = "https://api.hdoujin.org"
 AUTH_BASE = "https://auth.hdoujin.org"
@@ -41,7 +43,7 @@ def _create_session() -> cloudscraper.CloudScraper:
         'Upgrade-Insecure-Requests': '1',
         'User-Agent': _user_agent
     })
-    return session
+    return rate_limiter.install(session)
 
 
 # 全局 session 实例（支持连接复用和 Cloudflare bypass）
@@ -5,16 +5,140 @@ import subprocess
 import tempfile
 import time
 import re
-from utils import check_dirs
+import threading
+from page_downloader import PageDownloader, DEFAULT_PAGE_CONCURRENCY, open_page
+from cbzstream import CbzStreamWriter
+from ratelimit import rate_limiter
+from bandwidth import bandwidth_limiter
+from metadata_cache import metadata_cache
+
+# gg.js 的刷新间隔（秒），期间所有任务共享同一份解析结果
+GG_REFRESH_INTERVAL = 60
+
+_gg_cache_lock = threading.Lock()
+_gg_cache = {'script': None, 'resolver': None, 'fetched_at': 0.0}
+
+# 图片 hash 的格式: 61 位 + 2 位 + 1 位十六进制
+_HASH_PATTERN = re.compile(r'([\da-f]{61})([\da-f]{2})([\da-f])')
+
+# gg.s() 的已知实现，去除空白后比较
+_GG_S_KNOWN = "function(h){varm=/(..)(.)$/.exec(h);returnparseInt(m[2]+m[1],16).toString(10);}"
+
+
+class GGResolver:
+    """gg.js 的 Python 实现：m() 转为查找表，b 为路径前缀，s() 为固定变换"""
+
+    def __init__(self, case_map, default, b):
+        self.case_map = case_map
+        self.default = default
+        self.b = b
+
+    @classmethod
+    def parse(cls, gg_script):
+        """解析 gg.js，格式无法识别时抛出 ValueError"""
+        default_match = re.search(r'(?:var\s|default:)\s*o\s*=\s*(\d+)', gg_script)
+        b_match = re.search(r'b:\s*["\']([^"\']+)["\']', gg_script)
+        s_match = re.search(r's:\s*(function\s*\(h\)\s*\{.*?\})\s*,?\s*(?:b:|m:|\};)', gg_script, re.S)
+        if not default_match or not b_match or not s_match:
+            raise ValueError("gg.js 缺少 m/b/s 定义")
+        if re.sub(r'\s+', '', s_match.group(1)) != _GG_S_KNOWN:
+            raise ValueError(f"未知的 gg.s 实现: {s_match.group(1)}")
+
+        # switch 形式: 连续的 case 共享其后的 o = N
+        case_map = {}
+        pending = []
+        for match in re.finditer(r'case\s+(\d+):(?:\s*o\s*=\s*(\d+))?', gg_script):
+            pending.append(int(match.group(1)))
+            if match.group(2) is not None:
+                value = int(match.group(2))
+                for key in pending:
+                    case_map[key] = value
+                pending = []
+        # if 形式: if (g === N) { o = V; }
+        for match in re.finditer(r'if\s*\(\s*g\s*===?\s*(\d+)\s*\)[\s{]*o\s*=\s*(\d+)', gg_script):
+            case_map[int(match.group(1))] = int(match.group(2))
+        if pending or not case_map:
+            raise ValueError("无法解析 gg.m 的 case 表")
+
+        b = b_match.group(1)
+        if not b.endswith('/'):
+            b += '/'
+        return cls(case_map, int(default_match.group(1)), b)
+
+    def m(self, g):
+        return self.case_map.get(g, self.default)
+
+    def s(self, h):
+        return str(int(h[-1] + h[-3:-1], 16))
+
+    def image_url(self, hash_value, domain):
+        match = _HASH_PATTERN.search(hash_value)
+        if not match:
+            raise ValueError(f"Invalid hash format: {hash_value}")
+        g = int(match.group(3) + match.group(2), 16)
+        return f"https://w{self.m(g) + 1}.{domain}/{self.b}{self.s(hash_value)}/{hash_value}.webp"
+
+    def image_urls(self, hashes, domain):
+        """批量计算，hash 格式无效的页面返回 None"""
+        urls = []
+        for h in hashes:
+            try:
+                urls.append(self.image_url(h, domain))
+            except ValueError:
+                urls.append(None)
+        return urls
+
+
+class NodeGGResolver:
+    """gg.js 格式变化时的回退方案：用 Node.js 执行原始脚本，每个画廊只启动一次进程"""
+
+    def __init__(self, gg_script):
+        self.gg_script = gg_script
+
+    def image_url(self, hash_value, domain):
+        url = self.image_urls([hash_value], domain)[0]
+        if url is None:
+            raise ValueError(f"Invalid hash format: {hash_value}")
+        return url
+
+    def image_urls(self, hashes, domain):
+        node_script = f"""
+    var gg;
+    {self.gg_script}
+    var hashes = {json.dumps(hashes)};
+    var urls = hashes.map(function(hash) {{
+        var m = /([\\da-f]{{61}})([\\da-f]{{2}})([\\da-f])/.exec(hash);
+        if (!m) return null;
+        var g = parseInt(m[3] + m[2], 16);
+        return "https://w" + (gg.m(g) + 1) + ".{domain}/" + gg.b + gg.s(hash) + "/" + hash + ".webp";
+    }});
+    console.log(JSON.stringify(urls));
+    """
+
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as f:
+            f.write(node_script)
+            temp_file = f.name
+
+        try:
+            result = subprocess.run(['node', temp_file], capture_output=True, text=True, timeout=60)
+            if result.returncode != 0:
+                raise ValueError(f"Node.js URL calculation failed: {result.stderr}")
+            return json.loads(result.stdout.strip())
+        finally:
+            os.unlink(temp_file)
+
 
 class HitomiTools:
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, page_concurrency=DEFAULT_PAGE_CONCURRENCY, stream_cbz=False):
         self.logger = logger
+        self.page_concurrency = page_concurrency
+        self.stream_cbz = stream_cbz
         self.domain = 'gold-usergeneratedcontent.net'
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
+        rate_limiter.install(self.session)
 
     def get_gallery_data(self, gallery_id):
         """获取完整的画廊元数据 - 模拟JS脚本的行为"""
@@ -58,104 +182,55 @@ class HitomiTools:
             raise ValueError(f"Failed to get gallery data: {e}")
 
     def get_gg_script(self):
-        """获取并执行GG脚本 - 使用Node.js正确执行"""
-        url = f"https://ltn.{self.domain}/gg.js?_={int(time.time()*1000)}"
+        """获取 GG 解析器 - 进程内缓存，gg.js 内容变化时才重新解析"""
+        now = time.time()
+        with _gg_cache_lock:
+            if _gg_cache['resolver'] is not None and now - _gg_cache['fetched_at'] < GG_REFRESH_INTERVAL:
+                return _gg_cache['resolver']
+
+        url = f"https://ltn.{self.domain}/gg.js?_={int(now*1000)}"
         try:
-            response = self.session.get(url)
+            response = self.session.get(url, timeout=30)
             response.raise_for_status()
-
             gg_script = response.text
-
-            # 创建临时Node.js脚本 - 先定义gg变量，然后执行脚本
-            node_script = f"""
-    var gg;
-    {gg_script}
-    console.log(JSON.stringify(gg));
-    """
-
-            # 使用Node.js执行脚本
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as f:
-                f.write(node_script)
-                temp_file = f.name
-
-            try:
-                result = subprocess.run(['node', temp_file], capture_output=True, text=True, timeout=10)
-                if result.returncode != 0:
-                    raise ValueError(f"Node.js execution failed: {result.stderr}")
-
-                gg_json = result.stdout.strip()
-                gg = json.loads(gg_json)
-
-                print(f"GG object from Node.js: {gg}")
-
-                # 检查GG对象 - 由于JSON序列化，函数会丢失，需要特殊处理
-                if 'b' not in gg:
-                    raise ValueError("GG object missing 'b' property")
-
-                # 保存GG脚本以供后续使用
-                self._gg_script = gg_script
-
-                # 由于函数无法JSON序列化，我们需要创建一个包装器来调用函数
-                gg_wrapper = {
-                    'b': gg['b'],
-                    'm': self.create_gg_function_caller('m', gg_script),
-                    's': self.create_gg_function_caller('s', gg_script)
-                }
-
-                return gg_wrapper
-
-            finally:
-                os.unlink(temp_file)
-
         except Exception as e:
+            # 刷新失败时继续使用上一次的解析结果
+            with _gg_cache_lock:
+                if _gg_cache['resolver'] is not None:
+                    if self.logger:
+                        self.logger.warning(f"刷新 gg.js 失败，继续使用缓存: {e}")
+                    return _gg_cache['resolver']
             raise ValueError(f"Failed to get GG script: {e}")
 
-    def calculate_image_url(self, file_info, gg):
-        """计算图片URL - 使用Node.js执行原始JS逻辑"""
-        hash_value = file_info['hash']
+        with _gg_cache_lock:
+            # 脚本未变化时直接复用已解析的结构
+            if _gg_cache['script'] == gg_script and _gg_cache['resolver'] is not None:
+                _gg_cache['fetched_at'] = now
+                return _gg_cache['resolver']
 
         try:
-            # 获取GG脚本（需要传递给这个方法）
-            gg_script = getattr(self, '_gg_script', None)
-            if not gg_script:
-                raise ValueError("GG script not available")
-
-            # 创建Node.js脚本来计算URL
-            node_script = f"""
-    var gg;
-    {gg_script}
-    var hash = "{hash_value}";
-
-    // 原始JS逻辑
-    var m = /([\\da-f]{{61}})([\\da-f]{{2}})([\\da-f])/.exec(hash);
-    if (!m) throw new Error("Invalid hash format: " + hash);
-
-    var g = parseInt(m[3] + m[2], 16);
-    var imageId = gg.s(hash);
-    var subdomain = gg.m(g) + 1;
-    var url = "https://w" + subdomain + ".{self.domain}/" + gg.b + imageId + "/" + hash + ".webp";
-
-    console.log(url);
-    """
-
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as f:
-                f.write(node_script)
-                temp_file = f.name
-
-            try:
-                result = subprocess.run(['node', temp_file], capture_output=True, text=True, timeout=10)
-                if result.returncode != 0:
-                    raise ValueError(f"Node.js URL calculation failed: {result.stderr}")
+            resolver = GGResolver.parse(gg_script)
+            if self.logger:
+                self.logger.info(f"gg.js 已解析: b={resolver.b}, {len(resolver.case_map)} 个 case, 默认值 {resolver.default}")
+        except ValueError as e:
+            # 脚本格式发生变化，回退到 Node.js 执行
+            if self.logger:
+                self.logger.warning(f"gg.js 格式无法识别，回退到 Node.js: {e}")
+            resolver = NodeGGResolver(gg_script)
 
-                url = result.stdout.strip()
-                return url
+        with _gg_cache_lock:
+            _gg_cache['script'] = gg_script
+            _gg_cache['resolver'] = resolver
+            _gg_cache['fetched_at'] = now
+        return resolver
 
-            finally:
-                os.unlink(temp_file)
+    def calculate_image_url(self, file_info, gg):
+        """计算单张图片URL"""
+        return gg.image_url(file_info['hash'], self.domain)
 
-        except Exception as e:
-            print(f"Error calculating URL for hash {hash_value}: {e}")
-            raise
+    def calculate_image_urls(self, files, gg):
+        """一次性计算画廊所有图片的URL"""
+        return gg.image_urls([file_info['hash'] for file_info in files], self.domain)
 
     def download_image(self, url, filename, referer):
         """下载单张图片"""
@@ -165,11 +240,12 @@ class HitomiTools:
 
         for attempt in range(3):
             try:
-                response = self.session.get(url, headers=headers, timeout=30)
-                response.raise_for_status()
+                with self.session.get(url, headers=headers, timeout=30, stream=True) as response:
+                    response.raise_for_status()
 
-                with open(filename, 'wb') as f:
-                    f.write(response.content)
+                    with open_page(filename) as f:
+                        for chunk in bandwidth_limiter.iter_content(response, 'hitomi'):
+                            f.write(chunk)
 
                 return True
             except Exception as e:
@@ -179,30 +255,6 @@ class HitomiTools:
 
         return False
 
-    def create_gg_function_caller(self, func_name, gg_script):
-        """创建GG函数调用器"""
-        def caller(arg):
-            node_script = f"""
-    var gg;
-    {gg_script}
-    console.log(gg.{func_name}({json.dumps(arg)}));
-    """
-
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as f:
-                f.write(node_script)
-                temp_file = f.name
-
-            try:
-                result = subprocess.run(['node', temp_file], capture_output=True, text=True, timeout=10)
-                if result.returncode != 0:
-                    raise ValueError(f"Node.js function call failed: {result.stderr}")
-
-                return int(result.stdout.strip())
-            finally:
-                os.unlink(temp_file)
-
-        return caller
-
     def download_gallery(self, url, output_dir, task_id=None, tasks=None, tasks_lock=None):
         """下载整个画廊"""
         try:
@@ -216,77 +268,51 @@ class HitomiTools:
             if not gallery_data:
                 return None
 
-            gallery_dir = output_dir
-            os.makedirs(gallery_dir, exist_ok=True)
-
-            # 获取GG脚本
+            sink = None
+            if self.stream_cbz:
+                # 流式打包：页面直接写入 CBZ，不落地到画廊目录
+                cbz_path = output_dir if output_dir.lower().endswith(('.cbz', '.zip')) else f"{output_dir}.cbz"
+                gallery_dir = os.path.dirname(cbz_path)
+                sink = CbzStreamWriter(cbz_path, self.logger)
+            else:
+                gallery_dir = output_dir
+                os.makedirs(gallery_dir, exist_ok=True)
+
+            # 获取GG解析器，并一次性计算所有图片URL
             gg = self.get_gg_script()
+            image_urls = self.calculate_image_urls(gallery_data['files'], gg)
 
             # 下载每张图片
             referer = f"https://hitomi.la/reader/{gallery_id}.html"
-            downloaded_files = []
             total_imgs = len(gallery_data['files'])
 
             if self.logger:
                 self.logger.info(f"开始下载 Hitomi 画廊 {gallery_id}，共 {total_imgs} 张图片")
 
-            for i, file_info in enumerate(gallery_data['files'], 1):
-                # 检查任务是否被取消
-                if task_id and tasks and tasks_lock:
-                    with tasks_lock:
-                        task = tasks.get(task_id)
-                        if task and task.cancelled:
-                            # 清理已下载的文件
-                            for file_path in downloaded_files:
-                                if os.path.exists(file_path):
-                                    os.remove(file_path)
-                            return None
-
-                try:
-                    # 计算图片URL
-                    image_url = self.calculate_image_url(file_info, gg)
-
-                    # 生成文件名
-                    ext = os.path.splitext(file_info['name'])[1] or '.webp'
-                    filename = f"{i:03d}{ext}"
-                    filepath = os.path.join(gallery_dir, filename)
+            def make_fetch(image_url):
+                return lambda filepath: self.download_image(image_url, filepath, referer)
 
+            pages = []
+            for i, (file_info, image_url) in enumerate(zip(gallery_data['files'], image_urls), 1):
+                if not image_url:
                     if self.logger:
-                        self.logger.info(f"下载图片 {i}/{total_imgs}: {filename}")
-
-                    # 下载图片
-                    if self.download_image(image_url, filepath, referer):
-                        downloaded_files.append(filepath)
-                    else:
-                        if self.logger:
-                            self.logger.error(f"图片 {i}/{total_imgs} 下载失败: {filename}")
-                        # 如果下载失败，退出整个下载过程
-                        if self.logger:
-                            self.logger.error(f"图片下载失败，退出下载过程")
-                        # 清理已下载的文件
-                        for file_path in downloaded_files:
-                            if os.path.exists(file_path):
-                                os.remove(file_path)
-                        return None
-
-                    # 更新进度
-                    if task_id and tasks and tasks_lock:
-                        with tasks_lock:
-                            if task_id in tasks:
-                                tasks[task_id].progress = int((i / total_imgs) * 100)
-
-                    # 添加延迟避免被限制
-                    time.sleep(0.5)
-
-                except Exception as e:
-                    if self.logger:
-                        self.logger.error(f"处理图片 {i} 时出错: {e}")
+                        self.logger.error(f"处理图片 {i} 时出错: Invalid hash format: {file_info.get('hash')}")
                     continue
 
+                # 生成文件名
+                ext = os.path.splitext(file_info['name'])[1] or '.webp'
+                filename = f"{i:03d}{ext}"
+                pages.append((os.path.join(gallery_dir, filename), make_fetch(image_url)))
+
+            downloader = PageDownloader(self.page_concurrency, self.logger, task_id, tasks, tasks_lock)
+            downloaded_files = downloader.run(pages, gallery_dir, sink)
+            if downloaded_files is None:
+                return None
+
             if self.logger:
                 self.logger.info(f"Hitomi 画廊 {gallery_id} 下载完成，共下载 {len(downloaded_files)}/{total_imgs} 张图片")
 
-            return gallery_dir
+            return sink.path if sink else gallery_dir
 
         except Exception as e:
             if self.logger:
@@ -317,6 +343,12 @@ class HitomiTools:
             if not gallery_id:
                 return None
 
+            metadata = metadata_cache.get('hitomi', gallery_id)
+            if metadata:
+                if self.logger:
+                    self.logger.info(f"使用缓存的 Hitomi 元数据: {gallery_id}")
+                return metadata
+
             # 获取完整的画廊数据
             galleryinfo = self.get_gallery_data(gallery_id)
             if not galleryinfo:
@@ -377,16 +409,11 @@ class HitomiTools:
                 'tags': tags
             }
 
-            gmetadata = {"gmetadata": [metadata]}
-
             if self.logger:
-                self.logger.info(f"Hitomi metadata: {json.dumps(gmetadata, ensure_ascii=False)}")
+                self.logger.info(f"Hitomi metadata: {json.dumps(metadata, ensure_ascii=False)}")
 
-            # 保存元数据
-            metadata_dir = check_dirs('data/hitomi/gmetadata/')
-            metadata_file = os.path.join(metadata_dir, f'{gallery_id}.json')
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(gmetadata, f, ensure_ascii=False, indent=4)
+            # 保存到元数据缓存
+            metadata_cache.put('hitomi', gallery_id, metadata)
 
             return metadata
 
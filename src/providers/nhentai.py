@@ -1,10 +1,14 @@
 import cloudscraper
 import re
-import json
 import os
 import time
 import urllib.parse
-from utils import check_dirs
+from utils import get_task_info
+from page_downloader import PageDownloader, DEFAULT_PAGE_CONCURRENCY, open_page, discard_page
+from cbzstream import CbzStreamWriter
+from ratelimit import rate_limiter
+from bandwidth import bandwidth_limiter
+from metadata_cache import metadata_cache
 
 def try_n(retries):
     def decorator(func):
@@ -112,22 +116,9 @@ def _parse_gallery(gal):
 
     return Info(host, id, id_media, title, title_jpn, artists, groups, series, characters, tags, lang, category, page_paths)
 
-_nhentai_last_api_call = 0.0
-_nhentai_min_interval = 2.1  # 30/min -> 2 sec, use 2.1 for安全余量
-
-
-def _wait_nhentai_rate_limit():
-    global _nhentai_last_api_call
-    now = time.time()
-    elapsed = now - _nhentai_last_api_call
-    if elapsed < _nhentai_min_interval:
-        time.sleep(_nhentai_min_interval - elapsed)
-    _nhentai_last_api_call = time.time()
-
-
 def _nhentai_get_with_rate_limit(session, url, **kwargs):
+    # 请求频率由 session 上挂载的全局限速器控制 (rate_limit.hosts.nhentai.net)
     for attempt in range(4):
-        _wait_nhentai_rate_limit()
         response = session.get(url, **kwargs)
         if response.status_code == 429:
             backoff = (2 ** attempt)
@@ -177,8 +168,10 @@ def get_imgs(id, session):
         return None, []
 
 class NHentaiTools:
-    def __init__(self, cookie=None, logger=None):
+    def __init__(self, cookie=None, logger=None, page_concurrency=DEFAULT_PAGE_CONCURRENCY, stream_cbz=False):
         self.logger = logger
+        self.page_concurrency = page_concurrency
+        self.stream_cbz = stream_cbz
         self.session = self._create_session(delay=5)
         if cookie:
             self.session.cookies.update(cookie)
@@ -198,7 +191,7 @@ class NHentaiTools:
             'Upgrade-Insecure-Requests': '1',
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
         })
-        return session
+        return rate_limiter.install(session)
 
     def search_by_title(self, title, original_title=None, language=None):
         """根据标题搜索 nhentai 画廊"""
@@ -272,18 +265,15 @@ class NHentaiTools:
             if self.logger:
                 self.logger.debug(f"开始下载: {url} ==> {path}")
 
+            task = get_task_info(task_id, tasks, tasks_lock)
             with self.session.get(url, stream=True, timeout=self.timeout, headers=request_headers) as r:
                 r.raise_for_status()
-                with open(path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        # 只有在有任务参数时才检查任务取消状态，避免不必要的开销
-                        if task_id and tasks and tasks_lock:
-                            with tasks_lock:
-                                task = tasks.get(task_id)
-                                if task and task.cancelled:
-                                    if os.path.exists(path):
-                                        os.remove(path)
-                                    raise Exception("Task was cancelled by user")
+                with open_page(path) as f:
+                    for chunk in bandwidth_limiter.iter_content(r, 'nhentai', chunk_size=8192):
+                        # 取消标志是任务独立的 Event，检查时不需要加锁
+                        if task and task.cancel_event.is_set():
+                            discard_page(path)
+                            raise Exception("Task was cancelled by user")
                         if chunk:
                             f.write(chunk)
 
@@ -343,6 +333,10 @@ class NHentaiTools:
             gallery_id = get_id(url)
             if not gallery_id:
                 return None
+            metadata = metadata_cache.get('nhentai', gallery_id)
+            if metadata:
+                if self.logger: self.logger.info(f"使用缓存的 nhentai 元数据: {gallery_id}")
+                return metadata
             info = get_info(gallery_id, self.session)
             if not info:
                 return None
@@ -368,12 +362,8 @@ class NHentaiTools:
                 metadata['tags'].append(f"language:{info.lang}")
             if info.category:
                 metadata['tags'].append(f"category:{info.category}")
-            gmetadata = {"gmetadata": [metadata]}
-            if self.logger: self.logger.info(gmetadata)
-            metadata_dir = check_dirs('data/nhentai/gmetadata/')
-            metadata_file = os.path.join(metadata_dir, f'{gallery_id}.json')
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(gmetadata, f, ensure_ascii=False, indent=4)
+            if self.logger: self.logger.info(metadata)
+            metadata_cache.put('nhentai', gallery_id, metadata)
             return metadata
         except Exception as e:
             return None
@@ -387,52 +377,36 @@ class NHentaiTools:
             info, imgs = get_imgs(gallery_id, self.session)
             if not info or not imgs:
                 return None
-            gallery_dir = output_dir
-            os.makedirs(gallery_dir, exist_ok=True)
-            downloaded_files = []
+            sink = None
+            if self.stream_cbz:
+                # 流式打包：页面直接写入 CBZ，不落地到画廊目录
+                cbz_path = output_dir if output_dir.lower().endswith(('.cbz', '.zip')) else f"{output_dir}.cbz"
+                gallery_dir = os.path.dirname(cbz_path)
+                sink = CbzStreamWriter(cbz_path, self.logger)
+            else:
+                gallery_dir = output_dir
+                os.makedirs(gallery_dir, exist_ok=True)
             total_imgs = len(imgs)
             if self.logger:
                 self.logger.info(f"开始下载 nhentai 画廊 {gallery_id}，共 {total_imgs} 张图片")
-            for i, img in enumerate(imgs, 1):
-                if task_id and tasks and tasks_lock:
-                    with tasks_lock:
-                        task = tasks.get(task_id)
-                        if task and task.cancelled:
-                            for file_path in downloaded_files:
-                                if os.path.exists(file_path):
-                                    os.remove(file_path)
-                            return None
-                headers = {'Referer': img.referer}
-                img_path = os.path.join(gallery_dir, img.name)
-                # 使用统一的备用URL尝试方法
-                if hasattr(img, 'possible_urls') and img.possible_urls:
-                    success = self._try_backup_urls(img.url, img.possible_urls, img_path, headers, task_id, tasks, tasks_lock)
-                else:
-                    success = self._download_with_referer(img.url, img_path, headers, task_id, tasks, tasks_lock)
 
-                if success:
-                    downloaded_files.append(img_path)
-                    if self.logger:
-                        self.logger.info(f"图片 {i}/{total_imgs} 下载成功: {img.name}")
-                else:
-                    if self.logger:
-                        self.logger.error(f"图片 {i}/{total_imgs} 所有链接下载失败: {img.name}")
-                    # 如果下载失败，退出整个下载过程
-                    if self.logger:
-                        self.logger.error(f"图片下载失败，退出下载过程")
-                    # 清理已下载的文件
-                    for file_path in downloaded_files:
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                    return None
-                if task_id and tasks and tasks_lock:
-                    with tasks_lock:
-                        if task_id in tasks:
-                            tasks[task_id].progress = int((i / total_imgs) * 100)
-                time.sleep(0.5)
+            def make_fetch(img):
+                headers = {'Referer': img.referer}
+                def fetch(img_path):
+                    # 使用统一的备用URL尝试方法
+                    if hasattr(img, 'possible_urls') and img.possible_urls:
+                        return self._try_backup_urls(img.url, img.possible_urls, img_path, headers, task_id, tasks, tasks_lock)
+                    return self._download_with_referer(img.url, img_path, headers, task_id, tasks, tasks_lock)
+                return fetch
+
+            pages = [(os.path.join(gallery_dir, img.name), make_fetch(img)) for img in imgs]
+            downloader = PageDownloader(self.page_concurrency, self.logger, task_id, tasks, tasks_lock)
+            downloaded_files = downloader.run(pages, gallery_dir, sink)
+            if downloaded_files is None:
+                return None
             if self.logger:
                 self.logger.info(f"nhentai 画廊 {gallery_id} 下载完成，共下载 {len(downloaded_files)}/{total_imgs} 张图片")
-            return gallery_dir
+            return sink.path if sink else gallery_dir
         except Exception as e:
             if self.logger:
                 self.logger.error(f"下载 nhentai 画廊失败: {e}")
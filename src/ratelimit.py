@@ -0,0 +1,335 @@
+import re
+import threading
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+# 触发降速的状态码
+THROTTLE_STATUS = (429, 503)
+
+# 未在配置中列出的主机的默认并发上限
+DEFAULT_HOST_CONCURRENCY = 8
+
+_RATE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*/\s*(\d*)\s*([smhd])\w*\s*$', re.IGNORECASE)
+_UNIT_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(value):
+    """
+    解析速率字符串为每秒请求数，如 '30/m' -> 0.5, '5/s' -> 5, '100/10m' -> 0.1667
+    空值或 0 表示不限速，返回 None
+    """
+    if value in (None, '', 0, False):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) if value > 0 else None
+    match = _RATE_PATTERN.match(str(value))
+    if not match:
+        raise ValueError(f"无法解析速率: {value}，格式应为 数量/单位，如 30/m")
+    count, multiplier, unit = match.groups()
+    period = (int(multiplier) if multiplier else 1) * _UNIT_SECONDS[unit.lower()]
+    rate = float(count) / period
+    return rate if rate > 0 else None
+
+
+class TokenBucket:
+    """线程安全的令牌桶，acquire 采用预约方式，多个线程按到达顺序排队"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def configure(self, rate, burst=1):
+        with self.lock:
+            self.rate = rate
+            self.capacity = max(1.0, float(burst))
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _reserve(self, tokens=1):
+        """预约 tokens 个令牌，返回需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= tokens
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def acquire(self, tokens=1):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD 并发控制器：
+    - 正常响应时每次增加 1/limit（约每轮并发 +1）
+    - 遇到 429/503 时并发减半，同一冷却期内只减一次
+    """
+
+    def __init__(self, max_limit, min_limit=1, cooldown=2.0):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = float(self.max_limit)
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def configure(self, max_limit):
+        with self.cond:
+            self.max_limit = max(1, int(max_limit))
+            self.min_limit = min(self.min_limit, self.max_limit)
+            self.limit = min(self.limit, float(self.max_limit))
+            self.cond.notify_all()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def on_success(self):
+        with self.cond:
+            if self.limit < self.max_limit:
+                previous = int(self.limit)
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+                if int(self.limit) > previous:
+                    self.cond.notify_all()
+
+    def on_throttle(self):
+        """返回是否实际降低了并发"""
+        with self.cond:
+            now = time.monotonic()
+            if now - self.last_decrease < self.cooldown:
+                return False
+            self.last_decrease = now
+            self.limit = max(float(self.min_limit), self.limit / 2)
+            return True
+
+
+class HostLimiter:
+    """单个主机（或主机通配规则）的限速器：令牌桶 + 自适应并发 + Retry-After 退避"""
+
+    def __init__(self, name, rate=None, burst=1, concurrency=DEFAULT_HOST_CONCURRENCY):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.concurrency = AdaptiveConcurrency(concurrency)
+        # 服务器通过 Retry-After 要求退避时，在此时间之前不发起新请求（与是否配置了速率无关）
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def configure(self, rate=None, burst=1, concurrency=DEFAULT_HOST_CONCURRENCY):
+        if rate is None:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate, burst)
+        else:
+            self.bucket.configure(rate, burst)
+        self.concurrency.configure(concurrency)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_if_paused(self):
+        wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_throttle(self, retry_after=None):
+        decreased = self.concurrency.on_throttle()
+        if retry_after:
+            self.pause(retry_after)
+        return decreased
+
+
+class _SlotRelease:
+    """只释放一次的并发名额：流式响应在 close() 或响应对象被回收时释放"""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.released = False
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.concurrency.release()
+
+
+def _hold_until_closed(response, release):
+    """流式响应的正文在 send() 返回后才传输，名额保持到响应关闭；未关闭的响应在被回收时释放"""
+    close = response.close
+
+    def closing():
+        try:
+            close()
+        finally:
+            release()
+
+    response.close = closing
+    weakref.finalize(response, release)
+
+
+def _parse_retry_after(response):
+    """解析 Retry-After：秒数或 HTTP 日期"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiterRegistry:
+    """
+    进程级的按主机限速器注册表，所有 provider 的 session 共享
+
+    配置示例 (config.yaml):
+        rate_limit:
+          default_concurrency: 8
+          hosts:
+            nhentai.net: 30/m
+            '*.nhentai.net': {rate: 5/s, burst: 2, concurrency: 4}
+
+    先按主机名精确匹配，再按 '*.域名' 通配规则匹配最长后缀，均未命中时只做自适应并发控制。
+    并发名额覆盖整个传输过程：stream=True 的请求在响应关闭（或被回收）时才释放名额。
+    429/503 响应带有 Retry-After 时，该主机的所有请求都暂停到指定时间之后。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules = {}
+        self.limiters = {}
+        self.default_concurrency = DEFAULT_HOST_CONCURRENCY
+        self.logger = None
+        self.local = threading.local()
+
+    def configure(self, config, logger=None):
+        """根据 rate_limit 配置段更新规则，已存在的限速器原地更新"""
+        config = config or {}
+        rules = {}
+        for pattern, spec in (config.get('hosts') or {}).items():
+            try:
+                if isinstance(spec, dict):
+                    rule = {
+                        'rate': parse_rate(spec.get('rate')),
+                        'burst': float(spec.get('burst') or 1),
+                        'concurrency': int(spec.get('concurrency') or config.get('default_concurrency') or DEFAULT_HOST_CONCURRENCY),
+                    }
+                else:
+                    rule = {
+                        'rate': parse_rate(spec),
+                        'burst': 1,
+                        'concurrency': int(config.get('default_concurrency') or DEFAULT_HOST_CONCURRENCY),
+                    }
+            except (ValueError, TypeError) as e:
+                if logger:
+                    logger.error(f"rate_limit.hosts.{pattern} 配置无效，已忽略: {e}")
+                continue
+            rules[str(pattern).lower()] = rule
+
+        try:
+            default_concurrency = int(config.get('default_concurrency') or DEFAULT_HOST_CONCURRENCY)
+        except (ValueError, TypeError):
+            default_concurrency = DEFAULT_HOST_CONCURRENCY
+
+        with self.lock:
+            self.rules = rules
+            self.default_concurrency = default_concurrency
+            self.logger = logger
+            for key, limiter in self.limiters.items():
+                limiter.configure(**self._rule_for(key))
+
+    def _match(self, host):
+        """返回命中的规则名：精确主机名 > 最长的通配后缀 > 主机名本身"""
+        if host in self.rules:
+            return host
+        best = None
+        for pattern in self.rules:
+            if pattern.startswith('*.') and host.endswith(pattern[1:]):
+                if best is None or len(pattern) > len(best):
+                    best = pattern
+        return best or host
+
+    def _rule_for(self, key):
+        return self.rules.get(key) or {'rate': None, 'burst': 1, 'concurrency': self.default_concurrency}
+
+    def get(self, host):
+        host = (host or '').lower()
+        with self.lock:
+            key = self._match(host)
+            limiter = self.limiters.get(key)
+            if limiter is None:
+                limiter = HostLimiter(key, **self._rule_for(key))
+                self.limiters[key] = limiter
+            return limiter
+
+    def request(self, send, method, url, *args, **kwargs):
+        """在限速器控制下执行一次请求，send 为原始的 session.request"""
+        limiter = self.get(urlsplit(url).hostname)
+        # cloudscraper 处理验证时会在同一线程内递归发起请求，此时不再重复占用并发名额
+        nested = getattr(self.local, 'depth', 0) > 0
+        limiter.wait_if_paused()
+        release = None
+        if not nested:
+            limiter.concurrency.acquire()
+            release = _SlotRelease(limiter.concurrency)
+        self.local.depth = getattr(self.local, 'depth', 0) + 1
+        response = None
+        try:
+            if limiter.bucket:
+                limiter.bucket.acquire()
+            response = send(method, url, *args, **kwargs)
+        finally:
+            self.local.depth -= 1
+            if release:
+                if response is not None and kwargs.get('stream'):
+                    _hold_until_closed(response, release)
+                else:
+                    release()
+
+        if response.status_code in THROTTLE_STATUS:
+            retry_after = _parse_retry_after(response)
+            if limiter.on_throttle(retry_after) and self.logger:
+                self.logger.warning(
+                    f"{limiter.name} 返回 {response.status_code}，并发降至 {int(limiter.concurrency.limit)}"
+                    + (f"，暂停 {retry_after:.0f} 秒" if retry_after else "")
+                )
+        else:
+            limiter.concurrency.on_success()
+        return response
+
+    def install(self, session):
+        """为 requests/cloudscraper session 挂载限速，重复调用无副作用"""
+        if getattr(session, '_rate_limited', False):
+            return session
+        send = session.request
+
+        def limited_request(method, url, *args, **kwargs):
+            return self.request(send, method, url, *args, **kwargs)
+
+        session.request = limited_request
+        session._rate_limited = True
+        return session
+
+
+# 全局实例
+rate_limiter = RateLimiterRegistry()
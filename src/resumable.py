@@ -0,0 +1,177 @@
+import os
+import json
+
+from utils import get_task_info
+from transfer_meter import TransferMeter, format_speed
+from bandwidth import bandwidth_limiter
+
+# .part 文件的侧车元数据后缀
+SIDECAR_SUFFIX = '.part.json'
+# 每写入多少字节刷新一次侧车文件
+SIDECAR_FLUSH_BYTES = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def part_paths(path):
+    """返回 (.part 文件路径, 侧车文件路径)"""
+    return f"{path}.part", f"{path}{SIDECAR_SUFFIX}"
+
+
+def _load_sidecar(sidecar_path):
+    try:
+        with open(sidecar_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return meta if isinstance(meta, dict) else None
+    except (OSError, ValueError):
+        return None
+
+
+def _save_sidecar(sidecar_path, meta):
+    tmp_path = f"{sidecar_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, sidecar_path)
+
+
+def discard_partial(path):
+    """删除 path 对应的 .part 文件和侧车文件"""
+    for p in part_paths(path):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def _total_from_response(response, offset):
+    """从响应头推算文件总大小，未知时返回 0"""
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[-1].strip()
+        if total.isdigit():
+            return int(total)
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit():
+        return int(length) + (offset if response.status_code == 206 else 0)
+    return 0
+
+
+def _range_start(response):
+    """解析 206 响应 Content-Range 的起始偏移"""
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        return int(content_range.split(' ', 1)[1].split('-', 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def download_resumable(session, url, path, logger=None, task_id=None, tasks=None, tasks_lock=None, timeout=30, provider=None):
+    """
+    可断点续传的文件下载
+
+    数据先写入 path.part，侧车文件 path.part.json 记录 URL、ETag/Last-Modified 和已写入字节数。
+    再次下载时如果存在 .part 文件，则通过 Range + If-Range 续传；服务器不支持或文件已变更时从头下载。
+    网络异常时保留 .part 以便重试续传，用户取消时删除。
+    读取的数据受 bandwidth_limiter 的全局限速和 provider 限速控制。
+
+    返回 path，失败或被取消时返回 None
+    """
+    part_path, sidecar_path = part_paths(path)
+    task = get_task_info(task_id, tasks, tasks_lock)
+    meta = _load_sidecar(sidecar_path) if os.path.exists(part_path) else None
+    offset = os.path.getsize(part_path) if meta else 0
+
+    headers = {}
+    validator = None
+    if meta and offset > 0:
+        validator = meta.get('etag') or meta.get('last_modified')
+        # 没有校验值时只在 URL 相同的情况下续传
+        if validator or meta.get('url') == url:
+            headers['Range'] = f'bytes={offset}-'
+            if validator:
+                headers['If-Range'] = validator
+        else:
+            offset = 0
+
+    try:
+        with session.get(url, stream=True, timeout=timeout, headers=headers) as r:
+            if r.status_code == 416 and meta and offset and offset == meta.get('total_size'):
+                # .part 已经完整，只差重命名
+                if logger:
+                    logger.info(f"检测到已完整下载的临时文件: {part_path}")
+                os.replace(part_path, path)
+                discard_partial(path)
+                return path
+            r.raise_for_status()
+
+            resumed = r.status_code == 206 and offset > 0 and _range_start(r) == offset
+            if not resumed:
+                offset = 0
+            total_size = _total_from_response(r, offset)
+            if resumed and meta.get('total_size') and total_size and meta['total_size'] != total_size:
+                # 文件大小发生变化，说明服务端内容已不同，重新下载
+                if logger:
+                    logger.warning("远程文件大小已变化，放弃续传并重新下载")
+                r.close()
+                discard_partial(path)
+                return download_resumable(session, url, path, logger, task_id, tasks, tasks_lock, timeout, provider)
+
+            if logger:
+                if resumed:
+                    logger.info(f"从 {offset} 字节处续传: {path}")
+                elif headers.get('Range'):
+                    logger.info(f"服务器不支持续传或文件已变更，从头下载: {path}")
+
+            meta = {
+                'url': url,
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'total_size': total_size,
+                'bytes': offset,
+            }
+            _save_sidecar(sidecar_path, meta)
+
+            downloaded = offset
+            unflushed = 0
+            meter = TransferMeter(task, total_size=total_size, downloaded=offset)
+            try:
+                with open(part_path, 'ab' if resumed else 'wb') as f:
+                    for chunk in bandwidth_limiter.iter_content(r, provider, chunk_size=CHUNK_SIZE):
+                        # 检查任务是否被取消
+                        if task and task.cancel_event.is_set():
+                            if logger:
+                                logger.info(f"任务 {task_id} 被用户取消，正在清理文件")
+                            f.close()
+                            discard_partial(path)
+                            meta = None
+                            return None
+
+                        if not chunk:
+                            continue
+                        f.write(chunk)
+                        downloaded += len(chunk)
+                        unflushed += len(chunk)
+
+                        if unflushed >= SIDECAR_FLUSH_BYTES:
+                            f.flush()
+                            meta['bytes'] = downloaded
+                            _save_sidecar(sidecar_path, meta)
+                            unflushed = 0
+
+                        # 更新进度、速度和剩余时间（按间隔节流）
+                        meter.add(len(chunk))
+            finally:
+                meter.finish()
+                if meta is not None and os.path.exists(part_path):
+                    meta['bytes'] = os.path.getsize(part_path)
+                    _save_sidecar(sidecar_path, meta)
+
+        if total_size and downloaded < total_size:
+            raise IOError(f"下载不完整: {downloaded}/{total_size} 字节，已保留临时文件以便续传")
+
+        os.replace(part_path, path)
+        discard_partial(path)
+        if logger:
+            logger.info(f"下载完成: {path} (平均 {format_speed(meter.average_speed)})")
+        return path
+    except Exception as e:
+        if logger:
+            logger.error(f"下载失败: {e}")
+        return None
@@ -22,6 +22,10 @@ def download_url():
             - true/t/1/y/yes: 添加到收藏夹 0
             - 0-9: 添加到指定收藏夹
             - false/其他: 不添加到收藏夹
+        priority: 排队优先级（可选）
+            - manual: 手动下载（默认）
+            - rss: RSS 订阅触发
+            - favorites: 收藏夹自动下载
     
     返回:
         200: 任务已存在（已完成或进行中）
@@ -34,6 +38,7 @@ def download_url():
         url = request.args.get('url')
         mode = request.args.get('mode')
         fav_param = request.args.get('fav', 'false').lower()
+        priority = request.args.get('priority')
         
         # 新的 fav 参数处理逻辑
         # 如果是 true, t, 1, y, yes -> '0'
@@ -52,9 +57,9 @@ def download_url():
         # 从 current_app.config 获取共享对象
         tasks = current_app.config.get('TASKS', {})
         tasks_lock = current_app.config.get('TASKS_LOCK')
-        executor = current_app.config.get('EXECUTOR')
+        scheduler = current_app.config.get('DOWNLOAD_SCHEDULER')
         
-        if not executor or not tasks_lock:
+        if not scheduler or not tasks_lock:
             return json_response({'error': 'Server not properly initialized'}), 500
         
         # 导入必要的模块
@@ -136,23 +141,22 @@ def download_url():
         # 两位年份+月日时分秒，使用UTC时间避免时区问题
         task_id = datetime.now(timezone.utc).strftime('%y%m%d%H%M%S%f')
         
-        # 从 current_app.config 获取函数和类
-        get_task_logger = current_app.config.get('GET_TASK_LOGGER')
-        task_failure_processing = current_app.config.get('TASK_FAILURE_PROCESSING')
-        download_gallery_task = current_app.config.get('DOWNLOAD_GALLERY_TASK')
-        TaskInfo = current_app.config.get('TASK_INFO_CLASS')
-        
-        if not all([get_task_logger, task_failure_processing, download_gallery_task, TaskInfo]):
+        submit_download_task = current_app.config.get('SUBMIT_DOWNLOAD_TASK')
+        if not submit_download_task:
             return json_response({'error': 'Server functions not properly initialized'}), 500
-        
-        logger, log_buffer = get_task_logger(task_id)
-        
-        # 动态应用装饰器
-        decorated_download_task = task_failure_processing(url, task_id, logger, tasks, tasks_lock)(download_gallery_task)
-        
-        future = executor.submit(decorated_download_task, url, mode, task_id, logger, favcat, tasks, tasks_lock)
-        with tasks_lock:
-            tasks[task_id] = TaskInfo(future, logger, log_buffer)
+
+        # 排队并写入持久化队列，重启后会自动恢复
+        # 同一画廊已有排队中或执行中的任务时（并发的重复请求），直接返回已有任务
+        owner_id = submit_download_task(task_id, url, mode=mode, favcat=favcat, priority=priority)
+        if owner_id != task_id:
+            return json_response({
+                'message': 'Task already exists',
+                'task_id': owner_id,
+                'status': TaskStatus.IN_PROGRESS,
+                'reason': 'in_progress',
+                'url': url,
+                'queue_position': scheduler.queue_position(owner_id)
+            }), 200
 
         # 添加任务到数据库，包含URL、mode和favcat信息用于重试
         # 将 favcat 转换为字符串存储（False -> None）
@@ -165,12 +169,14 @@ def download_url():
                 'message': f'Previous task {existing_status}, retrying with new task ID {task_id}',
                 'task_id': task_id,
                 'previous_task_id': previous_task_id,
-                'retried': True
+                'retried': True,
+                'queue_position': scheduler.queue_position(task_id)
             }), 202
         else:
             return json_response({
                 'message': f"Download task for {url} started with task ID {task_id}.",
-                'task_id': task_id
+                'task_id': task_id,
+                'queue_position': scheduler.queue_position(task_id)
             }), 202
 
     except Exception as e:
@@ -6,6 +6,7 @@ Task 相关路由
 from flask import Blueprint, current_app, request
 import sqlite3
 from utils import json_response
+from metadata_cache import metadata_cache
 
 # 创建 Blueprint 实例
 bp = Blueprint('task', __name__)
@@ -52,7 +53,9 @@ def get_task_stats():
                 'completed': completed,
                 'cancelled': cancelled,
                 'failed': failed,
-                'status_counts': status_counts
+                'status_counts': status_counts,
+                'queue': current_app.config['DOWNLOAD_SCHEDULER'].snapshot() if current_app.config.get('DOWNLOAD_SCHEDULER') else None,
+                'metadata_cache': metadata_cache.stats()
             })
 
     except sqlite3.Error as e:
@@ -142,22 +145,15 @@ def get_task(task_id):
         if not tasks_lock:
             return json_response({'error': 'Server not properly initialized'}), 500
 
-        # 首先检查内存中的任务
+        # 首先检查内存中的任务，只在查找时持有锁，读取快照不阻塞工作线程
         with tasks_lock:
             memory_task = tasks.get(task_id)
-            if memory_task:
-                task_data = {
-                    'id': task_id,
-                    'status': memory_task.status,
-                    'error': memory_task.error,
-                    'filename': memory_task.filename,
-                    'progress': memory_task.progress,
-                    'downloaded': memory_task.downloaded,
-                    'total_size': memory_task.total_size,
-                    'speed': memory_task.speed,
-                    'log': memory_task.log_buffer.getvalue()
-                }
-                return json_response(task_data)
+        if memory_task:
+            task_data = {'id': task_id, **memory_task.snapshot()}
+            # 等待中的任务返回其在下载队列中的位置
+            scheduler = current_app.config.get('DOWNLOAD_SCHEDULER')
+            task_data['queue_position'] = scheduler.queue_position(task_id) if scheduler else None
+            return json_response(task_data)
 
         # 如果内存中没有，检查数据库
         db_task = task_db.get_task(task_id)
@@ -274,8 +270,9 @@ def cancel_task(task_id):
         if cancelled:
             with tasks_lock:
                 task.status = TaskStatus.CANCELLED
-            # 更新数据库状态
+            # 更新数据库状态，排队中的任务不会再执行，从持久化队列中移除
             task_db.update_task(task_id, status=TaskStatus.CANCELLED)
+            task_db.remove_download(task_id)
             if global_logger:
                 global_logger.info(f"Task {task_id} cancelled successfully")
             return json_response({'message': 'Task cancelled'})
@@ -302,14 +299,13 @@ def retry_task(task_id):
         from database import task_db
         from datetime import datetime, timezone
         import sqlite3
-        import main
 
-        # 从 current_app.config 获取 tasks、tasks_lock 和 executor
+        # 从 current_app.config 获取 tasks、tasks_lock 和下载调度器
         tasks = current_app.config.get('TASKS', {})
         tasks_lock = current_app.config.get('TASKS_LOCK')
-        executor = current_app.config.get('EXECUTOR')
+        scheduler = current_app.config.get('DOWNLOAD_SCHEDULER')
 
-        if not tasks_lock or not executor:
+        if not tasks_lock or not scheduler:
             return json_response({'error': 'Server not properly initialized'}), 500
 
         # 从数据库获取任务信息
@@ -333,6 +329,24 @@ def retry_task(task_id):
         # 创建新的任务ID
         new_task_id = datetime.now(timezone.utc).strftime('%y%m%d%H%M%S%f')
 
+        # 创建新的任务执行
+        # 将 favcat 从字符串转换回原始格式（'0'-'9' 或 False）
+        if favcat and favcat.isdigit():
+            favcat_param = favcat  # 保持为字符串 '0'-'9'
+        else:
+            favcat_param = False
+        
+        # 手动重试按手动下载的优先级排队
+        submit_download_task = current_app.config.get('SUBMIT_DOWNLOAD_TASK')
+        owner_id = submit_download_task(new_task_id, url, mode=mode, favcat=favcat_param, priority='manual')
+        if owner_id != new_task_id:
+            # 同一画廊已有排队中或执行中的任务，保留原失败任务不做修改
+            return json_response({
+                'message': f'Task for this gallery is already in progress with ID {owner_id}',
+                'task_id': owner_id,
+                'queue_position': scheduler.queue_position(owner_id)
+            }), 200
+
         # 添加新任务到数据库
         task_db.add_task(new_task_id, status=TaskStatus.IN_PROGRESS, url=url, mode=mode, favcat=favcat)
 
@@ -355,33 +369,13 @@ def retry_task(task_id):
                     tasks[task_id].log_buffer.close()
                 del tasks[task_id]
 
-        # 创建新的任务执行
-        # 将 favcat 从字符串转换回原始格式（'0'-'9' 或 False）
-        if favcat and favcat.isdigit():
-            favcat_param = favcat  # 保持为字符串 '0'-'9'
-        else:
-            favcat_param = False
-        
-        logger, log_buffer = main.get_task_logger(new_task_id)
-        
-        # 从 current_app.config 获取函数和类
-        get_task_logger = current_app.config.get('GET_TASK_LOGGER')
-        task_failure_processing = current_app.config.get('TASK_FAILURE_PROCESSING')
-        download_gallery_task = current_app.config.get('DOWNLOAD_GALLERY_TASK')
-        TaskInfo = current_app.config.get('TASK_INFO_CLASS')
-        
-        # 动态应用装饰器
-        decorated_download_task = task_failure_processing(url, new_task_id, logger, tasks, tasks_lock)(download_gallery_task)
-        
-        future = executor.submit(decorated_download_task, url, mode, new_task_id, logger, favcat_param, tasks, tasks_lock)
-
-        # 更新内存中的任务信息
-        with tasks_lock:
-            tasks[new_task_id] = TaskInfo(future, logger, log_buffer)
-
         if global_logger:
             global_logger.info(f"Task retry started with new ID {new_task_id}")
-        return json_response({'message': f'Task retry started with new ID {new_task_id}', 'task_id': new_task_id}), 202
+        return json_response({
+            'message': f'Task retry started with new ID {new_task_id}',
+            'task_id': new_task_id,
+            'queue_position': scheduler.queue_position(new_task_id)
+        }), 202
 
     except Exception as e:
         if global_logger:
@@ -427,36 +421,22 @@ def get_tasks():
         # 从数据库获取任务列表
         db_tasks, total = task_db.get_tasks(status_filter, page, page_size)
 
-        # 合并内存中的活跃任务信息
+        # 合并内存中的活跃任务信息：只在查找时持有锁，读取快照和写数据库都在锁外进行
+        scheduler = current_app.config.get('DOWNLOAD_SCHEDULER')
         with tasks_lock:
-            for db_task in db_tasks:
-                task_id = db_task['id']
-                if task_id in tasks:
-                    memory_task = tasks[task_id]
-                    # 用内存中的最新信息更新数据库任务
-                    db_task.update({
-                        'status': memory_task.status,
-                        'error': memory_task.error,
-                        'log': memory_task.log_buffer.getvalue(),
-                        'filename': memory_task.filename,
-                        'progress': memory_task.progress,
-                        'downloaded': memory_task.downloaded,
-                        'total_size': memory_task.total_size,
-                        'speed': memory_task.speed
-                    })
-
-                    # 同步更新数据库
-                    task_db.update_task(
-                        task_id,
-                        status=memory_task.status,
-                        error=memory_task.error,
-                        log=memory_task.log_buffer.getvalue(),
-                        filename=memory_task.filename,
-                        progress=memory_task.progress,
-                        downloaded=memory_task.downloaded,
-                        total_size=memory_task.total_size,
-                        speed=memory_task.speed
-                    )
+            memory_tasks = {db_task['id']: tasks[db_task['id']] for db_task in db_tasks if db_task['id'] in tasks}
+        for db_task in db_tasks:
+            memory_task = memory_tasks.get(db_task['id'])
+            if not memory_task:
+                continue
+            snapshot = memory_task.snapshot()
+            # 用内存中的最新信息更新数据库任务
+            db_task.update(snapshot)
+            db_task['queue_position'] = scheduler.queue_position(db_task['id']) if scheduler else None
+
+            # 同步更新数据库（eta 只在内存中保留）
+            snapshot.pop('eta', None)
+            task_db.update_task(db_task['id'], **snapshot)
 
         # 按任务ID降序排序（任务ID基于时间，新的ID更大）
         db_tasks.sort(key=lambda x: x.get('id', ''), reverse=True)
@@ -501,7 +481,8 @@ def get_tasks():
                 'completed': completed_count,
                 'cancelled': cancelled_count,
                 'failed': failed_count
-            }
+            },
+            'queue': scheduler.snapshot() if scheduler else None
         })
 
     except Exception as e:
@@ -1,9 +1,11 @@
 from flask_apscheduler import APScheduler
+import json
 import logging
 import requests
 from flask import current_app
 from providers.komga import KomgaAPI
 from database import task_db
+from bandwidth import bandwidth_limiter
 
 from utils import parse_gallery_url
 from metadata_extractor import parse_filename
@@ -11,6 +13,9 @@ from metadata_extractor import parse_filename
 # 初始化调度器
 scheduler = APScheduler()
 
+# global 表中记录上次同步时各收藏夹分类画廊数量的键
+FAVCAT_COUNTS_KEY = 'eh_favcat_counts'
+
 def trigger_undownloaded_favorites_download(logger=None, config=None):
     """
     触发未下载收藏的下载任务。
@@ -37,6 +42,14 @@ def trigger_undownloaded_favorites_download(logger=None, config=None):
         return 0, 0, 0
     
     logger.info(f"发现 {len(undownloaded_favorites)} 个新的收藏夹项目需要下载。")
+
+    # 先通过 gdata 批量（每次 25 个）检查画廊，跳过 gid/token 已失效的项目；结果写入元数据缓存供下载时使用
+    gmetadata_map = ehentai_tool.get_gmetadata_many([(fav['gid'], fav['token']) for fav in undownloaded_favorites])
+    invalid_favorites = [fav for fav in undownloaded_favorites if 'error' in gmetadata_map.get(fav['gid'], {})]
+    for fav in invalid_favorites:
+        logger.warning(f"收藏画廊 GID {fav['gid']} 无法获取元数据，跳过下载: {gmetadata_map[fav['gid']]['error']}")
+    undownloaded_favorites = [fav for fav in undownloaded_favorites if fav not in invalid_favorites]
+
     port = config.get('PORT', 5001)
     api_base_url = f"http://127.0.0.1:{port}"
     
@@ -52,7 +65,7 @@ def trigger_undownloaded_favorites_download(logger=None, config=None):
         try:
             logger.info(f"为新画廊创建下载任务: {url}")
             favcat_id = fav.get('favcat')
-            response = requests.get(f"{api_base_url}/api/download", params={"url": url, "fav": favcat_id, "download": "true"}, timeout=10)
+            response = requests.get(f"{api_base_url}/api/download", params={"url": url, "fav": favcat_id, "download": "true", "priority": "favorites"}, timeout=10)
             
             if response.status_code == 202:
                 logger.info(f"成功为 {url} 创建下载任务。")
@@ -68,7 +81,76 @@ def trigger_undownloaded_favorites_download(logger=None, config=None):
             logger.error(f"调用下载 API 时发生网络错误 for url {url}: {re}")
             failed_count += 1
     
-    return success_count, failed_count, len(undownloaded_favorites)
+    return success_count, failed_count + len(invalid_favorites), len(undownloaded_favorites) + len(invalid_favorites)
+
+def _sync_favcat_galleries(ehentai_tool, favcat_list, initial_scan_pages, reconcile_favcats, logger):
+    """
+    扫描指定的收藏夹分类并同步到 eh_favorites 表，返回请求失败的分类ID列表
+    reconcile_favcats 中的分类忽略已有记录进行全量扫描，以便删除线上已不存在的本地记录
+    """
+    # 3. 获取数据库中已存在的画廊，按收藏夹分类分组
+    local_galleries_raw = task_db.get_eh_favorites_by_favcat(favcat_list)
+    local_galleries = {g['gid']: g for g in local_galleries_raw}
+    existing_gids = {favcat: set() for favcat in favcat_list}
+    for g in local_galleries_raw:
+        existing_gids.setdefault(str(g['favcat']), set()).add(g['gid'])
+
+    if local_galleries:
+        logger.info(f"数据库中已有 {len(local_galleries)} 个收藏画廊，有记录的分类将进行增量扫描（连续匹配5个相同GID时停止）。")
+    else:
+        if initial_scan_pages == 0:
+            logger.info(f"数据库中没有收藏记录，将进行全量扫描（所有页）。")
+        else:
+            logger.info(f"数据库中没有收藏记录，将扫描前 {initial_scan_pages} 页。")
+
+    # 4. 按分类获取画廊，并以 GID 作为键（传入各分类已存在的GID集合和首次扫描页数）
+    # 注意：有记录的分类进行增量扫描，只返回新的画廊；complete_favcats 为返回了完整线上列表的分类
+    online_galleries_raw, complete_favcats, failed_favcats = ehentai_tool.get_favorites_by_favcat(
+        favcat_list,
+        existing_gids=existing_gids,
+        initial_scan_pages=initial_scan_pages,
+        full_scan_favcats=reconcile_favcats
+    )
+    online_galleries = {}
+    for g in online_galleries_raw:
+        gid, _ = parse_gallery_url(g.get('url', ''))
+        if gid:
+            online_galleries[gid] = g
+
+    logger.info(f"扫描完成，从线上收藏夹中获取到 {len(online_galleries)} 个新的或需要更新的画廊。")
+
+    # 5. 执行数据库操作
+    # 使用 UPSERT 逻辑一次性处理新增和信息变更（如 favcat, added time）
+    if online_galleries:
+        galleries_to_upsert = list(online_galleries.values())
+
+        if task_db.upsert_eh_favorites(galleries_to_upsert):
+            logger.info(f"成功向数据库同步（新增/更新）了 {len(galleries_to_upsert)} 个收藏夹画廊。")
+        else:
+            logger.error("向数据库同步（新增/更新）画廊时发生错误。")
+    else:
+        logger.info("线上收藏夹为空或没有新画廊，无需同步。")
+
+    # 6. 只对返回了完整线上列表的分类删除本地不存在于线上的画廊
+    # 增量扫描或受页数限制的分类不删除，因为我们没有获取该分类完整的线上列表
+    if complete_favcats:
+        online_gids = set(online_galleries.keys())
+        removed_gids = {
+            gid for gid, g in local_galleries.items()
+            if str(g['favcat']) in complete_favcats and gid not in online_gids
+        }
+
+        if removed_gids:
+            if task_db.delete_eh_favorites_by_gids(list(removed_gids)):
+                logger.info(f"成功从数据库移除了 {len(removed_gids)} 个已不存在的收藏夹画廊。")
+            else:
+                logger.error("从数据库移除旧画廊时发生错误。")
+        else:
+            logger.info("没有需要移除的收藏夹画廊。")
+    else:
+        logger.info("没有获取到完整线上列表的收藏夹分类，跳过画廊删除检查。")
+
+    return failed_favcats
 
 def sync_eh_favorites_job(auto_download=None):
     """
@@ -103,70 +185,43 @@ def sync_eh_favorites_job(auto_download=None):
 
             logger.info(f"准备同步以下收藏夹分类: {favcat_list}")
 
-            # 3. 获取数据库中已存在的画廊
-            local_galleries_raw = task_db.get_eh_favorites_by_favcat(favcat_list)
-            local_galleries = {g['gid']: g for g in local_galleries_raw}
-            existing_gids = set(local_galleries.keys())
-            
             # 获取首次扫描页数配置
             initial_scan_pages = config.get('EH_FAV_INITIAL_SCAN_PAGES', 1)
-            
-            if existing_gids:
-                logger.info(f"数据库中已有 {len(existing_gids)} 个收藏画廊，将进行增量扫描（连续匹配5个相同GID时停止）。")
-            else:
-                if initial_scan_pages == 0:
-                    logger.info(f"数据库中没有收藏记录，将进行全量扫描（所有页）。")
-                else:
-                    logger.info(f"数据库中没有收藏记录，将扫描前 {initial_scan_pages} 页。")
 
-            # 4. 获取所有画廊，并以 GID 作为键（传入已存在的GID集合和首次扫描页数）
-            # 注意：当传入 existing_gids 时，get_favorites 会进行增量扫描，只返回新的画廊
-            is_incremental = existing_gids is not None and len(existing_gids) > 0
-            
-            online_galleries_raw = ehentai_tool.get_favorites(
-                favcat_list,
-                existing_gids=existing_gids if existing_gids else None,
-                initial_scan_pages=initial_scan_pages
-            )
-            online_galleries = {}
-            for g in online_galleries_raw:
-                gid, _ = parse_gallery_url(g.get('url', ''))
-                if gid:
-                    online_galleries[gid] = g
-            
-            if is_incremental:
-                logger.info(f"增量扫描完成，从线上收藏夹中获取到 {len(online_galleries)} 个新的画廊。")
+            # 2. 预检查：读取收藏夹页面顶部各分类的画廊数量（一次请求），与上次同步时记录的数量比较
+            scan_favcats = favcat_list
+            reconcile_favcats = []
+            online_counts = ehentai_tool.get_favcat_counts()
+            stored_counts = json.loads(task_db.get_global_state(FAVCAT_COUNTS_KEY) or '{}')
+            if online_counts is None:
+                logger.warning("无法读取各收藏夹分类的画廊数量，将扫描所有要同步的分类。")
             else:
-                logger.info(f"全量扫描完成，从线上收藏夹中获取到 {len(online_galleries)} 个画廊。")
-
-            # 5. 执行数据库操作
-            # 使用 UPSERT 逻辑一次性处理新增和信息变更（如 favcat, added time）
-            if online_galleries:
-                galleries_to_upsert = list(online_galleries.values())
-                
-                if task_db.upsert_eh_favorites(galleries_to_upsert):
-                    logger.info(f"成功向数据库同步（新增/更新）了 {len(galleries_to_upsert)} 个收藏夹画廊。")
-                else:
-                    logger.error("向数据库同步（新增/更新）画廊时发生错误。")
-            else:
-                logger.info("线上收藏夹为空或没有新画廊，无需同步。")
-
-            # 6. 只有在全量扫描时才删除本地不存在于线上的画廊
-            # 增量扫描时不删除，因为我们没有获取完整的线上列表
-            if not is_incremental:
-                online_gids = set(online_galleries.keys())
-                local_gids = set(local_galleries.keys())
-                removed_gids = local_gids - online_gids
-                
-                if removed_gids:
-                    if task_db.delete_eh_favorites_by_gids(list(removed_gids)):
-                        logger.info(f"成功从数据库移除了 {len(removed_gids)} 个已不存在的收藏夹画廊。")
-                    else:
-                        logger.error("从数据库移除旧画廊时发生错误。")
-                else:
-                    logger.info("没有需要移除的收藏夹画廊。")
+                scan_favcats = [favcat for favcat in favcat_list if online_counts.get(favcat) != stored_counts.get(favcat)]
+                decreased = [
+                    favcat for favcat in scan_favcats
+                    if favcat in online_counts and favcat in stored_counts and online_counts[favcat] < stored_counts[favcat]
+                ]
+                if decreased:
+                    # 数量减少说明有画廊被取消收藏或移动到了其他分类，增量扫描无法发现删除，
+                    # 因此对所有数量变化的分类做一次全量核对（移动的画廊在目标分类中也能被找到）
+                    reconcile_favcats = scan_favcats
+                    logger.info(f"收藏夹分类 {decreased} 的画廊数量减少，将对分类 {reconcile_favcats} 进行全量核对。")
+                elif scan_favcats:
+                    logger.info(f"收藏夹分类 {scan_favcats} 的画廊数量有变化，开始扫描。")
+
+            # 3-6. 扫描数量有变化的分类并同步到数据库
+            if scan_favcats:
+                failed_favcats = _sync_favcat_galleries(ehentai_tool, scan_favcats, initial_scan_pages, reconcile_favcats, logger)
             else:
-                logger.info("增量扫描模式，跳过画廊删除检查。")
+                failed_favcats = []
+                logger.info("各收藏夹分类的画廊数量与上次同步时相同，跳过收藏夹扫描。")
+
+            # 记录本次同步的分类数量，请求失败的分类保留旧值以便下次重新扫描
+            if online_counts is not None:
+                for favcat in favcat_list:
+                    if favcat in online_counts and favcat not in failed_favcats:
+                        stored_counts[favcat] = online_counts[favcat]
+                task_db.set_global_state(FAVCAT_COUNTS_KEY, json.dumps(stored_counts))
 
             # 7. 检查 Komga 匹配
             komga_enabled = config.get('KOMGA_TOGGLE', False)
@@ -469,6 +524,20 @@ def update_scheduler_jobs(app):
             if existing_komga_index_job:
                 app.logger.info("Komga URL 索引同步任务已禁用并移除")
 
+        # 添加下载限速时段检查任务（没有下载进行时也能按时切换 aria2 的限速）
+        bandwidth_job_id = 'refresh_bandwidth_schedule'
+        if scheduler.get_job(bandwidth_job_id):
+            scheduler.remove_job(bandwidth_job_id)
+
+        if bandwidth_limiter.configured:
+            scheduler.add_job(
+                id=bandwidth_job_id,
+                func=bandwidth_limiter.refresh,
+                trigger='interval',
+                minutes=1,
+                misfire_grace_time=60
+            )
+
 
 def init_scheduler(app):
     """
@@ -0,0 +1,112 @@
+import time
+from collections import deque
+
+# 计算瞬时吞吐量的滑动窗口（秒）
+SPEED_WINDOW = 5.0
+# 速度的指数加权移动平均系数，越大越接近瞬时速度
+SPEED_EWMA_ALPHA = 0.3
+# 向 TaskInfo 发布进度的最小间隔（秒）
+UPDATE_INTERVAL = 0.5
+
+
+def estimate_eta(remaining, speed):
+    """根据剩余字节数和速度估算剩余时间（秒），无法估算时返回 None"""
+    if remaining is None or remaining < 0 or not speed or speed <= 0:
+        return None
+    return int(remaining / speed)
+
+
+def format_size(bytes_value):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if bytes_value < 1024:
+            return f"{bytes_value:.1f} {unit}"
+        bytes_value /= 1024
+    return f"{bytes_value:.1f} TB"
+
+
+def format_speed(speed):
+    if speed >= 1024 * 1024:
+        return f"{speed / (1024 * 1024):.2f} MB/s"
+    if speed >= 1024:
+        return f"{speed / 1024:.2f} KB/s"
+    return f"{int(speed)} B/s"
+
+
+class TransferMeter:
+    """
+    下载流量计：滑动窗口吞吐量 + EWMA 平滑速度 + ETA
+
+    add() 记录新下载的字节数，按 UPDATE_INTERVAL 节流后通过 task.update_progress() 发布
+    downloaded、total_size、speed、eta（report_progress 为 True 时同时发布字节进度百分比）。
+    每个下载只由一个线程调用 add()，不需要加锁。
+    """
+
+    def __init__(self, task=None, total_size=0, downloaded=0, report_progress=True,
+                 window=SPEED_WINDOW, alpha=SPEED_EWMA_ALPHA, update_interval=UPDATE_INTERVAL):
+        self.task = task
+        self.total_size = total_size or 0
+        self.downloaded = downloaded
+        self.initial = downloaded
+        self.report_progress = report_progress
+        self.window = window
+        self.alpha = alpha
+        self.update_interval = update_interval
+        self.started_at = time.monotonic()
+        # (时间, 累计字节数) 样本，续传时已有的字节不计入速度
+        self.samples = deque([(self.started_at, downloaded)])
+        self.speed = 0.0
+        self.last_publish = 0.0
+
+    def set_total(self, total_size):
+        self.total_size = total_size or 0
+
+    def add(self, nbytes):
+        """记录新下载的 nbytes 字节，到达发布间隔时更新任务进度"""
+        self.downloaded += nbytes
+        now = time.monotonic()
+        if now - self.last_publish >= self.update_interval:
+            self._sample(now)
+            self.publish(now)
+
+    def _sample(self, now):
+        self.samples.append((now, self.downloaded))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        start_time, start_bytes = self.samples[0]
+        elapsed = now - start_time
+        if elapsed <= 0:
+            return
+        rate = (self.downloaded - start_bytes) / elapsed
+        # 第一个样本直接使用窗口速度，之后做指数平滑
+        self.speed = rate if self.speed == 0 else self.alpha * rate + (1 - self.alpha) * self.speed
+
+    @property
+    def eta(self):
+        if not self.total_size:
+            return None
+        return estimate_eta(self.total_size - self.downloaded, self.speed)
+
+    @property
+    def average_speed(self):
+        """本次下载的平均速度（B/s）"""
+        elapsed = time.monotonic() - self.started_at
+        return (self.downloaded - self.initial) / elapsed if elapsed > 0 else 0
+
+    def publish(self, now=None):
+        self.last_publish = now or time.monotonic()
+        if not self.task:
+            return
+        fields = {
+            'downloaded': self.downloaded,
+            'total_size': self.total_size,
+            'speed': int(self.speed),
+            'eta': self.eta,
+        }
+        if self.report_progress and self.total_size > 0:
+            fields['progress'] = min(100, int(self.downloaded * 100 / self.total_size))
+        self.task.update_progress(**fields)
+
+    def finish(self):
+        """下载结束：发布最终字节数，速度归零"""
+        self.speed = 0.0
+        self.publish()
@@ -1,10 +1,13 @@
 import os, json, re
+import struct
+import threading
 import zipfile
 import unicodedata
 import logging
 from logging.handlers import RotatingFileHandler
 from glob import glob
 from enum import Enum
+from collections import OrderedDict
 from flask import Response
 
 class TaskStatus(str, Enum):
@@ -15,6 +18,17 @@ class TaskStatus(str, Enum):
     @classmethod
     def all(cls):
         return [item.value for item in cls]
+
+
+def get_task_info(task_id, tasks=None, tasks_lock=None):
+    """
+    获取任务的内存记录（只在查找时持有 tasks_lock）
+    下载循环应在开始前获取一次，之后通过 task.cancel_event 和 task.update_progress() 无锁访问
+    """
+    if not task_id or tasks is None or tasks_lock is None:
+        return None
+    with tasks_lock:
+        return tasks.get(task_id)
     
 
 def json_output(data):
@@ -51,14 +65,121 @@ def is_url(text):
     return re.match(url_pattern, text) is not None
 
 # 验证 ZIP 文件完整性
-def is_valid_zip(path: str) -> bool:
+# ZIP 校验级别：structure 只检查中央目录和各成员的本地文件头，full 额外解压并校验所有成员的 CRC
+ZIP_CHECK_STRUCTURE = "structure"
+ZIP_CHECK_FULL = "full"
+_ZIP_CHECK_LEVELS = {ZIP_CHECK_STRUCTURE: 1, ZIP_CHECK_FULL: 2}
+
+# 已通过校验的压缩包，键为 (绝对路径, 大小, 修改时间)，文件被改写后自动失效
+_ZIP_CHECK_CACHE_SIZE = 256
+_zip_check_cache = OrderedDict()
+_zip_check_lock = threading.Lock()
+
+def _zip_cache_key(path: str):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+def mark_zip_verified(path: str, level: str = ZIP_CHECK_FULL):
+    """
+    记录压缩包已通过指定级别的校验
+    写入时已逐个校验过成员 CRC 的压缩包（如 cbztool 重新打包的 CBZ）在写完后调用，之后的 full 校验直接命中缓存
+    """
+    try:
+        key = _zip_cache_key(path)
+    except OSError:
+        return
+    with _zip_check_lock:
+        if _ZIP_CHECK_LEVELS[level] > _ZIP_CHECK_LEVELS.get(_zip_check_cache.get(key), 0):
+            _zip_check_cache[key] = level
+        _zip_check_cache.move_to_end(key)
+        while len(_zip_check_cache) > _ZIP_CHECK_CACHE_SIZE:
+            _zip_check_cache.popitem(last=False)
+
+def is_zip_verified(path: str, level: str = ZIP_CHECK_FULL) -> bool:
+    """压缩包自上次修改后是否已通过不低于 level 的校验"""
+    try:
+        key = _zip_cache_key(path)
+    except OSError:
+        return False
+    with _zip_check_lock:
+        return _ZIP_CHECK_LEVELS.get(_zip_check_cache.get(key), 0) >= _ZIP_CHECK_LEVELS[level]
+
+def check_zip_structure(zf: zipfile.ZipFile) -> bool:
+    """检查每个成员的本地文件头签名，以及数据是否越过中央目录，只读取文件头不读取成员数据"""
+    end = getattr(zf, "start_dir", None)
+    for info in zf.infolist():
+        zf.fp.seek(info.header_offset)
+        header = zf.fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            return False
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        data_end = (info.header_offset + zipfile.sizeFileHeader + fields[zipfile._FH_FILENAME_LENGTH]
+                    + fields[zipfile._FH_EXTRA_FIELD_LENGTH] + info.compress_size)
+        if end is not None and data_end > end:
+            return False
+    return True
+
+def is_valid_zip(path: str, mode: str = ZIP_CHECK_FULL) -> bool:
+    """
+    校验压缩包，结果按 (路径, 大小, 修改时间) 缓存，同一文件最多完整校验一次
+    mode 为 ZIP_CHECK_STRUCTURE 时只做结构检查，ZIP_CHECK_FULL 时再用 testzip 校验所有成员
+    """
     if not path or not os.path.exists(path):
         return False
+    if is_zip_verified(path, mode):
+        return True
     try:
         with zipfile.ZipFile(path, "r") as zf:
-            return zf.testzip() is None
-    except (FileNotFoundError, zipfile.BadZipFile):
+            if not check_zip_structure(zf):
+                return False
+            if mode == ZIP_CHECK_FULL and zf.testzip() is not None:
+                return False
+    except (OSError, zipfile.BadZipFile):
         return False
+    mark_zip_verified(path, mode)
+    return True
+
+def is_valid_image(path: str, data=None) -> bool:
+    """
+    轻量检查图片文件是否完整：只读取文件头和文件尾，不解码图片
+    - 文件头魔数需与格式匹配
+    - JPEG 需以 FFD9 结尾，PNG 需以 IEND 块结尾，GIF 需以 0x3B 结尾，WebP 的 RIFF 长度需与文件大小一致
+    无法识别的格式只要文件非空即视为有效
+    data 不为空时直接检查内存中的内容（bytes/memoryview），path 仅用于判断扩展名
+    """
+    if data is not None:
+        size = len(data)
+        if size < 12:
+            return False
+        head = bytes(data[:16])
+        tail = bytes(data[max(0, size - 12):])
+    else:
+        try:
+            size = os.path.getsize(path)
+            if size < 12:
+                return False
+            with open(path, 'rb') as f:
+                head = f.read(16)
+                f.seek(max(0, size - 12))
+                tail = f.read()
+        except OSError:
+            return False
+
+    if head.startswith(b'\xff\xd8\xff'):
+        # 部分 JPEG 在 EOI 之后带有填充字节
+        return b'\xff\xd9' in tail
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return tail.endswith(b'IEND\xaeB`\x82')
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return tail.endswith(b'\x3b')
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return int.from_bytes(head[4:8], 'little') + 8 <= size
+    if head[4:8] == b'ftyp' or head.startswith(b'\xff\x0a') or head.startswith(b'\x00\x00\x00\x0cJXL '):
+        # AVIF / JXL 没有简单的结束标记，只检查文件头
+        return True
+
+    ext = os.path.splitext(path)[1].lower()
+    return ext not in ('.jpg', '.jpeg', '.png', '.gif', '.webp')
 
 # 移除字符串中的表情符号
 def remove_emoji(text):
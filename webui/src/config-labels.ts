@@ -72,6 +72,18 @@ export const configLabels: Record<string, Record<string, FieldLabel>> = {
         prefer_openai_series: {
             label: '优先 OpenAI 系列识别',
             description: '优先使用 OpenAI 进行系列识别，正则作为后备方案'
+        },
+        page_download_concurrency: {
+            label: '逐页下载并发数',
+            description: 'nhentai / Hitomi 逐页下载时每个画廊同时下载的页面数'
+        },
+        stream_cbz: {
+            label: '流式打包 CBZ',
+            description: 'nhentai / Hitomi 下载的页面按顺序直接写入 CBZ，不再经过临时目录重新打包'
+        },
+        cbz_compression: {
+            label: 'CBZ 压缩方式',
+            description: 'stored：图片不再压缩（推荐，图片本身已压缩）；deflated：使用 zlib 压缩'
         }
     },
 